@@ -5,7 +5,8 @@ The module defines traverse_deps and supproting functions
 for traversing ELF file dependancy tree.
 
 Used:
-`readelf -d` utility for reading the dynamic section of ELF files,
+elf_dynamic for reading the dynamic section of ELF files in-process,
+with `readelf -d` as the fallback backend,
 `uname -m` for getting the <platform> of the machine.
 
 Dependencies are searched according to ld.so man page:
@@ -14,11 +15,16 @@ Dependencies are searched according to ld.so man page:
        if it contains a slash `/`
 
     2. if not, it searches through:
+       0) `RPATH` of the ELF's dynamic section, if there is no `RUNPATH`,
        1) paths in `LD_LIBRARY_PATH` environment variable,
        2) `RUNPATH` of the ELF's dynamic section
-       3) in standard paths:
+       3) /etc/ld.so.cache, loaded once by ld_cache,
+          or the directories listed in /etc/ld.so.conf if there is no cache
+       4) in standard paths:
            /lib/, /usr/lib/, /lib/<platform>-linux-gnu/, /usr/lib/<platform>-linux-gnu/
           --- where <platform> is found from `uname -m`.
+       with the glibc-hwcaps subdirectories of each path first.
+       The search directories are listed once, see ld_search.
 
 """
 
@@ -26,18 +32,28 @@ import argparse
 import textwrap
 
 import logging
+import os
+import shutil
 import sys
-from os import environ
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from os import environ, uname
 from os.path import isfile, realpath, basename, dirname
-from subprocess import check_output, CalledProcessError
 
-from dep_node import DepNode, DepDefinition
+import elf_cache
+import elf_dynamic
+import ld_cache
+import ld_search
+import run_stats
+from ld_search import find_so
+from dep_node import DepNode, DepDefinition, CompactGraph, GRAPH_FORMATS, graph_lines
+from versions import is_range
 
-MAX_DEPTH = 10
+MAX_DEPTH = None # the default depth limit of traverse_deps, None = no limit
 #only_binaries=False
 
-platform = check_output("uname -m", shell=True).decode().strip()
-# has got to be a better way
+platform = uname().machine  # `uname -m`, without spawning it
 #print(platform)
 paths_stdlibs = ['/lib/', '/lib64/', "/lib/"+ platform +"-linux-gnu/", '/usr/lib/', "/usr/lib/"+ platform +"-linux-gnu/"]
 #print(paths_stdlibs)
@@ -49,93 +65,171 @@ if 'LD_LIBRARY_PATH' in environ:
 #>>> os.environ["LD_LIBRARY_PATH"]
 #':/opt/AMDAPP/lib/x86_64:/opt/AMDAPP/lib/x86'
 
-def find_so(so, paths):
-    for p in paths:
-        if isfile(p + "/" + so):
-            return p + "/" + so
+paths_ld_conf = ld_search.read_ld_so_conf()
+hwcaps = ld_search.hwcaps_subdirs(platform)
+ld_so_cache = ld_cache.load_ld_so_cache(platform, hwcaps)
+
+resolver = ld_search.LibraryResolver(paths_ld_lib, paths_ld_conf, paths_stdlibs, hwcaps, ld_so_cache)
+
+def expand_origin(paths_str, directory):
+    '''
+    split a RUNPATH/RPATH string into the list of directories
+    with $ORIGIN replaced by the directory of the ELF file
+    '''
+    if not paths_str:
+        return []
+    return paths_str.replace('${ORIGIN}', directory).replace('$ORIGIN', directory).split(':')
+
+# the dynamic sections read in this run, per physical file:
+# symlink aliases like libc.so.6 -> libc-2.19.so are read once
+_physical_files = {}
+_physical_files_locks = {}
+_physical_files_lock = threading.Lock()
+
+def read_physical_file(thebin):
+    '''
+    read_physical_file(thebin) -> ElfDynamic of the real path <thebin>,
+    read once per run, also when several threads ask for it
+    '''
+
+    dynamic = _physical_files.get(thebin)
+    if dynamic is not None:
+        return dynamic
+
+    with _physical_files_lock:
+        lock = _physical_files_locks.setdefault(thebin, threading.Lock())
+
+    with lock:
+        dynamic = _physical_files.get(thebin)
+        if dynamic is None:
+            dynamic = _physical_files[thebin] = elf_cache.read_elf_dynamic(thebin)
+
+    return dynamic
+
+def read_physical_files(thebins, jobs=1):
+    '''
+    read_physical_files(thebins, jobs=1)
+
+    Read the real paths that were not read yet in one batch (see elf_cache.read_many):
+    the readelf calls of the batch are in flight together.
+    A file that fails is left to read_physical_file, which raises the error.
+    '''
+
+    missing = [thebin for thebin in dict.fromkeys(thebins) if thebin not in _physical_files]
+    for thebin, dynamic in zip(missing, elf_cache.read_many(missing, jobs)):
+        if not isinstance(dynamic, BaseException):
+            _physical_files.setdefault(thebin, dynamic)
+
+def read_dynamic(elf_filename, thebin=None):
+    '''
+    read_dynamic(elf_filename, thebin=None) -> ElfDynamic
+
+    The dynamic section is read in-process by elf_dynamic,
+    `readelf -d` is the fallback backend,
+    through the persistent elf_cache if it is open,
+    once per physical file <thebin> = realpath(elf_filename).
+    The needed, runpath and rpath are lists, with $ORIGIN expanded
+    relative to elf_filename.
+    '''
+
+    dynamic = read_physical_file(thebin or realpath(elf_filename))
 
-    return None
+    #name, directory = basename(filename), dirname(filename)
+    directory = dirname(elf_filename)
+
+    return dynamic._replace(needed  = list(dynamic.needed),
+                            runpath = expand_origin(dynamic.runpath, directory),
+                            rpath   = expand_origin(dynamic.rpath, directory))
 
 def readelf_dynamic(elf_filename):
-    # TODO: error-check here:
-    try:
-        elf_header = [l.decode() for l in check_output("readelf -d %s" % elf_filename, shell=True).split(b'\n')]
+    '''
+    readelf_dynamic(elf_filename) -> (needed, runpath, soname)
+    '''
 
-    except CalledProcessError as e:
-        #print("FAILED TO READ ELF " + elf_filename)
-        raise Exception(f'failed to readelf -d {elf_filename}') from e
-    #print(elf_header)
+    dynamic = read_dynamic(elf_filename)
+    return dynamic.needed, dynamic.runpath, dynamic.soname
 
-    #name, directory = basename(filename), dirname(filename)
-    directory = dirname(elf_filename)
+class AccumulatedNodes(dict):
+    '''
+    accumulated_dependencies = {'filename': [[DepNode, score], ...]}
 
-    needed  = []
-    runpath = []
-    soname  = ""
-    for line in elf_header:
-        if "NEEDED" in line:
-            needed.append( line.split('[')[1].split(']')[0] )
-        elif "SONAME" in line:
-            soname = line.split('[')[1].split(']')[0]
-        elif "RUNPATH" in line:
-            runpath = line.split('[')[1].split(']')[0].replace('$ORIGIN', directory).split(':')
+    with a hash index {DepDefinition: [DepNode, score]}
+    so that check_in_accumulated_nodes does not scan the lists.
 
-    return needed, runpath, soname
+    The index holds only exact definitions. DepDefinition equality is loose:
+    an empty version matches any version, hash sets match if they overlap.
+    So the names that got a loose node are remembered and still scanned.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.index = {}
+        self.loose_names = set()
+
+def is_loose(full_definition):
+    return not full_definition.version or is_range(full_definition.version) or len(full_definition.hashes) > 0
 
 def check_in_accumulated_nodes(full_definition, accumulated_dependencies):
     #
     name = full_definition.filename
-    if name not in accumulated_dependencies:
+    existing_deps = accumulated_dependencies.get(name)
+    if not existing_deps:
         return None
 
     # check if you can reuse the node
-    existing_deps = accumulated_dependencies[name]
+    index = getattr(accumulated_dependencies, 'index', None)
+    if index is not None and not is_loose(full_definition) and name not in accumulated_dependencies.loose_names:
+        existing = index.get(full_definition)
 
-    # if the definition matches one of existing nodes, use it
-    defs = [n.full_definition for n, _ in existing_deps]
-    if full_definition in defs: # TODO: this won't work well, right?
+    else:
+        # if the definition matches one of existing nodes, use it
+        # TODO: this won't work well, right?
         # definitions are just tuples
         # they will compare hashes and versions literally
         # without the meaning
-        ind = defs.index(full_definition)
-        existing_deps[ind][1] += 1 # increase the reuse score in the graph
+        existing = next((dep for dep in existing_deps if dep[0].full_definition == full_definition), None)
 
-        matching_node = existing_deps[ind][0]
-        #matching_node.parents.update(parent_nodes)
-        return matching_node
+    if existing is None:
+        return None
 
-    return None
+    run_stats.count('nodes.reused')
+    existing[1] += 1 # increase the reuse score in the graph
+    return existing[0]
 
-def add_to_accumulated_nodes(new_node, accumulated_dependencies):
+def add_to_accumulated_nodes(new_node, accumulated_dependencies, score=1):
     # check for collisions with existing dependencies
     # accumulated_dependencies = {'filename': [[DepNode, score], ...]}
-    if new_node.name in accumulated_dependencies:
-        existing_deps = accumulated_dependencies[new_node.name]
-        # check for conflicts and save multiple versions if needed
-        if new_node in existing_deps:
-            # no conflict - this node can be satisfied by one of accumulated ones
-            # increase the score of the node
-            existing_deps[existing_deps.index[new_node]][1] += 1
-
-    else:
-        accumulated_dependencies[new_node.name] = [[new_node, 1]]
-
-def traverse_deps(filename, parent_nodes=set(), accumulated_dependencies={}):
-    """traverse_deps(filename)
-
-    Traverse the dependency tree of <filename>.
-    And return the dependency graph as DepNode.
-    """
-
-    logging.debug(f'traverse_deps: {filename} {len(accumulated_dependencies)}')
-
-    # this is a tricky bit:
-    # the filename is the name that is used
-    # it is also the soname
-    # but the real name includes the version of this soname
-    name, directory = basename(filename), dirname(filename)
-
-    needed, runpath, soname = readelf_dynamic(filename)
+    existing_deps = accumulated_dependencies.setdefault(new_node.name, [])
+
+    # check for conflicts and save multiple versions if needed
+    for existing in existing_deps:
+        if existing[0] is new_node:
+            # the node is already there, increase its score
+            existing[1] += score
+            return
+
+    run_stats.count('nodes.created')
+    existing = [new_node, score]
+    existing_deps.append(existing)
+
+    if isinstance(accumulated_dependencies, AccumulatedNodes):
+        accumulated_dependencies.index.setdefault(new_node.full_definition, existing)
+        if is_loose(new_node.full_definition):
+            accumulated_dependencies.loose_names.add(new_node.name)
+
+FileVisit = namedtuple('FileVisit', 'needed runpath rpath soname version dependencies signature')
+# what traverse_deps learns about a file from the filesystem:
+# the dynamic section, the "version" (the real name),
+# the resolved paths of the NEEDED dependencies,
+# and the stat signature of the file when it was read (see elf_cache)
+
+def file_version(filename):
+    '''
+    file_version(filename) -> (thebin, version)
+
+    The node identity is DepDefinition(basename(filename), version),
+    it does not need reading the file.
+    '''
 
     #version = soname
     # no, version is the real name of the binary, not the soname
@@ -144,79 +238,345 @@ def traverse_deps(filename, parent_nodes=set(), accumulated_dependencies={}):
     version = basename(thebin) # TODO: is there some better way to get the binary version?
     # now, the binary "version" = its filename, i.e. its "interface name"
 
-    #
-    # Full definition of this dependency node
-    hashes = frozenset() # no hashes in this case of extracting from existing system
-    full_definition = DepDefinition(name, version, hashes)
+    return thebin, version
+
+def read_file(filename):
+    thebin, version = file_version(filename)
+    dynamic = read_dynamic(filename, thebin)
+
+    return dynamic.needed, dynamic.runpath, dynamic.rpath, dynamic.soname, version
+
+def resolve_dependencies(filename, needed, runpath, rpath=()):
+    '''
+    resolve_dependencies(filename, needed, runpath, rpath=()) -> [dep_filename, ...]
+
+    The paths of the NEEDED dependencies that were found, in the NEEDED order.
+    '''
 
-    matching_node = check_in_accumulated_nodes(full_definition, accumulated_dependencies)
-    if matching_node is not None:
-        matching_node.parents.update(parent_nodes)
-        return matching_node
+    directory = dirname(filename)
 
-    dependencies = set()
+    dependencies = []
     for dep in needed:
         # if it contains a slash -- look relative to binary's directory
-        # otherwise in $LD_LIBRARY_PATH
+        # otherwise in RPATH (if no RUNPATH)
+        # $LD_LIBRARY_PATH
         # RUNPATH
+        # /etc/ld.so.conf
         # or defaults "/lib/" "/usr/lib/" "/lib/"(uname -m)"-linux-gnu/" "/usr/lib/"(uname -m)"-linux-gnu/"
         if '/' in dep:
             if isfile(directory + dep):
-                dependencies.add(traverse_deps(directory + dep, parent_nodes, accumulated_dependencies))
+                dependencies.append(directory + dep)
             else:
                 logging.error(f"FILE NOT FOUND: {directory + dep}")
                 # and supposedly ld doesn't follow to other sorces of dependencies
 
         else:
-            libenv_bin = find_so(dep, paths_ld_lib)
-            if libenv_bin:
-                dependencies.add(traverse_deps(libenv_bin, parent_nodes, accumulated_dependencies))
+            dep_bin = resolver.find(dep, runpath, rpath)
+            if dep_bin:
+                dependencies.append(dep_bin)
                 continue
 
-            #
-            if runpath:
-                runpath_bin = find_so(dep, runpath)
-                if runpath_bin:
-                    dependencies.add(traverse_deps(runpath_bin, parent_nodes, accumulated_dependencies))
+            logging.error("DEP NOT FOUND %s" % dep)
+
+    return dependencies
+
+def visit_file(filename):
+    # the signature is taken before the file is read: a change during the scan shows on the next one
+    signature = elf_cache.stat_signature(os.stat(filename))
+    needed, runpath, rpath, soname, version = read_file(filename)
+    return FileVisit(needed, runpath, rpath, soname, version, resolve_dependencies(filename, needed, runpath, rpath), signature)
+
+def scan_files(filenames, jobs, on_error=None):
+    '''
+    scan_files(filenames, jobs, on_error=None) -> {filename: FileVisit}
+
+    Visit all files reachable from filenames, breadth-first, a frontier at a time:
+    the dynamic sections of the frontier are read in one batch (read_physical_files),
+    then its files are visited on a pool of <jobs> threads.
+    A file is in exactly one frontier, however many parents reach it.
+
+    If on_error(filename, exception) is given, the files that cannot be read
+    are passed to it and left out, instead of raising.
+    '''
+
+    visits = {}
+    seen = set()
+
+    def next_frontier(filenames):
+        frontier = []
+        for filename in filenames:
+            if filename not in seen:
+                seen.add(filename)
+                frontier.append(filename)
+        return frontier
+
+    def visit(filename):
+        try:
+            return visit_file(filename), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        frontier = next_frontier(filenames)
+        while frontier:
+            with run_stats.timer('scan.prefetch'):
+                read_physical_files(pool.map(realpath, frontier), jobs)
+
+            dependencies = []
+            for filename, (visit_result, error) in zip(frontier, pool.map(visit, frontier)):
+                if error is not None:
+                    if on_error is None:
+                        raise error
+                    on_error(filename, error)
                     continue
 
-            stdlibs_bin = find_so(dep, paths_stdlibs)
-            if stdlibs_bin:
-                #print(stdlibs_bin)
-                dependencies.add(traverse_deps(stdlibs_bin, parent_nodes, accumulated_dependencies))
+                visits[filename] = visit_result
+                dependencies.extend(visit_result.dependencies)
+
+            frontier = next_frontier(dependencies)
+
+    logging.debug(f'scan_files: visited {len(visits)} files with {jobs} jobs')
+    return visits
+
+class DepNodeGraph:
+    '''
+    The graph builder of traverse_deps that makes DepNode-s
+    and keeps them in accumulated_dependencies.
+    dep_node.CompactGraph is the other builder.
+    '''
+
+    def __init__(self, accumulated_dependencies):
+        self.accumulated_dependencies = accumulated_dependencies
+
+    def reuse_node(self, full_definition):
+        return check_in_accumulated_nodes(full_definition, self.accumulated_dependencies)
+
+    def new_node(self, name, soname, version, full_definition, full_path, rpath):
+        # the dependencies are added to the node when they are done
+        return DepNode(name, soname, version, full_definition, full_path, rpath, set(), set())
+
+    def attach(self, node, dep_node):
+        node.children.add(dep_node)
+        dep_node.parents.add(node)
+
+    def node_done(self, node, full_definition, score):
+        add_to_accumulated_nodes(node, self.accumulated_dependencies, score)
+
+def min_depths(filenames, visits=None, max_depth=MAX_DEPTH):
+    '''
+    min_depths(filenames, visits=None, max_depth=MAX_DEPTH) -> {DepDefinition: depth}
+
+    The shortest distance from any of the targets <filenames> to the nodes
+    within <max_depth>, breadth-first. traverse_into follows the dependencies
+    of a node only if it is closer than max_depth, wherever it meets the node
+    first: a node cut at max_depth under one target is not reused, cut,
+    where another target reaches it earlier.
+    '''
+
+    depths = {}
+    seen = set(filenames)
+    frontier = list(dict.fromkeys(filenames))
+    depth = 0
+    while frontier:
+        dependencies = []
+        for filename in frontier:
+            visit = visits.get(filename) if visits is not None else None
+            version = visit.version if visit is not None else file_version(filename)[1]
+            depths.setdefault(DepDefinition(basename(filename), version, frozenset()), depth)
+            if depth >= max_depth:
                 continue
 
-            logging.error("DEP NOT FOUND %s" % dep)
+            if visit is not None:
+                dependencies.extend(visit.dependencies)
+            else:
+                dynamic = read_dynamic(filename)
+                dependencies.extend(resolve_dependencies(filename, dynamic.needed, dynamic.runpath, dynamic.rpath))
+
+        frontier = []
+        for filename in dependencies:
+            if filename not in seen:
+                seen.add(filename)
+                frontier.append(filename)
+        depth += 1
 
-    new_dep = DepNode(name, soname, version, full_definition, filename, runpath, dependencies, parent_nodes)
+    return depths
 
-    add_to_accumulated_nodes(new_dep, accumulated_dependencies)
+def traverse_deps(filename, parent_nodes=None, accumulated_dependencies=None, visits=None, max_depth=MAX_DEPTH, depths=None):
+    """traverse_deps(filename)
 
-    return new_dep
+    Traverse the dependency tree of <filename>.
+    And return the dependency graph as DepNode.
+    The <parent_nodes> become the parents of the returned node.
 
-def targets_to_graph(targets):
-    entry_graph_nodes = []
-    accumulated_nodes = {}
+    If <visits> is given (see scan_files), the files are not read again,
+    the graph is built from the visits in the same order as without them.
+
+    The traversal is depth-first on an explicit stack, so deep graphs
+    do not hit the recursion limit. The dependencies of the nodes
+    at <max_depth> from the target are not followed (None = no limit),
+    or from the closest of several targets, if their min_depths are given.
+    Cycles are closed on the node that is still on the stack.
+    """
+
+    if accumulated_dependencies is None:
+        accumulated_dependencies = AccumulatedNodes()
+
+    root = traverse_into(filename, DepNodeGraph(accumulated_dependencies), visits, max_depth, depths)
+    if parent_nodes:
+        root.parents.update(parent_nodes)
+    return root
+
+def traverse_into(filename, graph, visits=None, max_depth=MAX_DEPTH, depths=None):
+    '''
+    traverse_into(filename, graph, visits=None, max_depth=MAX_DEPTH, depths=None) -> root node
+
+    The traversal of traverse_deps, building the nodes with
+    the <graph> builder: DepNodeGraph or dep_node.CompactGraph.
+    '''
 
-    for targ in targets:
-        full_filename = None
-        if isfile(targ):
-            #print("got file", targ)
-            full_filename = targ
+    if max_depth is not None and depths is None:
+        depths = min_depths([filename], visits, max_depth)
 
+    # the nodes on the stack, not done yet:
+    # {DepDefinition: [node, reuse score]}
+    in_progress = {}
+
+    def enter(filename):
+        '''
+        return (node, full_definition, dep_filenames),
+        dep_filenames is None if the node is reused
+        '''
+
+        logging.debug(f'traverse_deps: {filename} {len(in_progress)}')
+
+        # this is a tricky bit:
+        # the filename is the name that is used
+        # it is also the soname
+        # but the real name includes the version of this soname
+        name = basename(filename)
+
+        # the identity of the node first, the file is read only for a new node
+        visit = visits.get(filename) if visits is not None else None
+        if visit is not None:
+            version = visit.version
+        else:
+            thebin, version = file_version(filename)
+
+        #
+        # Full definition of this dependency node
+        hashes = frozenset() # no hashes in this case of extracting from existing system
+        full_definition = DepDefinition(name, version, hashes)
+
+        matching_node = graph.reuse_node(full_definition)
+        if matching_node is not None:
+            return matching_node, full_definition, None
+
+        # a cycle
+        if full_definition in in_progress:
+            in_progress[full_definition][1] += 1
+            return in_progress[full_definition][0], full_definition, None
+
+        if visit is not None:
+            needed, runpath, rpath, soname = visit.needed, visit.runpath, visit.rpath, visit.soname
+        else:
+            dynamic = read_dynamic(filename, thebin)
+            needed, runpath, rpath, soname = dynamic.needed, dynamic.runpath, dynamic.rpath, dynamic.soname
+
+        if max_depth is not None and depths.get(full_definition, max_depth) >= max_depth:
+            logging.warning(f"MAXIMUM DEPTH REACHED {max_depth}: {filename}")
+            dep_filenames = []
+        elif visit is not None:
+            dep_filenames = visit.dependencies
         else:
-            try:
-                #print("which %s" % targ)
-                filename = check_output("which %s" % targ, shell=True).strip().decode()
-                #print("got a command, found it at %s" % filename)
-                full_filename = filename
+            dep_filenames = resolve_dependencies(filename, needed, runpath, rpath)
+
+        new_dep = graph.new_node(name, soname, version, full_definition, filename, runpath)
+        in_progress[full_definition] = [new_dep, 0]
+        return new_dep, full_definition, dep_filenames
+
+    root, root_definition, dep_filenames = enter(filename)
+    if dep_filenames is None:
+        return root
+
+    # frames: [node, its definition, iterator over its dependency filenames]
+    stack = [(root, root_definition, iter(dep_filenames))]
+    while stack:
+        node, full_definition, dep_iter = stack[-1]
+
+        for dep_filename in dep_iter:
+            dep_node, dep_definition, dep_filenames = enter(dep_filename)
+            if dep_filenames is None:
+                graph.attach(node, dep_node)
+            else:
+                stack.append((dep_node, dep_definition, iter(dep_filenames)))
+                break
+
+        else:
+            # all dependencies are done
+            stack.pop()
+            _, reuse_score = in_progress.pop(full_definition)
+            graph.node_done(node, full_definition, 1 + reuse_score)
+            if stack:
+                graph.attach(stack[-1][0], node)
+
+    return root
+
+def find_target(targ):
+    if isfile(targ):
+        #print("got file", targ)
+        return targ
+
+    # the $PATH lookup of `which`, in-process
+    filename = shutil.which(targ)
+    if filename is None:
+        print("usage: ./all_deps.py <cmd|filename>")
+        raise Exception(f"Could not find the binary: which {targ}")
 
-            except CalledProcessError as e:
-                print("usage: ./all_deps.py <cmd|filename>")
-                raise Exception(f"Could not find the binary: which {targ}") from e
+    return filename
 
+def targets_to_graph(targets, jobs=1, max_depth=MAX_DEPTH, compact=False):
+    '''
+    targets_to_graph(targets, jobs=1, max_depth=MAX_DEPTH, compact=False) -> (entry_graph_nodes, accumulated_nodes)
+
+    With jobs > 1 all files are read concurrently first (scan_files),
+    then the graph is built from the visits. The result is the same.
+
+    With compact=True the graph is built in a dep_node.CompactGraph,
+    and the returned nodes and accumulated_nodes are read-only views over it.
+    '''
+
+    full_filenames = [find_target(targ) for targ in targets]
+
+    visits = None
+    if jobs > 1:
+        visits = scan_files(full_filenames, jobs)
+
+    return build_graph(full_filenames, visits, max_depth, compact)
+
+def build_graph(full_filenames, visits=None, max_depth=MAX_DEPTH, compact=False):
+    '''
+    build_graph(full_filenames, visits=None, max_depth=MAX_DEPTH, compact=False) -> (entry_graph_nodes, accumulated_nodes)
+
+    The graph of targets_to_graph from the full paths of the targets,
+    and the visits of scan_files if they are given,
+    one accumulated graph shared by all targets.
+    '''
+
+    # the depths from the closest target: the cuts do not depend on the order of the targets
+    depths = min_depths(full_filenames, visits, max_depth) if max_depth is not None else None
+
+    if compact:
+        graph = CompactGraph()
+        root_ids = [traverse_into(full_filename, graph, visits, max_depth, depths) for full_filename in full_filenames]
+        graph.freeze()
+        return [graph.node(i) for i in root_ids], graph.accumulated()
+
+    entry_graph_nodes = []
+    accumulated_nodes = AccumulatedNodes()
+
+    for full_filename in full_filenames:
         parent_nodes = set()
-        dep_graph = traverse_deps(full_filename, parent_nodes, accumulated_nodes)
+        dep_graph = traverse_deps(full_filename, parent_nodes, accumulated_nodes, visits, max_depth, depths)
         entry_graph_nodes.append(dep_graph)
 
     return entry_graph_nodes, accumulated_nodes
@@ -226,7 +586,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(
             formatter_class = argparse.RawDescriptionHelpFormatter,
             description = textwrap.dedent("""
-            Traverse dependancy tree of an ELF file using `readelf -d`.
+            Traverse dependancy tree of an ELF file, reading the dynamic sections in-process (or with `readelf -d`).
             Output the full tree or aspects of it."""),
             epilog = textwrap.dedent("""
             Example:
@@ -243,20 +603,38 @@ if __name__ == "__main__":
             ls > libc.so.6
             ls > libc.so.6 > ld-linux-x86-64.so.2
             $ ./all_deps.py -g -a -n -p ls dir
+            $ ./all_deps.py -g -f dot nautilus | dot -Tsvg > nautilus.svg
+            $ ./all_deps.py --select 'libgtk*>libglib*' --select '=libc.so.6' nautilus
             """)
             )
 
     parser.add_argument("target_names", nargs='+', help="the names of the binaries to parse for dependencies, filename or a name found in $PATH")
 
     parser.add_argument("-g", "--print-graph", action='store_true', help="print graph nodes")
+    parser.add_argument("-f", "--graph-format", choices=GRAPH_FORMATS, default='paths',
+                        help="the format of --print-graph: every path from the targets (the default), "
+                             "or each node once: adjacency list, Graphviz dot, JSON Lines, indented tree")
+    parser.add_argument("--max-paths", type=int, default=100000,
+                        help="stop the `paths` graph format after N paths, 0 = no limit (default: %(default)s)")
     parser.add_argument("-a", "--all-nodes", action='store_true',
                         help="print more: print the accumulated distinct nodes and their scores")
     parser.add_argument("-p", "--print-filenames", action='store_true', help="print found filenames to save them")
     parser.add_argument("-n", "--print-dependencies", action='store_true', help="print the dependency definitions")
+    parser.add_argument("--select", action='append', default=[], metavar='SELECTOR',
+                        help="print the definitions of the nodes that match the selector: "
+                             "name globs with =version, joined by > (a child) or space (a descendant), see graph_select.py")
 
+    parser.add_argument("--snapshot", type=str, metavar='FILE', help="save the graph to a snapshot FILE for ./graph_snapshot.py queries")
     parser.add_argument("-s", "--save-to-store", type=str, help="convert the found files and save to the store dir")
     parser.add_argument("-e", "--setup-env", type=str, help="the input: env_file,env_dir,store_dir")
 
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="read the files, and convert them to the store, on N threads, parse the large batches of files on N processes (default: %(default)s)")
+    parser.add_argument("--compact", action='store_true', help="keep the graph in the compact array-backed store, for very large graphs")
+    parser.add_argument("--max-depth", type=int, default=MAX_DEPTH, help="do not follow the dependencies deeper than N (default: no limit)")
+    parser.add_argument("--elf-backend", choices=elf_dynamic.BACKENDS, default=elf_dynamic.backend,
+                        help="how to read the dynamic section of ELF files (default: %(default)s)")
+    elf_cache.add_cache_arguments(parser)
+    run_stats.add_stats_arguments(parser)
     parser.add_argument("-d", "--debug", action='store_true', help="DEBUG logging")
 
     args = parser.parse_args()
@@ -266,17 +644,22 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logging.INFO)
 
+    elf_dynamic.backend = args.elf_backend
+    elf_cache.open_cache(args.cache, args.cache_file)
+    run_stats.start(args)
+
     #acc_deps  = {}
     #dep_graph = traverse_deps(full_filename, acc_deps)
     #for ch in dep_graph.children:
     #    print(f'{ch.name} {ch.children}')
 
-    dep_graphs, acc_deps = targets_to_graph(args.target_names)
+    with run_stats.timer('phase.traverse'):
+        dep_graphs, acc_deps = targets_to_graph(args.target_names, args.jobs, args.max_depth, args.compact)
 
     if args.print_graph:
-        for dep_graph in dep_graphs:
-            for node_list in dep_graph.list_graph():
-                print(' > '.join(str(n) for n in node_list))
+        with run_stats.timer('phase.print_graph'):
+            for line in graph_lines(dep_graphs, args.graph_format, args.max_paths or None):
+                print(line)
 
     if args.all_nodes:
         for name, nodes in acc_deps.items():
@@ -293,11 +676,27 @@ if __name__ == "__main__":
                 name, version, hashes = node.full_definition
                 print(f'{name},{version},{":".join(h for h in hashes)}')
 
+    if args.select:
+        from graph_select import SelectorIndex
+
+        with run_stats.timer('phase.select'):
+            index = SelectorIndex.from_graph(dep_graphs, acc_deps)
+            for selector in args.select:
+                for node in index.select_nodes(selector):
+                    name, version, hashes = node.full_definition
+                    print(f'{name},{version},{":".join(h for h in hashes)}')
+
+    if args.snapshot:
+        from graph_snapshot import write_snapshot
+
+        with run_stats.timer('phase.snapshot'):
+            write_snapshot(args.snapshot, dep_graphs, acc_deps)
+
     if args.save_to_store:
-        from store_files import convert_to_store
+        from store_files import convert_nodes_to_store
 
         store_dir = args.save_to_store
-        for name, nodes in acc_deps.items():
-            for node, score in nodes:
-                convert_to_store(node, store_dir)
+        with run_stats.timer('phase.store'):
+            convert_nodes_to_store((node for name, nodes in acc_deps.items() for node, score in nodes),
+                                   store_dir, args.jobs)
 
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+'''
+Benchmarks of the main operations on synthetic ELF forests (see elf_forest.py),
+at several graph sizes, with the scaling curves as JSON:
+
+    traverse_deps    -- all_deps.targets_to_graph of all executables
+    list_graph       -- the paths of the graphs, up to --max-paths per executable
+    convert_to_store -- store_files.convert_nodes_to_store of all nodes
+    parse_env_file   -- an env file with the executables and a rule per library
+    find_dep         -- resolve that environment from the store
+
+The persistent ELF cache is bypassed, and the in-process memos of all_deps
+and ld_search are cleared before every size, so each size starts cold.
+
+    ./bench.py --sizes 10,40,160 -o bench.json
+'''
+
+import argparse, logging
+import textwrap
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from itertools import islice
+from os.path import join
+
+import all_deps
+import elf_cache
+import ld_search
+import store_files
+from elf_forest import generate_forest
+
+PHASES = ('traverse_deps', 'list_graph', 'convert_to_store', 'parse_env_file', 'find_dep')
+
+def reset_memos():
+    all_deps._physical_files.clear()
+    all_deps.resolver.memo.clear()
+    ld_search._dir_indexes.clear()
+
+class Timer:
+    def __init__(self):
+        self.seconds = {}
+
+    def __call__(self, phase):
+        timer = self
+        class _Phase:
+            def __enter__(self):
+                self.start = time.perf_counter()
+            def __exit__(self, *exc):
+                timer.seconds[phase] = time.perf_counter() - self.start
+        return _Phase()
+
+def write_env_file(filename, forest, store_index):
+    '''the executables, and a rule pinning the latest stored version of every library'''
+    with open(filename, 'w') as f:
+        for path in forest.executables:
+            f.write(f'{os.path.basename(path)},,\n')
+
+        rules = []
+        for soname in forest.libraries.values():
+            version = store_index.select_version(soname)
+            if version is not None:
+                rules.append(f'{soname},>={version},')
+        for path in forest.executables:
+            f.write(f'{os.path.basename(path)},, > {" ".join(rules)}\n')
+
+def run_size(size, args, workdir):
+    '''the timings for one forest size, the width of the library levels'''
+
+    root = join(workdir, f'forest-{size}')
+    store_dir = join(workdir, f'store-{size}')
+    os.makedirs(store_dir)
+    timer = Timer()
+
+    with timer('generate'):
+        forest = generate_forest(root, args.roots, size, args.depth, args.fanout, args.versions, args.cycles, args.seed)
+
+    reset_memos()
+    with timer('traverse_deps'):
+        roots, accumulated = all_deps.targets_to_graph(forest.executables, args.jobs)
+
+    with timer('list_graph'):
+        paths = sum(1 for node in roots for _ in islice(node.list_graph(), args.max_paths))
+
+    nodes = [node for defs in accumulated.values() for node, _ in defs]
+    with timer('convert_to_store'):
+        store_files.convert_nodes_to_store(nodes, store_dir, args.jobs)
+
+    index = store_files.store_index.open_index(store_dir)
+    env_file = join(workdir, f'env-{size}.txt')
+    write_env_file(env_file, forest, index)
+
+    with timer('parse_env_file'):
+        dependency_defs = store_files.parse_env_file(env_file)
+
+    with timer('find_dep'):
+        accumulated_binaries = all_deps.AccumulatedNodes()
+        for bindef in dependency_defs:
+            store_files.find_dep(bindef, store_dir, dependency_defs, set(), accumulated_binaries)
+
+    result = {
+        'size': size,
+        'files': forest.files,
+        'edges': forest.edges,
+        'nodes': len(nodes),
+        'paths': paths,
+        'env_rules': len(dependency_defs),
+        'seconds': timer.seconds,
+    }
+    logging.info(f'bench: size {size}: {forest.files} files, {len(nodes)} nodes: ' +
+                 ', '.join(f'{phase} {seconds:.3f}s' for phase, seconds in timer.seconds.items()))
+    return result
+
+def curves(results):
+    '''{phase: [[nodes, seconds], ...]} -- the scaling curves'''
+    return {phase: [[r['nodes'], r['seconds'][phase]] for r in results] for phase in PHASES}
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+            formatter_class = argparse.RawDescriptionHelpFormatter,
+            description = textwrap.dedent("""Benchmark the graph, store and environment operations on synthetic ELF forests"""),
+            epilog = textwrap.dedent("""
+            Example:
+            ./bench.py --sizes 10,40,160 -o bench.json
+            ./bench.py --sizes 100 --versions 3 --cycles 0.1 --jobs 4
+            """)
+            )
+
+    parser.add_argument("--sizes",     type=str,   default='10,40,160', help="comma-separated forest widths, libraries per level (default: %(default)s)")
+    parser.add_argument("--roots",     type=int,   default=10,  help="executables per forest (default: %(default)s)")
+    parser.add_argument("--depth",     type=int,   default=5,   help="levels of libraries (default: %(default)s)")
+    parser.add_argument("--fanout",    type=int,   default=3,   help="NEEDED entries per file (default: %(default)s)")
+    parser.add_argument("--versions",  type=int,   default=2,   help="versions of every library (default: %(default)s)")
+    parser.add_argument("--cycles",    type=float, default=0.05, help="the probability of a back edge per library (default: %(default)s)")
+    parser.add_argument("--seed",      type=int,   default=0,   help="random seed (default: %(default)s)")
+    parser.add_argument("--jobs",      type=int,   default=1,   help="threads for traverse_deps and convert_to_store (default: %(default)s)")
+    parser.add_argument("--max-paths", type=int,   default=100000, help="list_graph paths per executable (default: %(default)s)")
+    parser.add_argument("--workdir",   type=str,   default=None, help="where to write the forests and the stores (default: a temp dir, removed at the end)")
+    parser.add_argument("-o", "--output", type=str, default='-', help="the JSON report file (default: stdout)")
+    parser.add_argument("-d", "--debug", action='store_true', help="DEBUG logging")
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    elf_cache.open_cache('bypass')
+    sizes = [int(s) for s in args.sizes.split(',')]
+
+    with tempfile.TemporaryDirectory(prefix='bench-', dir=args.workdir) as workdir:
+        results = [run_size(size, args, workdir) for size in sizes]
+
+    report = {
+        'python': sys.version.split()[0],
+        'machine': platform.machine(),
+        'parameters': {k: v for k, v in vars(args).items() if k not in ('output', 'workdir', 'debug')},
+        'results': results,
+        'curves': curves(results),
+    }
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
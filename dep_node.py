@@ -2,8 +2,14 @@
 whatever is needed to handle dependency graphs
 '''
 
+from array import array
 from collections import namedtuple
+from collections.abc import Mapping
+import json
 import logging
+import sys
+
+from versions import versions_overlap
 
 
 class GraphNode:
@@ -12,11 +18,14 @@ class GraphNode:
     a modified clone of OptNode from curses_menu
     '''
 
-    def __init__(self, name, value=None, children=set(), parents=set(), logger=None):
+    __slots__ = ('name', 'value', 'children', 'parents')
+
+    def __init__(self, name, value=None, children=None, parents=None, logger=None):
         self.name = str(name) # TODO: not sure if name is always str
         self.value = value
-        self.children = children
-        self.parents  = parents
+        # no shared mutable defaults: each node gets its own sets
+        self.children = children if children is not None else set()
+        self.parents  = parents  if parents  is not None else set()
 
         # confirm that the input children and parents are sets
         for set_param in (self.children, self.parents):
@@ -57,6 +66,17 @@ class GraphNode:
             for opt in [c.list_graph(prefix_self) for c in self.children]:
                 yield from opt
 
+    def label(self):
+        return str(self)
+
+    def key(self):
+        '''identity of the node in the graph outputs'''
+        return id(self)
+
+    def as_record(self):
+        '''the fields of the node for the JSON Lines output'''
+        return {'name': self.name}
+
     def print_flat(self, delimeter='.'):
         #prefix_self = prefix + str(self)
         #print(prefix_self)
@@ -96,13 +116,10 @@ class DepDefinition(_DepDefinitionTuple):
 
     def eq_version(self, other_dep):
         '''
+        the versions match if one is empty, if they are the same string,
+        or if the ranges (see versions.py) overlap
         '''
-        # if version strings are empty - it matches any version
-        if not self.version or not other_dep.version:
-            return True
-
-        return self.version == other_dep.version
-        # TODO: support version ranges, use some module for semantic versions
+        return versions_overlap(self.version, other_dep.version)
 
     def eq_hash(self, other_dep):
         '''
@@ -116,7 +133,7 @@ class DepDefinition(_DepDefinitionTuple):
         if len(self_hashes) == 0 or len(other_hashes) == 0:
             return True
 
-        return len(self_hashes and other_hashes) != 0
+        return not self_hashes.isdisjoint(other_hashes)
 
     def no_conflict(self, other_dep):
         '''
@@ -135,7 +152,14 @@ class DepDefinition(_DepDefinitionTuple):
                self.eq_hash(other_dep)
 
 def str_to_def(string):
-    name, version, hashstrs = string.split(',')
+    '''
+    name,version,hash1:hash2
+    the version can be a range with commas: name,>=2.19,<3,
+    '''
+    fields = string.split(',')
+    if len(fields) < 3:
+        raise ValueError(f'not a definition name,version,hashes: {string!r}')
+    name, version, hashstrs = fields[0], ','.join(fields[1:-1]), fields[-1]
     if hashstrs:
         hashes = frozenset(hashstrs.split(':'))
     else:
@@ -149,7 +173,9 @@ class DepNode(GraphNode):
     TODO: try it out and see whether it makes sense.
     '''
 
-    def __init__(self, filename, soname, version, full_definition, full_path='', rpath='', needed=set(), parent_nodes=set()):
+    __slots__ = ('full_definition',)
+
+    def __init__(self, filename, soname, version, full_definition, full_path='', rpath='', needed=None, parent_nodes=None):
         assert filename == full_definition.filename
         assert isinstance(full_definition, DepDefinition)
         self.full_definition = full_definition
@@ -163,7 +189,7 @@ class DepNode(GraphNode):
 
         super().__init__(filename, value, children=needed, parents=parent_nodes)
 
-        for dep in needed:
+        for dep in self.children:
             dep.parents.add(self)
             # TODO: check, it has to add the node and resolve conflicts
             #       can the nodes overwrite each other in the set?
@@ -200,135 +226,390 @@ class DepNode(GraphNode):
     def no_conflict(self, other_dep):
         return self.full_definition.no_conflict(other_dep.full_definition)
 
-"""
-I might want to search through the graph
-although probably it just should be a separate function
+    def label(self):
+        version = self.full_definition.version
+        if not version or version == self.name:
+            return self.name
+        return f'{self.name} [{version}]'
 
-    def match_name(self, substr):
-        # TODO: just add full regexp
-        match_last = False
-        if substr[-1] == '$':
-            substr = substr[:-1]
-            match_last = True
+    def as_record(self):
+        name, version, hashes = self.full_definition
+        return {'name': name,
+                'version': version,
+                'hashes': sorted(hashes),
+                'soname': self.value['soname'],
+                'full_path': self.value['full_path']}
 
-        if substr not in self.name:
-            return False
+# one shared empty hash set, an empty frozenset() is a new 216 bytes object
+NO_HASHES = frozenset()
 
-        match_ind = self.name.index(substr)
+class NodeRecord:
+    '''
+    the data of a node in CompactGraph,
+    the full path is stored as the interned directory prefix + the name,
+    the strings shared by many nodes are interned
+    '''
+    __slots__ = ('name', 'version', 'hashes', 'soname', 'rpath', 'path_prefix')
+
+    def __init__(self, name, version, hashes, soname, rpath, full_path):
+        assert not full_path or full_path.endswith(name), (name, full_path)
+        self.name    = name
+        self.version = version
+        self.hashes  = hashes or NO_HASHES
+        self.soname  = sys.intern(soname)
+        self.rpath   = tuple(sys.intern(p) for p in rpath)
+        self.path_prefix = sys.intern(full_path[:len(full_path) - len(name)]) if full_path else None
+
+    @property
+    def full_path(self):
+        if self.path_prefix is None:
+            return ''
+        return self.path_prefix + self.name
+
+    def definition(self):
+        return DepDefinition(self.name, self.version, self.hashes)
+
+class CompactGraph:
+    '''
+    A compact store for large dependency graphs.
 
-        if substr in self.name and match_last and self.name[match_ind:] != substr:
-            return False
+    The nodes are integer ids, interned by their definition
+    (by_name maps a name to its id, or a list of ids for several versions),
+    their data is in NodeRecord-s with __slots__.
+    The edges are appended to two array('i') while the graph is built,
+    and freeze() turns them into CSR-style forward and reverse adjacency:
 
-        self.highlight_name(match_ind, match_ind+len(substr))
-        return True
+        children of node i = fwd_targets[fwd_offsets[i]:fwd_offsets[i+1]]
+        parents  of node i = rev_targets[rev_offsets[i]:rev_offsets[i+1]]
 
-    def match_selector(self, selector):
-        '''match_selector(self, selector)
+    The children keep the order they were attached in.
+    DepNodeView gives the DepNode interface over a node,
+    accumulated() -- the accumulated_dependencies interface.
 
-        Returns True or False. Matches the basic selectors:
-        = for value
-        . for basic type
-        the rest is name match
-        '''
-        assert len(selector) > 0
-        if selector[0] in ('=', '.'):
-            assert len(selector) > 1
+    It implements the graph builder interface of all_deps.traverse_deps:
+    reuse_node, new_node, attach, node_done.
+    '''
 
-        if selector[0] == '=' and selector[1:] == str(self.value):
-            self.highlight_value(True)
-            return True
+    def __init__(self):
+        self.records = []
+        self.scores = array('i')
+        self.by_name = {}              # {name: node id or [node id, ...]}
+        self.done_order = array('i')   # the order the nodes were done, as in accumulated_dependencies
+
+        self._edge_src = array('i')
+        self._edge_dst = array('i')
+        self.fwd_offsets = self.fwd_targets = None
+        self.rev_offsets = self.rev_targets = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def name_ids(self, name):
+        ids = self.by_name.get(name, ())
+        return (ids,) if isinstance(ids, int) else ids
+
+    def find(self, full_definition):
+        '''the id of the node with exactly this definition, or None'''
+        for node_id in self.name_ids(full_definition.filename):
+            record = self.records[node_id]
+            if record.version == full_definition.version and record.hashes == full_definition.hashes:
+                return node_id
+        return None
+
+    def add_node(self, name, version, hashes=frozenset(), soname='', rpath=(), full_path=''):
+        node_id = self.find(DepDefinition(name, version, hashes))
+        if node_id is not None:
+            return node_id
+
+        node_id = len(self.records)
+        self.records.append(NodeRecord(name, version, hashes, soname, rpath, full_path))
+        self.scores.append(0)
+
+        ids = self.by_name.get(name)
+        if ids is None:
+            self.by_name[name] = node_id
+        elif isinstance(ids, int):
+            self.by_name[name] = [ids, node_id]
+        else:
+            ids.append(node_id)
 
-        if selector[0] == '.':
-            type_matched = False
-            type_matched |= selector[1:] == 'int' and type(self.value) == int
-            type_matched |= selector[1:] == 'float' and type(self.value) == float
-            type_matched |= selector[1:] == 'str' and type(self.value) == str
-            return type_matched
+        return node_id
 
-        return self.match_name(selector)
+    def add_edge(self, src, dst):
+        if self.fwd_offsets is not None:
+            raise Exception('CompactGraph: cannot add edges to a frozen graph')
+        self._edge_src.append(src)
+        self._edge_dst.append(dst)
 
-    def match_selectors(self, selectors, prev_nodes=[]):
-        '''match_selectors(self, selectors, prev_nodes=[]):
+    @staticmethod
+    def _csr(n_nodes, src, dst):
+        # a stable counting sort of the edges by src
+        offsets = array('i', bytes(4 * (n_nodes + 1)))
+        for s in src:
+            offsets[s + 1] += 1
+        for i in range(n_nodes):
+            offsets[i + 1] += offsets[i]
 
-        In general, matching returns an option list from the tree of GraphNode-s.
-        Therefore `match_selector` returns True or False whether this node
-        matched the selector, and sets the highlights in self node, and in the
-        child nodes if needed.
+        targets = array('i', bytes(4 * len(dst)))
+        fill = array('i', offsets[:-1])
+        for s, d in zip(src, dst):
+            targets[fill[s]] = d
+            fill[s] += 1
 
-        Special selectors:
-        = for value
-        . for basic types of value
-        > prefix to match child nodes, including [.=]
-        '''
+        return offsets, targets
 
-        # test and clean up the selectors here
-        checked_selectors = []
-        for sel in selectors:
-            assert len(sel) > 0
+    def freeze(self):
+        n_nodes = len(self.records)
+        self.fwd_offsets, self.fwd_targets = self._csr(n_nodes, self._edge_src, self._edge_dst)
+        self.rev_offsets, self.rev_targets = self._csr(n_nodes, self._edge_dst, self._edge_src)
+        self._edge_src = self._edge_dst = None
 
-            if all(ch in ('>', '=', '.') for ch in sel):
-                if logger is not None: # TODO: add a default logger
-                    logger.warning(f'got an empty special selector: {sel}')
-                continue
+    def children_ids(self, node_id):
+        return self.fwd_targets[self.fwd_offsets[node_id]:self.fwd_offsets[node_id + 1]]
 
-            checked_selectors.append(sel)
+    def parents_ids(self, node_id):
+        return self.rev_targets[self.rev_offsets[node_id]:self.rev_offsets[node_id + 1]]
 
-        # run the recursive matching
-        if len(checked_selectors) == 0:
-            # done
-            for opt in self.list_graph():
-                yield prev_nodes + opt
+    def node(self, node_id):
+        return DepNodeView(self, node_id)
 
-        else:
-            yield from self._match_selectors(checked_selectors, prev_nodes)
-
-    def _match_selectors(self, selectors, prev_nodes=[]):
-        assert len(selectors) > 0
-        #if len(selectors) == 0:
-        #    # the all selectors got mathed
-        #    for opt in self.list_graph():
-        #        #yield prev_nodes + opt
-        #        return prev_nodes + opt
-
-        sel = selectors[0]
-        assert len(sel) > 0
-
-        ## skip empty special selectors
-        ##if sel[0] in ('>', '=', '.') and len(sel) == 1:
-        #if all(ch in ('>', '=', '.') for ch in sel):
-        #    if logger is not None: # TODO: add a default logger
-        #        logger.warning(f'got an empty special selector: {sel}')
-        #    selectors = selectors[1:]
-        #    sel = selectors[0]
-        #    #self.match_selectors(selectors[1:], prev_nodes)
-
-        matched = False
-        matched_self = False
-        if sel[0] == '>':
-            # children names
-            cnode_selector = sel[1:]
-
-            for c in self.children:
-                #yield from c.match_selectors([sel[0][1:]] + selectors[1:], prev_nodes + [self])
-                matched |= c.match_selector(cnode_selector)
+    def accumulated(self):
+        return AccumulatedView(self)
 
-        else:
-            matched = matched_self = self.match_selector(sel)
+    # the graph builder interface of all_deps.traverse_deps
+
+    def reuse_node(self, full_definition):
+        node_id = self.find(full_definition)
+        if node_id is not None:
+            self.scores[node_id] += 1
+        return node_id
+
+    def new_node(self, name, soname, version, full_definition, full_path, rpath):
+        return self.add_node(name, version, full_definition.hashes, soname, rpath, full_path)
+
+    def attach(self, node_id, dep_node_id):
+        self.add_edge(node_id, dep_node_id)
+
+    def node_done(self, node_id, full_definition, score):
+        self.scores[node_id] += score
+        self.done_order.append(node_id)
+
+class DepNodeView(DepNode):
+    '''
+    A thin DepNode over a node of CompactGraph.
+    The views are made on access, the children and parents are new views.
+    '''
+
+    __slots__ = ('graph', 'node_id')
+
+    def __init__(self, graph, node_id):
+        self.graph = graph
+        self.node_id = node_id
+
+    @property
+    def record(self):
+        return self.graph.records[self.node_id]
+
+    @property
+    def name(self):
+        return self.record.name
+
+    @property
+    def full_definition(self):
+        return self.record.definition()
+
+    @property
+    def value(self):
+        record = self.record
+        return {'full_definition': self.full_definition,
+                'soname': record.soname,
+                'version': record.version,
+                'rpath': list(record.rpath),
+                'full_path': record.full_path}
 
-        next_selectors = selectors[1:] if matched else selectors
-        if len(next_selectors) == 0:
-            # done
-            for opt in self.list_graph():
-                yield prev_nodes + opt
+    @property
+    def children(self):
+        return {self.graph.node(i) for i in self.graph.children_ids(self.node_id)}
 
-        elif matched and not matched_self:
-            # matched something in child nodes
-            # the matching process stays at this node
-            yield from self._match_selectors(next_selectors, prev_nodes)
+    @property
+    def parents(self):
+        return {self.graph.node(i) for i in self.graph.parents_ids(self.node_id)}
 
+    def __hash__(self):
+        return hash((self.name, self.full_definition))
+
+    def __repr__(self):
+        return f'DepNodeView({self.node_id}, {self.full_definition})'
+
+    def key(self):
+        return (id(self.graph), self.node_id)
+
+class AccumulatedView(Mapping):
+    '''
+    read-only accumulated_dependencies of a CompactGraph:
+    {'filename': [[DepNodeView, score], ...]}, made on access,
+    in the order the nodes were done, like in the DepNode traversal
+    '''
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.names = {}
+        for node_id in graph.done_order:
+            self.names.setdefault(graph.records[node_id].name, []).append(node_id)
+
+    def __getitem__(self, name):
+        return [[self.graph.node(i), self.graph.scores[i]] for i in self.names[name]]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+#
+# Graph outputs that visit each node and edge once, O(V+E),
+# unlike GraphNode.list_graph that lists every path from the root.
+# They are generators of lines, to stream large graphs.
+# The children are sorted by label, to get a stable output.
+
+GRAPH_FORMATS = ('paths', 'adjacency', 'dot', 'jsonl', 'tree')
+
+def number_nodes(roots, accumulated):
+    '''
+    number_nodes(roots, accumulated) -> (nodes, scores, children, root_ids)
+
+    Give the nodes integer ids: the nodes of accumulated_dependencies in its order,
+    then the roots, then the nodes reachable but not accumulated (the --max-depth cuts).
+    children[i] are the ids of the children of nodes[i], sorted.
+    '''
+
+    ids = {}
+    nodes = []
+    scores = []
+
+    def add(node, score):
+        node_id = ids.get(node.key())
+        if node_id is None:
+            node_id = ids[node.key()] = len(nodes)
+            nodes.append(node)
+            scores.append(score)
+        return node_id
+
+    for name, defs in accumulated.items():
+        for node, score in defs:
+            add(node, score)
+    root_ids = [add(root, 0) for root in roots]
+
+    children = []
+    while len(children) < len(nodes):
+        # the unknown children get the next ids
+        children.append(sorted(add(child, 0) for child in nodes[len(children)].children))
+
+    return nodes, scores, children, root_ids
+
+def sorted_children(node):
+    return sorted(node.children, key=lambda c: c.label())
+
+def walk_graph(roots):
+    '''
+    walk_graph(roots)
+
+    Yield every node reachable from the roots once, depth-first pre-order.
+    '''
+
+    seen = set()
+    stack = list(reversed(roots))
+    while stack:
+        node = stack.pop()
+        if node.key() in seen:
+            continue
+        seen.add(node.key())
+        yield node
+        stack.extend(reversed(sorted_children(node)))
+
+def adjacency_lines(roots):
+    '''node > child child ...'''
+    for node in walk_graph(roots):
+        children = sorted_children(node)
+        if children:
+            yield f'{node.label()} > {" ".join(c.label() for c in children)}'
         else:
-            for c in self.children:
-                yield from c._match_selectors(next_selectors, prev_nodes + [self])
-"""
+            yield node.label()
+
+def _dot_quote(string):
+    return '"' + string.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def dot_lines(roots, graph_name='deps'):
+    '''Graphviz DOT'''
+    ids = {}
+    def node_id(node):
+        return ids.setdefault(node.key(), f'n{len(ids)}')
+
+    yield f'digraph {graph_name} {{'
+    for node in walk_graph(roots):
+        yield f'  {node_id(node)} [label={_dot_quote(node.label())}];'
+        for c in sorted_children(node):
+            yield f'  {node_id(node)} -> {node_id(c)};'
+    yield '}'
+
+def jsonl_lines(roots):
+    '''one JSON object per node, the children are referred to by "id"'''
+    ids = {}
+    def node_id(node):
+        return ids.setdefault(node.key(), len(ids))
+
+    root_ids = {r.key() for r in roots}
+    for node in walk_graph(roots):
+        record = {'id': node_id(node)}
+        record.update(node.as_record())
+        record['root'] = node.key() in root_ids
+        record['children'] = [node_id(c) for c in sorted_children(node)]
+        yield json.dumps(record)
+
+def tree_lines(roots, indent='  '):
+    '''
+    an indented tree, each subtree is printed once,
+    the later references to it are marked with ` ^` (see above)
+    '''
+
+    printed = set()
+    for root in roots:
+        stack = [(root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if node.key() in printed:
+                yield f'{indent * depth}{node.label()} ^'
+                continue
+
+            printed.add(node.key())
+            yield f'{indent * depth}{node.label()}'
+            stack.extend((c, depth + 1) for c in reversed(sorted_children(node)))
 
+def path_lines(roots, max_paths=None):
+    '''
+    the legacy output: every path from the roots, as `a > b > c`,
+    it stops after max_paths paths (None = no limit)
+    '''
 
+    count = 0
+    for root in roots:
+        for node_list in root.list_graph():
+            if max_paths is not None and count >= max_paths:
+                logging.warning(f'stopped after {max_paths} paths, the graph has more: try another graph format')
+                return
+            count += 1
+            yield ' > '.join(str(n) for n in node_list)
+
+def graph_lines(roots, graph_format='paths', max_paths=None):
+    if graph_format == 'paths':
+        return path_lines(roots, max_paths)
+    elif graph_format == 'adjacency':
+        return adjacency_lines(roots)
+    elif graph_format == 'dot':
+        return dot_lines(roots)
+    elif graph_format == 'jsonl':
+        return jsonl_lines(roots)
+    elif graph_format == 'tree':
+        return tree_lines(roots)
+
+    raise ValueError(f'unknown graph format: {graph_format}')
@@ -0,0 +1,234 @@
+'''
+Persistent on-disk cache of the ELF dynamic sections.
+
+The entries are keyed on the stat signature of the real file:
+
+    (st_dev, st_ino, st_size, st_mtime_ns)
+
+so a library that was rebuilt, replaced or touched gets a new key
+and is read again. The cache is a JSON file, by default in
+
+    $XDG_CACHE_HOME/binary-packaging/elf_dynamic.json
+
+It is loaded once, and saved atomically (write a temp file, rename over)
+at the end of the run if anything changed.
+
+Modes:
+
+    use     -- read and update the cache
+    bypass  -- do not read or write the cache
+    rebuild -- ignore the existing entries, write a fresh cache
+'''
+
+import atexit
+import json
+import logging
+import os
+import threading
+from os.path import dirname, expanduser, join
+
+import elf_dynamic
+import run_stats
+from elf_dynamic import ElfDynamic
+
+CACHE_MODES = ('use', 'bypass', 'rebuild')
+CACHE_FORMAT = 1
+
+active_cache = None
+
+def default_cache_file():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or expanduser('~/.cache')
+    return join(cache_home, 'binary-packaging', 'elf_dynamic.json')
+
+def stat_signature(st):
+    return f'{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}'
+
+class ElfCache:
+    def __init__(self, filename, rebuild=False):
+        self.filename = filename
+        # {signature: [path, needed, runpath, rpath, soname, interp]}
+        self.entries = {}
+        self.used = set()
+        self.dirty = rebuild
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if not rebuild:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+
+        except FileNotFoundError:
+            return
+
+        except (OSError, ValueError) as e:
+            logging.warning(f'ElfCache: cannot load {self.filename}, starting empty: {e}')
+            return
+
+        if data.get('format') != CACHE_FORMAT:
+            logging.info(f'ElfCache: {self.filename} has a different format, starting empty')
+            return
+
+        self.entries = data['entries']
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        # drop the entries that were not used in this run
+        # and do not match their file anymore
+        with self.lock:
+            for signature in list(self.entries.keys() - self.used):
+                path = self.entries[signature][0]
+                try:
+                    if stat_signature(os.stat(path)) == signature:
+                        continue
+                except OSError:
+                    pass
+                del self.entries[signature]
+
+            data = {'format': CACHE_FORMAT, 'entries': self.entries}
+
+        os.makedirs(dirname(self.filename) or '.', exist_ok=True)
+        tempname = f'{self.filename}.{os.getpid()}.tmp'
+        try:
+            with open(tempname, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tempname, self.filename)
+
+        except OSError as e:
+            logging.warning(f'ElfCache: cannot save {self.filename}: {e}')
+            if os.path.exists(tempname):
+                os.unlink(tempname)
+            return
+
+        self.dirty = False
+        logging.debug(f'ElfCache: saved {len(self.entries)} entries to {self.filename}, {self.hits} hits, {self.misses} misses')
+
+    def read_elf_dynamic(self, elf_filename):
+        '''
+        read_elf_dynamic(elf_filename) -> ElfDynamic
+
+        Return the cached record if the real file did not change,
+        otherwise read it and cache it.
+        '''
+
+        signature = stat_signature(os.stat(elf_filename))
+        run_stats.count('elf_cache.calls')
+
+        entry = self.entries.get(signature)
+        if entry is not None:
+            self.hits += 1
+            run_stats.count('elf_cache.hits')
+            self.used.add(signature)
+            _, needed, runpath, rpath, soname, interp = entry
+            return ElfDynamic(tuple(needed), runpath, rpath, soname, interp)
+
+        self.misses += 1
+        dynamic = elf_dynamic.read_elf_dynamic(elf_filename)
+
+        with self.lock:
+            self.entries[signature] = [elf_filename, list(dynamic.needed),
+                    dynamic.runpath, dynamic.rpath, dynamic.soname, dynamic.interp]
+            self.used.add(signature)
+            self.dirty = True
+
+        return dynamic
+
+    def read_many(self, elf_filenames, jobs=1):
+        '''
+        read_many(elf_filenames, jobs=1) -> [ElfDynamic or exception, ...]
+
+        The cached records, and the misses read in one elf_dynamic.read_many batch.
+        '''
+
+        results = []
+        misses = []
+        for elf_filename in elf_filenames:
+            try:
+                signature = stat_signature(os.stat(elf_filename))
+            except OSError as e:
+                results.append(e)
+                continue
+
+            run_stats.count('elf_cache.calls')
+            entry = self.entries.get(signature)
+            if entry is not None:
+                self.hits += 1
+                run_stats.count('elf_cache.hits')
+                self.used.add(signature)
+                _, needed, runpath, rpath, soname, interp = entry
+                results.append(ElfDynamic(tuple(needed), runpath, rpath, soname, interp))
+            else:
+                self.misses += 1
+                misses.append((len(results), elf_filename, signature))
+                results.append(None)
+
+        dynamics = elf_dynamic.read_many([elf_filename for _, elf_filename, _ in misses], jobs)
+        with self.lock:
+            for (i, elf_filename, signature), dynamic in zip(misses, dynamics):
+                results[i] = dynamic
+                if isinstance(dynamic, ElfDynamic):
+                    self.entries[signature] = [elf_filename, list(dynamic.needed),
+                            dynamic.runpath, dynamic.rpath, dynamic.soname, dynamic.interp]
+                    self.used.add(signature)
+                    self.dirty = True
+
+        return results
+
+def open_cache(mode='use', filename=None):
+    '''
+    open_cache(mode='use', filename=None)
+
+    Set up the active cache for read_elf_dynamic.
+    The cache is saved when the program exits.
+    '''
+
+    global active_cache
+    assert mode in CACHE_MODES, mode
+
+    if mode == 'bypass':
+        active_cache = None
+        return None
+
+    active_cache = ElfCache(filename or default_cache_file(), rebuild=(mode == 'rebuild'))
+    atexit.register(active_cache.save)
+    return active_cache
+
+def read_elf_dynamic(elf_filename):
+    '''
+    read_elf_dynamic(elf_filename) -> ElfDynamic
+
+    Through the active cache, if there is one.
+    '''
+
+    if active_cache is not None:
+        return active_cache.read_elf_dynamic(elf_filename)
+
+    return elf_dynamic.read_elf_dynamic(elf_filename)
+
+def read_many(elf_filenames, jobs=1):
+    '''
+    read_many(elf_filenames, jobs=1) -> [ElfDynamic or exception, ...]
+
+    A batch of read_elf_dynamic, see elf_dynamic.read_many.
+    '''
+
+    if active_cache is not None:
+        return active_cache.read_many(elf_filenames, jobs)
+
+    return elf_dynamic.read_many(elf_filenames, jobs)
+
+def add_cache_arguments(parser):
+    '''
+    the command line options shared by all_deps.py and store_files.py
+    '''
+
+    parser.add_argument("--cache", choices=CACHE_MODES, default='use',
+                        help="the persistent cache of ELF dynamic sections: use it, bypass it, or rebuild it (default: %(default)s)")
+    parser.add_argument("--cache-file", type=str, default=None,
+                        help=f"the cache file (default: {default_cache_file()})")
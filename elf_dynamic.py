@@ -0,0 +1,365 @@
+'''
+In-process reader of the dynamic section of ELF files.
+
+It replaces the `readelf -d` subprocess for the dependency traversal:
+the file is mmap-ed, the program headers are walked to PT_DYNAMIC
+and PT_INTERP, and the strings are read from the dynamic string table
+(DT_STRTAB, i.e. .dynstr) directly.
+
+Supports ELF32 and ELF64, little- and big-endian.
+`readelf` stays as a fallback backend:
+
+    backend = 'python'  -- the in-process reader, fall back to readelf on ElfFormatError
+    backend = 'readelf' -- always run `readelf -d -l`
+'''
+
+import logging
+import mmap
+import multiprocessing
+import struct
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from subprocess import CalledProcessError
+
+import run_stats
+from tool_runner import run_tool, run_many
+
+ELF_MAGIC = b'\x7fELF'
+
+ELFCLASS32, ELFCLASS64 = 1, 2
+ELFDATA2LSB, ELFDATA2MSB = 1, 2
+
+PT_LOAD, PT_DYNAMIC, PT_INTERP = 1, 2, 3
+SHT_DYNAMIC = 6
+
+DT_NULL    = 0
+DT_NEEDED  = 1
+DT_STRTAB  = 5
+DT_STRSZ   = 10
+DT_SONAME  = 14
+DT_RPATH   = 15
+DT_RUNPATH = 29
+
+BACKENDS = ('python', 'readelf')
+backend = 'python'
+
+# the parsing is CPU-bound under the GIL: with jobs > 1
+# the batches of at least PROCESS_BATCH files are parsed on processes,
+# the smaller ones do not pay back the start of the pool (~0.2 s)
+PROCESS_BATCH = 2048
+
+ElfDynamic = namedtuple('ElfDynamic', 'needed runpath rpath soname interp')
+# needed is a tuple of strings,
+# runpath and rpath are the raw strings, with $ORIGIN not expanded,
+# interp is the PT_INTERP string or ''
+
+class ElfFormatError(Exception):
+    pass
+
+# struct layouts per (class, data):
+# the ELF header after e_ident, the program header, the section header, the dynamic entry
+_LAYOUTS = {}
+for _cls, _ehdr, _phdr, _shdr, _dyn in (
+        (ELFCLASS32, 'HHIIIIIHHHHHH', 'IIIIIIII', 'IIIIIIIIII', 'iI'),
+        (ELFCLASS64, 'HHIQQQIHHHHHH', 'IIQQQQQQ', 'IIQQQQIIQQ', 'qQ')):
+    for _data, _order in ((ELFDATA2LSB, '<'), (ELFDATA2MSB, '>')):
+        _LAYOUTS[(_cls, _data)] = tuple(struct.Struct(_order + fmt) for fmt in (_ehdr, _phdr, _shdr, _dyn))
+
+def _phdr_fields(elf_class, phdr):
+    '''(p_type, p_offset, p_vaddr, p_filesz) -- the field order differs in ELF32 and ELF64'''
+    if elf_class == ELFCLASS64:
+        p_type, _, p_offset, p_vaddr, _, p_filesz, _, _ = phdr
+    else:
+        p_type, p_offset, p_vaddr, _, p_filesz, _, _, _ = phdr
+    return p_type, p_offset, p_vaddr, p_filesz
+
+def _cstring(buf, offset, limit=None):
+    end = buf.find(b'\0', offset, limit if limit is not None else len(buf))
+    if end < 0:
+        raise ElfFormatError(f'unterminated string at offset {offset}')
+    return buf[offset:end].decode(errors='surrogateescape')
+
+def parse_dynamic(buf):
+    '''
+    parse_dynamic(buf) -> ElfDynamic
+
+    Parse an ELF image in a bytes-like object: bytes, mmap, memoryview.
+    Raises ElfFormatError if it is not a well-formed ELF file.
+    '''
+
+    if len(buf) < 16 or buf[:4] != ELF_MAGIC:
+        raise ElfFormatError('not an ELF file')
+
+    elf_class, elf_data = buf[4], buf[5]
+    if (elf_class, elf_data) not in _LAYOUTS:
+        raise ElfFormatError(f'unsupported ELF class/data: {elf_class}/{elf_data}')
+    ehdr_st, phdr_st, shdr_st, dyn_st = _LAYOUTS[(elf_class, elf_data)]
+
+    if len(buf) < 16 + ehdr_st.size:
+        raise ElfFormatError('truncated ELF header')
+    (_, _, _, _, e_phoff, e_shoff, _, _,
+     e_phentsize, e_phnum, e_shentsize, e_shnum, _) = ehdr_st.unpack_from(buf, 16)
+
+    if e_phnum and (e_phentsize < phdr_st.size or e_phoff + e_phnum * e_phentsize > len(buf)):
+        raise ElfFormatError('program headers out of the file')
+
+    loads = []
+    dynamic = None
+    interp = ''
+    for i in range(e_phnum):
+        p_type, p_offset, p_vaddr, p_filesz = _phdr_fields(elf_class, phdr_st.unpack_from(buf, e_phoff + i * e_phentsize))
+        if p_offset + p_filesz > len(buf):
+            raise ElfFormatError(f'segment {i} is out of the file')
+
+        if p_type == PT_LOAD:
+            loads.append((p_vaddr, p_offset, p_filesz))
+        elif p_type == PT_DYNAMIC:
+            dynamic = (p_offset, p_filesz)
+        elif p_type == PT_INTERP:
+            interp = _cstring(buf, p_offset, p_offset + p_filesz)
+
+    # the string table linked to the dynamic section
+    # in case DT_STRTAB does not fall in a loaded segment
+    dynstr_section = None
+    if dynamic is None or not loads:
+        dynamic_section, dynstr_section = _dynamic_from_sections(buf, e_shoff, e_shnum, e_shentsize, shdr_st, elf_class)
+        if dynamic is None:
+            dynamic = dynamic_section
+
+    if dynamic is None:
+        # a static binary
+        return ElfDynamic((), '', '', '', interp)
+
+    # collect the tags, the strings are resolved after DT_STRTAB is known
+    strtab_addr, strsz = None, None
+    needed_offsets = []
+    soname_off = runpath_off = rpath_off = None
+
+    dyn_offset, dyn_size = dynamic
+    for entry_offset in range(dyn_offset, dyn_offset + dyn_size - dyn_st.size + 1, dyn_st.size):
+        d_tag, d_val = dyn_st.unpack_from(buf, entry_offset)
+        if d_tag == DT_NULL:
+            break
+        elif d_tag == DT_NEEDED:
+            needed_offsets.append(d_val)
+        elif d_tag == DT_STRTAB:
+            strtab_addr = d_val
+        elif d_tag == DT_STRSZ:
+            strsz = d_val
+        elif d_tag == DT_SONAME:
+            soname_off = d_val
+        elif d_tag == DT_RUNPATH:
+            runpath_off = d_val
+        elif d_tag == DT_RPATH:
+            rpath_off = d_val
+
+    if strtab_addr is None:
+        if needed_offsets or soname_off is not None or runpath_off is not None or rpath_off is not None:
+            raise ElfFormatError('no DT_STRTAB in the dynamic section')
+        return ElfDynamic((), '', '', '', interp)
+
+    strtab = _vaddr_to_offset(strtab_addr, loads)
+    if strtab is None:
+        if dynstr_section is None:
+            _, dynstr_section = _dynamic_from_sections(buf, e_shoff, e_shnum, e_shentsize, shdr_st, elf_class)
+        if dynstr_section is None:
+            raise ElfFormatError(f'DT_STRTAB {strtab_addr:#x} is not in a loaded segment')
+        strtab = dynstr_section[0]
+        if strsz is None:
+            strsz = dynstr_section[1]
+
+    strtab_end = strtab + strsz if strsz is not None else len(buf)
+    if strtab_end > len(buf):
+        raise ElfFormatError('string table is out of the file')
+
+    def string(off):
+        if off is None:
+            return ''
+        if strtab + off >= strtab_end:
+            raise ElfFormatError(f'string offset {off} is out of the string table')
+        return _cstring(buf, strtab + off, strtab_end)
+
+    return ElfDynamic(tuple(string(off) for off in needed_offsets),
+                      string(runpath_off), string(rpath_off),
+                      string(soname_off), interp)
+
+def _vaddr_to_offset(vaddr, loads):
+    for p_vaddr, p_offset, p_filesz in loads:
+        if p_vaddr <= vaddr < p_vaddr + p_filesz:
+            return vaddr - p_vaddr + p_offset
+    return None
+
+def _dynamic_from_sections(buf, e_shoff, e_shnum, e_shentsize, shdr_st, elf_class):
+    '''
+    find the SHT_DYNAMIC section and the string table it links to,
+    return ((offset, size) or None, (offset, size) or None)
+    '''
+
+    if not e_shoff or not e_shnum or e_shentsize < shdr_st.size or e_shoff + e_shnum * e_shentsize > len(buf):
+        return None, None
+
+    def section(i):
+        sh = shdr_st.unpack_from(buf, e_shoff + i * e_shentsize)
+        # sh_type, sh_offset, sh_size, sh_link
+        return sh[1], sh[4], sh[5], sh[6]
+
+    for i in range(e_shnum):
+        sh_type, sh_offset, sh_size, sh_link = section(i)
+        if sh_type == SHT_DYNAMIC:
+            dynstr = None
+            if sh_link < e_shnum:
+                _, str_offset, str_size, _ = section(sh_link)
+                dynstr = (str_offset, str_size)
+            return (sh_offset, sh_size), dynstr
+
+    return None, None
+
+def read_elf_dynamic_python(elf_filename):
+    with open(elf_filename, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as e:
+            # mmap of an empty file
+            raise ElfFormatError(f'cannot mmap {elf_filename}') from e
+
+    try:
+        return parse_dynamic(buf)
+    except struct.error as e:
+        raise ElfFormatError(f'truncated ELF file {elf_filename}') from e
+    finally:
+        buf.close()
+
+def readelf_argv(elf_filename):
+    return ['readelf', '-d', '-l', '-W', elf_filename]
+
+def parse_readelf(output):
+    '''
+    parse_readelf(output) -> ElfDynamic
+
+    The stdout bytes of `readelf -d -l -W`.
+    '''
+
+    # format:
+    #  0x000000000000001d (RUNPATH)            Library runpath: [$ORIGIN/:$ORIGIN/hello_dependencies/]
+    #  0x0000000000000001 (NEEDED)             Shared library: [libc.so.6]
+    #  0x000000000000000e (SONAME)             Library soname: [ld-linux-x86-64.so.2]
+    #      [Requesting program interpreter: /lib64/ld-linux-x86-64.so.2]
+    def bracketed(line):
+        return line.split('[', 1)[1].rsplit(']', 1)[0]
+
+    needed = []
+    runpath = rpath = soname = interp = ''
+    for line in output.decode(errors='surrogateescape').split('\n'):
+        if '(NEEDED)' in line:
+            needed.append(bracketed(line))
+        elif '(SONAME)' in line:
+            soname = bracketed(line)
+        elif '(RUNPATH)' in line:
+            runpath = bracketed(line)
+        elif '(RPATH)' in line:
+            rpath = bracketed(line)
+        elif 'Requesting program interpreter:' in line:
+            interp = bracketed(line).split(':', 1)[1].strip()
+
+    return ElfDynamic(tuple(needed), runpath, rpath, soname, interp)
+
+def read_elf_dynamic_readelf(elf_filename):
+    try:
+        output = run_tool(readelf_argv(elf_filename))
+    except (CalledProcessError, OSError) as e:
+        raise Exception(f'failed to readelf -d {elf_filename}') from e
+
+    return parse_readelf(output)
+
+def read_many_readelf(elf_filenames):
+    '''
+    read_many_readelf(elf_filenames) -> [ElfDynamic or exception, ...]
+
+    readelf on all the files at once, see tool_runner.run_many.
+    '''
+
+    results = []
+    outputs = run_many([readelf_argv(elf_filename) for elf_filename in elf_filenames], return_exceptions=True)
+    for elf_filename, output in zip(elf_filenames, outputs):
+        if isinstance(output, (CalledProcessError, OSError)):
+            error = Exception(f'failed to readelf -d {elf_filename}')
+            error.__cause__ = output
+            results.append(error)
+        elif isinstance(output, BaseException):
+            raise output
+        else:
+            results.append(parse_readelf(output))
+
+    return results
+
+def read_elf_dynamic(elf_filename):
+    '''
+    read_elf_dynamic(elf_filename) -> ElfDynamic
+
+    Read with the module's `backend`.
+    The python backend falls back to readelf on files it cannot parse.
+    '''
+
+    if backend == 'readelf':
+        return read_elf_dynamic_readelf(elf_filename)
+
+    try:
+        run_stats.count('elf_dynamic.python_reads')
+        return read_elf_dynamic_python(elf_filename)
+
+    except ElfFormatError as e:
+        logging.debug(f'read_elf_dynamic: {e}, falling back to readelf')
+        return read_elf_dynamic_readelf(elf_filename)
+
+def _read_python(elf_filename):
+    try:
+        return read_elf_dynamic_python(elf_filename)
+    except (ElfFormatError, OSError) as e:
+        return e
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def _processes(jobs):
+    '''
+    the process pool of read_many, started once with <jobs> workers,
+    by a fork server: the callers run threads, a plain fork would copy their locks
+    '''
+
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('forkserver'))
+        return _process_pool
+
+def read_many(elf_filenames, jobs=1):
+    '''
+    read_many(elf_filenames, jobs=1) -> [ElfDynamic or exception, ...]
+
+    read_elf_dynamic of a batch of files, the failures are returned in place.
+    The python backend reads on <jobs> threads, or on <jobs> processes
+    if the batch has PROCESS_BATCH files or more. The files it cannot parse
+    go to readelf in one run_many batch, as all the files of the readelf backend.
+    '''
+
+    elf_filenames = list(elf_filenames)
+    if backend == 'readelf':
+        return read_many_readelf(elf_filenames)
+
+    run_stats.count('elf_dynamic.python_reads', len(elf_filenames))
+    if jobs > 1 and len(elf_filenames) >= PROCESS_BATCH:
+        chunksize = -(-len(elf_filenames) // (4 * jobs))
+        with run_stats.timer('elf_dynamic.processes'):
+            results = list(_processes(jobs).map(_read_python, elf_filenames, chunksize=chunksize))
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(_read_python, elf_filenames))
+
+    fallback = [i for i, result in enumerate(results) if isinstance(result, ElfFormatError)]
+    for i in fallback:
+        logging.debug(f'read_many: {results[i]}, falling back to readelf')
+    for i, result in zip(fallback, read_many_readelf([elf_filenames[i] for i in fallback])):
+        results[i] = result
+
+    return results
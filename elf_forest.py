@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+'''
+Generator of synthetic dependency forests of tiny, valid ELF files,
+for the benchmarks (see bench.py).
+
+Every file is a minimal little-endian ELF64 shared object: one PT_LOAD over
+the whole file, PT_DYNAMIC with DT_NEEDED, DT_SONAME, DT_RUNPATH,
+DT_STRTAB, DT_STRSZ and spare DT_NULLs, and a PT_NOTE (a build-id) that
+elf_patch can take for a new string table. There is no code:
+the files are read, patched and stored, not run.
+make_shared_object also writes ELF32 and big-endian files, for the tests.
+
+The tree:
+
+    root/bin/exe<i>                     RUNPATH=$ORIGIN/../lib/v<i % versions>
+    root/lib/v<k>/lib<level>_<j>.so.1 -> lib<level>_<j>.so.1.<k>
+    root/lib/v<k>/lib<level>_<j>.so.1.<k>   RUNPATH=$ORIGIN
+
+Each version directory has the whole library forest: <depth> levels of
+<width> libraries, each library needs <fanout> libraries of the next level,
+and with the probability <cycles> also one of an upper level (a cycle).
+The executables need <fanout> libraries of the first level.
+With versions > 1 the executables resolve different versions of the same
+names: the version conflicts.
+
+    ./elf_forest.py temp/forest --roots 10 --width 20 --depth 5 --fanout 3 --versions 2
+'''
+
+import argparse
+import textwrap
+import os
+import random
+import struct
+from collections import namedtuple
+from os.path import join
+
+Forest = namedtuple('Forest', 'root executables libraries files edges')
+# executables: [path, ...], libraries: {(level, j): soname}, files: the number of ELF files written
+
+# the ELF header after e_ident, the program header, the dynamic entry
+_LAYOUTS = {
+    64: ('HHIQQQIHHHHHH', 'IIQQQQQQ', 'qQ'),
+    32: ('HHIIIIIHHHHHH', 'IIIIIIII', 'iI'),
+}
+_MACHINES = {(64, '<'): 62, (32, '<'): 3, (64, '>'): 21, (32, '>'): 20}
+# EM_X86_64, EM_386, EM_PPC64, EM_PPC
+
+ET_DYN = 3
+PT_LOAD, PT_DYNAMIC, PT_NOTE = 1, 2, 4
+PF_R = 4
+DT_NULL, DT_NEEDED, DT_STRTAB, DT_STRSZ, DT_SONAME, DT_RPATH, DT_RUNPATH = 0, 1, 5, 10, 14, 15, 29
+NT_GNU_BUILD_ID = 3
+
+SPARE_DT_NULLS = 2
+
+def _align(value, alignment=8):
+    return (value + alignment - 1) // alignment * alignment
+
+def make_shared_object(needed=(), soname='', runpath='', tag=b'',
+                       bits=64, byte_order='<', rpath='', merge_strings=False):
+    '''
+    make_shared_object(needed=(), soname='', runpath='', tag=b'', ...) -> bytes
+
+    A minimal ELF shared object, the tag goes into the build-id note
+    so that the versions of the same library have different hashes.
+
+    bits (64 or 32) and byte_order ('<' or '>') select the ELF class and data,
+    rpath adds a DT_RPATH, and merge_strings stores a string that is the tail
+    of a longer one at the tail of that one, as `ld` does.
+    '''
+
+    ehdr_st, phdr_st, dyn_st = (struct.Struct(byte_order + fmt) for fmt in _LAYOUTS[bits])
+
+    # the string table
+    strtab = bytearray(b'\0')
+    def string(s):
+        encoded = s.encode() + b'\0'
+        offset = strtab.find(encoded) if merge_strings else -1
+        if offset < 0:
+            offset = len(strtab)
+            strtab.extend(encoded)
+        return offset
+
+    if merge_strings:
+        # the longest first, the shorter ones are found as their tails
+        for s in sorted({*needed, soname, runpath, rpath} - {''}, key=len, reverse=True):
+            string(s)
+
+    entries = [(DT_NEEDED, string(name)) for name in needed]
+    if soname:
+        entries.append((DT_SONAME, string(soname)))
+    if runpath:
+        entries.append((DT_RUNPATH, string(runpath)))
+    if rpath:
+        entries.append((DT_RPATH, string(rpath)))
+
+    nphdr = 3
+    phoff = 16 + ehdr_st.size
+    note_offset = phoff + nphdr * phdr_st.size
+    note = struct.pack(byte_order + 'III', 4, len(tag), NT_GNU_BUILD_ID) + b'GNU\0' + tag + b'\0' * (_align(len(tag), 4) - len(tag))
+    strtab_offset = _align(note_offset + len(note))
+    dynamic_offset = _align(strtab_offset + len(strtab))
+
+    entries += [(DT_STRTAB, strtab_offset), (DT_STRSZ, len(strtab))]
+    entries += [(DT_NULL, 0)] * (1 + SPARE_DT_NULLS)
+    dynamic = b''.join(dyn_st.pack(*entry) for entry in entries)
+    size = dynamic_offset + len(dynamic)
+
+    ident = b'\x7fELF' + bytes([bits // 32, 1 if byte_order == '<' else 2, 1]) + b'\0' * 9
+    header = ident + ehdr_st.pack(ET_DYN, _MACHINES[(bits, byte_order)], 1, 0, phoff, 0, 0,
+                                  16 + ehdr_st.size, phdr_st.size, nphdr, 64 if bits == 64 else 40, 0, 0)
+
+    def phdr(p_type, offset, filesz, align):
+        # the file is loaded at address 0: the offsets are the addresses
+        if bits == 64:
+            return phdr_st.pack(p_type, PF_R, offset, offset, offset, filesz, filesz, align)
+        return phdr_st.pack(p_type, offset, offset, offset, filesz, filesz, PF_R, align)
+
+    phdrs = [
+        phdr(PT_LOAD, 0, size, 0x1000),
+        phdr(PT_DYNAMIC, dynamic_offset, len(dynamic), bits // 8),
+        phdr(PT_NOTE, note_offset, len(note), 4),
+    ]
+
+    image = bytearray(size)
+    image[0:len(header)] = header
+    image[phoff:note_offset] = b''.join(phdrs)
+    image[note_offset:note_offset + len(note)] = note
+    image[strtab_offset:strtab_offset + len(strtab)] = strtab
+    image[dynamic_offset:size] = dynamic
+    return bytes(image)
+
+def library_name(level, j):
+    return f'lib{level}_{j}.so.1'
+
+def generate_forest(root, roots=10, width=20, depth=5, fanout=3, versions=1, cycles=0.0, seed=0):
+    '''
+    generate_forest(root, ...) -> Forest
+
+    Write the tree described in the module docstring under <root>.
+    '''
+
+    rng = random.Random(seed)
+
+    # the graph is the same in every version directory
+    needs = {}
+    for level in range(depth):
+        for j in range(width):
+            deps = set()
+            if level + 1 < depth:
+                deps.update(rng.sample(range(width), min(fanout, width)))
+                needs[(level, j)] = [library_name(level + 1, d) for d in sorted(deps)]
+            else:
+                needs[(level, j)] = []
+            if level > 0 and rng.random() < cycles:
+                needs[(level, j)].append(library_name(rng.randrange(level), rng.randrange(width)))
+
+    files = 0
+    for k in range(versions):
+        version_dir = join(root, 'lib', f'v{k}')
+        os.makedirs(version_dir, exist_ok=True)
+        for (level, j), needed in needs.items():
+            soname = library_name(level, j)
+            real = f'{soname}.{k}'
+            with open(join(version_dir, real), 'wb') as f:
+                f.write(make_shared_object(needed, soname, '$ORIGIN', f'{real} v{k}'.encode()))
+            os.symlink(real, join(version_dir, soname))
+            files += 1
+
+    bin_dir = join(root, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    executables = []
+    for i in range(roots):
+        needed = [library_name(0, d) for d in sorted(rng.sample(range(width), min(fanout, width)))]
+        path = join(bin_dir, f'exe{i}')
+        with open(path, 'wb') as f:
+            f.write(make_shared_object(needed, '', f'$ORIGIN/../lib/v{i % versions}', f'exe{i}'.encode()))
+        os.chmod(path, 0o755)
+        executables.append(path)
+        files += 1
+
+    edges = sum(len(needed) for needed in needs.values()) * versions + roots * min(fanout, width)
+    libraries = {key: library_name(*key) for key in needs}
+    return Forest(root, executables, libraries, files, edges)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+            formatter_class = argparse.RawDescriptionHelpFormatter,
+            description = textwrap.dedent("""Write a synthetic forest of tiny ELF files with dependencies"""),
+            epilog = textwrap.dedent("""
+            Example:
+            ./elf_forest.py temp/forest --roots 10 --width 20 --depth 5 --fanout 3 --versions 2 --cycles 0.1
+            ./all_deps.py -n temp/forest/bin/exe0
+            """)
+            )
+
+    parser.add_argument("root", type=str, help="the directory to write the forest to")
+    parser.add_argument("--roots",    type=int,   default=10,  help="the number of executables (default: %(default)s)")
+    parser.add_argument("--width",    type=int,   default=20,  help="libraries per level (default: %(default)s)")
+    parser.add_argument("--depth",    type=int,   default=5,   help="levels of libraries (default: %(default)s)")
+    parser.add_argument("--fanout",   type=int,   default=3,   help="NEEDED entries per file (default: %(default)s)")
+    parser.add_argument("--versions", type=int,   default=1,   help="versions of every library, >1 makes conflicts (default: %(default)s)")
+    parser.add_argument("--cycles",   type=float, default=0.0, help="the probability of a library to need an upper level one (default: %(default)s)")
+    parser.add_argument("--seed",     type=int,   default=0,   help="random seed (default: %(default)s)")
+
+    args = parser.parse_args()
+
+    forest = generate_forest(args.root, args.roots, args.width, args.depth, args.fanout, args.versions, args.cycles, args.seed)
+    print(f'{forest.files} files, {forest.edges} dependencies in {forest.root}')
@@ -0,0 +1,251 @@
+'''
+In-process editor of the RUNPATH of ELF files, instead of `patchelf --set-rpath`.
+
+The edit is planned on a read-only buffer (bytes or mmap) as a list of
+patches [(file offset, new bytes), ...] plus a tail appended to the file,
+so it can be applied while the file is copied and hashed, in one pass:
+
+    patches, tail = runpath_patches(buf, '$ORIGIN/')
+
+1) If the file has DT_RUNPATH or DT_RPATH and the new string fits in the old one,
+   the string is overwritten in place (padded with NULs), DT_RPATH becomes DT_RUNPATH.
+   Not when the linker merged the old string with another one (a DT_NEEDED,
+   DT_SONAME... pointing into it, or ending on the same NUL): then it goes to 2).
+
+2) Otherwise the dynamic string table is copied to the end of the file with
+   the new string appended, and mapped by a new read-only PT_LOAD segment.
+   The program header for it is taken from a PT_NOTE segment (not the
+   GNU property note), the notes stay in the file as sections.
+   DT_STRTAB, DT_STRSZ and the .dynstr section header point to the new table.
+   If the file has no RUNPATH/RPATH entry, it goes into a spare DT_NULL
+   at the end of the dynamic section.
+
+ElfPatchError is raised for the files it cannot edit (no PT_NOTE to take,
+no spare DT_NULL...), then patchelf is the fallback.
+Files without a dynamic section (static) are left as they are.
+'''
+
+import logging
+import mmap
+import struct
+
+from elf_dynamic import ELF_MAGIC, ELFCLASS64, _LAYOUTS, PT_LOAD, PT_DYNAMIC, SHT_DYNAMIC, \
+                        DT_NULL, DT_NEEDED, DT_STRTAB, DT_STRSZ, DT_SONAME, DT_RPATH, DT_RUNPATH
+
+PT_NOTE = 4
+PF_R = 4
+NT_GNU_PROPERTY_TYPE_0 = 5
+
+# the tags whose d_val is an offset in the dynamic string table
+DT_AUXILIARY, DT_FILTER = 0x7ffffffd, 0x7fffffff
+DT_CONFIG, DT_DEPAUDIT, DT_AUDIT = 0x6ffffefa, 0x6ffffefb, 0x6ffffefc
+_STRING_TAGS = {DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH, DT_AUXILIARY, DT_FILTER, DT_CONFIG, DT_DEPAUDIT, DT_AUDIT}
+
+class ElfPatchError(Exception):
+    pass
+
+_PHDR_FIELDS = {
+    ELFCLASS64: ('p_type', 'p_flags', 'p_offset', 'p_vaddr', 'p_paddr', 'p_filesz', 'p_memsz', 'p_align'),
+    1:          ('p_type', 'p_offset', 'p_vaddr', 'p_paddr', 'p_filesz', 'p_memsz', 'p_flags', 'p_align'),
+}
+
+def _align_up(value, alignment):
+    if alignment <= 1:
+        return value
+    return (value + alignment - 1) // alignment * alignment
+
+def _cstring_size(buf, offset):
+    end = buf.find(b'\0', offset)
+    if end < 0:
+        raise ElfPatchError(f'unterminated string at offset {offset}')
+    return end - offset
+
+def runpath_patches(buf, runpath):
+    '''
+    runpath_patches(buf, runpath) -> (patches, tail)
+
+    Plan setting DT_RUNPATH = runpath in the ELF image buf.
+    '''
+
+    try:
+        return _runpath_patches(buf, runpath)
+    except struct.error as e:
+        raise ElfPatchError('truncated ELF file') from e
+
+def _runpath_patches(buf, runpath):
+    if len(buf) < 16 or buf[:4] != ELF_MAGIC or (buf[4], buf[5]) not in _LAYOUTS:
+        raise ElfPatchError('not a supported ELF file')
+
+    elf_class = buf[4]
+    ehdr_st, phdr_st, shdr_st, dyn_st = _LAYOUTS[(buf[4], buf[5])]
+    fields = _PHDR_FIELDS[elf_class]
+
+    (_, _, _, _, e_phoff, e_shoff, _, _,
+     e_phentsize, e_phnum, e_shentsize, e_shnum, _) = ehdr_st.unpack_from(buf, 16)
+    if e_phentsize != phdr_st.size:
+        raise ElfPatchError(f'unexpected program header size {e_phentsize}')
+
+    phdrs = [dict(zip(fields, phdr_st.unpack_from(buf, e_phoff + i * e_phentsize))) for i in range(e_phnum)]
+    loads = [p for p in phdrs if p['p_type'] == PT_LOAD]
+    dynamic = next((p for p in phdrs if p['p_type'] == PT_DYNAMIC), None)
+    if dynamic is None:
+        logging.debug('runpath_patches: no dynamic section, nothing to patch')
+        return [], b''
+
+    def vaddr_to_offset(vaddr):
+        for p in loads:
+            if p['p_vaddr'] <= vaddr < p['p_vaddr'] + p['p_filesz']:
+                return vaddr - p['p_vaddr'] + p['p_offset']
+        raise ElfPatchError(f'address {vaddr:#x} is not in a loaded segment')
+
+    # the dynamic entries: {tag: (entry offset, value)}, the DT_NULL slots
+    # and all the string entries [(entry offset, string offset), ...]
+    entries = {}
+    null_slots = []
+    strings = []
+    for entry_offset in range(dynamic['p_offset'], dynamic['p_offset'] + dynamic['p_filesz'] - dyn_st.size + 1, dyn_st.size):
+        d_tag, d_val = dyn_st.unpack_from(buf, entry_offset)
+        if d_tag == DT_NULL:
+            null_slots.append(entry_offset)
+        elif not null_slots:
+            entries.setdefault(d_tag, (entry_offset, d_val))
+            if d_tag in _STRING_TAGS:
+                strings.append((entry_offset, d_val))
+
+    if DT_STRTAB not in entries or DT_STRSZ not in entries:
+        raise ElfPatchError('no DT_STRTAB/DT_STRSZ')
+
+    strtab = vaddr_to_offset(entries[DT_STRTAB][1])
+    strsz = entries[DT_STRSZ][1]
+    new_string = runpath.encode(errors='surrogateescape') + b'\0'
+
+    # the entry to set: DT_RUNPATH, or DT_RPATH turned into DT_RUNPATH
+    target = entries.get(DT_RUNPATH) or entries.get(DT_RPATH)
+
+    patches = []
+    if target is not None:
+        target_offset, string_offset = target
+        old_size = _cstring_size(buf, strtab + string_offset) + 1
+        if len(new_string) <= old_size and not _shares_string(buf, strtab, strsz, strings, target):
+            patches.append((strtab + string_offset, new_string + b'\0' * (old_size - len(new_string))))
+            patches.append((target_offset, dyn_st.pack(DT_RUNPATH, string_offset)))
+            return sorted(patches), b''
+
+    else:
+        # the entry goes into a DT_NULL slot, the last one must stay
+        if len(null_slots) < 2:
+            raise ElfPatchError('no spare DT_NULL slot for DT_RUNPATH')
+        target_offset = null_slots[0]
+
+    #
+    # append the new string table in a new PT_LOAD
+    notes = [p for p in phdrs if p['p_type'] == PT_NOTE and not _is_property_note(buf, p, elf_class)]
+    if not notes or not loads:
+        raise ElfPatchError('no PT_NOTE program header to reuse for the new string table')
+    note = notes[-1]
+
+    new_table = bytes(buf[strtab:strtab + strsz]) + new_string
+    table_offset = _align_up(len(buf), 16)
+
+    # the file offset and the address must be congruent modulo the alignment
+    alignment = max(p['p_align'] for p in loads)
+    vaddr_end = max(p['p_vaddr'] + p['p_memsz'] for p in loads)
+    table_vaddr = _align_up(vaddr_end, alignment) + (table_offset % alignment if alignment > 1 else 0)
+
+    new_load = dict(note, p_type=PT_LOAD, p_flags=PF_R,
+                    p_offset=table_offset, p_vaddr=table_vaddr, p_paddr=table_vaddr,
+                    p_filesz=len(new_table), p_memsz=len(new_table), p_align=alignment)
+
+    # PT_LOAD entries must be sorted by address: the new one goes after the last
+    new_phdrs = [p for p in phdrs if p is not note]
+    last_load = max(i for i, p in enumerate(new_phdrs) if p['p_type'] == PT_LOAD)
+    new_phdrs.insert(last_load + 1, new_load)
+    patches.append((e_phoff, b''.join(phdr_st.pack(*(p[f] for f in fields)) for p in new_phdrs)))
+
+    patches.append((entries[DT_STRTAB][0], dyn_st.pack(DT_STRTAB, table_vaddr)))
+    patches.append((entries[DT_STRSZ][0], dyn_st.pack(DT_STRSZ, len(new_table))))
+    patches.append((target_offset, dyn_st.pack(DT_RUNPATH, strsz)))
+
+    # the .dynstr section header, if the sections are there
+    dynstr_header = _dynstr_section_header(buf, e_shoff, e_shnum, e_shentsize, shdr_st)
+    if dynstr_header is not None:
+        header_offset, section = dynstr_header
+        # sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, ...
+        section[3], section[4], section[5] = table_vaddr, table_offset, len(new_table)
+        patches.append((header_offset, shdr_st.pack(*section)))
+
+    tail = b'\0' * (table_offset - len(buf)) + new_table
+    return sorted(patches), tail
+
+def _shares_string(buf, strtab, strsz, strings, target):
+    '''
+    does another string entry point into the string of the target entry,
+    or end on its NUL (the target string is its tail)
+    '''
+
+    target_offset, string_offset = target
+    string_end = string_offset + _cstring_size(buf, strtab + string_offset)
+    for entry_offset, offset in strings:
+        if entry_offset == target_offset or offset >= strsz:
+            continue
+        if string_offset <= offset <= string_end:
+            return True
+        if offset < string_offset and buf.find(b'\0', strtab + offset) >= strtab + string_offset:
+            return True
+    return False
+
+def _is_property_note(buf, phdr, elf_class):
+    '''the GNU property note (CET, BTI...) is read by the loader, it must stay'''
+    if phdr['p_filesz'] < 12:
+        return False
+    order = '<' if buf[5] == 1 else '>'
+    _, _, note_type = struct.unpack_from(order + 'III', buf, phdr['p_offset'])
+    return note_type == NT_GNU_PROPERTY_TYPE_0
+
+def _dynstr_section_header(buf, e_shoff, e_shnum, e_shentsize, shdr_st):
+    '''(offset of the section header, [its fields]) of the string table of SHT_DYNAMIC'''
+    if not e_shoff or e_shentsize != shdr_st.size or e_shoff + e_shnum * e_shentsize > len(buf):
+        return None
+
+    for i in range(e_shnum):
+        section = shdr_st.unpack_from(buf, e_shoff + i * e_shentsize)
+        sh_type, sh_link = section[1], section[6]
+        if sh_type == SHT_DYNAMIC and sh_link < e_shnum:
+            header_offset = e_shoff + sh_link * e_shentsize
+            return header_offset, list(shdr_st.unpack_from(buf, header_offset))
+
+    return None
+
+def apply_patches(chunk, chunk_offset, patches):
+    '''
+    apply the patches to a writable chunk of the file (bytearray or memoryview)
+    that starts at chunk_offset in the file
+    '''
+
+    chunk_end = chunk_offset + len(chunk)
+    for offset, data in patches:
+        start, end = max(offset, chunk_offset), min(offset + len(data), chunk_end)
+        if start < end:
+            chunk[start - chunk_offset:end - chunk_offset] = data[start - offset:end - offset]
+
+def set_runpath_file(filename, runpath):
+    '''
+    set_runpath_file(filename, runpath)
+
+    Edit the file in place.
+    '''
+
+    with open(filename, 'r+b') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                patches, tail = runpath_patches(buf, runpath)
+        except ValueError as e:
+            raise ElfPatchError(f'cannot mmap {filename}') from e
+
+        for offset, data in patches:
+            f.seek(offset)
+            f.write(data)
+
+        if tail:
+            f.seek(0, 2)
+            f.write(tail)
@@ -0,0 +1,142 @@
+'''
+Incremental, atomic updates of an environment directory.
+
+An environment is a layout of symlinks into the store:
+
+    {relative path: target}, like {'ls': '/store/ls/ls/ls,ls,<hash>', ...}
+
+With updates, env_dir is itself a symlink to one of two generation
+directories next to it, and a new layout is applied like this:
+
+    env_dir   -> env_dir.a     the active generation, never modified
+    env_dir.b                  the previous generation, or new
+
+    1) diff the layout of env_dir.b against the new layout,
+       create, replace and remove only the links that differ
+    2) point a temp symlink at env_dir.b and rename it over env_dir
+
+The rename is atomic: a program sees either the old or the new environment,
+never a half-built one. If the active generation already has the layout,
+nothing is touched.
+
+The generation that was just replaced is the one edited by the next update:
+a program started from it keeps its already loaded libraries,
+but a dlopen after two updates can see the newer files.
+
+A plain env_dir (not a symlink) from before is renamed into
+the first generation, the only moment env_dir does not exist.
+'''
+
+import logging
+import os
+from collections import namedtuple
+from os.path import basename, dirname, islink, join
+
+GENERATIONS = ('a', 'b')
+
+LayoutDiff = namedtuple('LayoutDiff', 'add change remove')
+# add and change are {path: target}, remove is [path, ...]
+
+def read_layout(directory):
+    '''
+    read_layout(directory) -> {relative path: symlink target}
+
+    The symlinks in the directory and its subdirectories, other files are ignored.
+    '''
+
+    layout = {}
+    if not os.path.isdir(directory):
+        return layout
+
+    stack = ['']
+    while stack:
+        prefix = stack.pop()
+        with os.scandir(join(directory, prefix) if prefix else directory) as entries:
+            for entry in entries:
+                path = prefix + entry.name
+                if entry.is_symlink():
+                    layout[path] = os.readlink(entry.path)
+                elif entry.is_dir():
+                    stack.append(path + '/')
+
+    return layout
+
+def diff_layouts(old, new):
+    add = {path: target for path, target in new.items() if path not in old}
+    change = {path: target for path, target in new.items() if path in old and old[path] != target}
+    remove = [path for path in old if path not in new]
+    return LayoutDiff(add, change, remove)
+
+def apply_diff(directory, diff):
+    '''make the links of the directory match the new layout'''
+
+    for path in diff.remove:
+        os.unlink(join(directory, path))
+
+    # the subdirectories left empty, the deepest first
+    for subdir in sorted({dirname(path) for path in diff.remove if '/' in path}, key=len, reverse=True):
+        try:
+            os.rmdir(join(directory, subdir))
+        except OSError:
+            # not empty
+            pass
+
+    for path, target in diff.change.items():
+        # a link cannot be overwritten in place: rename a new one over it
+        tmp = join(directory, f'{path}.{os.getpid()}.tmp')
+        os.symlink(target, tmp)
+        os.replace(tmp, join(directory, path))
+
+    for path, target in diff.add.items():
+        if '/' in path:
+            os.makedirs(join(directory, dirname(path)), exist_ok=True)
+        os.symlink(target, join(directory, path))
+
+def generation_dirs(env_dir):
+    env_dir = env_dir.rstrip('/')
+    return [f'{env_dir}.{gen}' for gen in GENERATIONS]
+
+def update_env(env_dir, layout, dry_run=False):
+    '''
+    update_env(env_dir, layout, dry_run=False) -> LayoutDiff against the active generation
+
+    Apply the layout {relative path: target} to env_dir, see the module docstring.
+    '''
+
+    env_dir = env_dir.rstrip('/')
+    gen_a, gen_b = generation_dirs(env_dir)
+
+    if islink(env_dir):
+        active = join(dirname(env_dir), os.readlink(env_dir))
+    elif os.path.isdir(env_dir):
+        active = None
+    else:
+        active = gen_b
+
+    diff = diff_layouts(read_layout(env_dir), layout)
+    if not any(diff):
+        logging.info(f'update_env: {env_dir} is up to date')
+        return diff
+
+    logging.info(f'update_env: {env_dir}: {len(diff.add)} new, {len(diff.change)} changed, {len(diff.remove)} removed links')
+    if dry_run:
+        return diff
+
+    if active is None:
+        # the old plain directory becomes the first generation
+        logging.info(f'update_env: moving {env_dir} to {gen_a}')
+        os.rename(env_dir, gen_a)
+        os.symlink(basename(gen_a), env_dir)
+        active = gen_a
+
+    inactive = gen_b if os.path.abspath(active) == os.path.abspath(gen_a) else gen_a
+    os.makedirs(inactive, exist_ok=True)
+    apply_diff(inactive, diff_layouts(read_layout(inactive), layout))
+
+    # the atomic swap
+    tmp = f'{env_dir}.{os.getpid()}.tmp'
+    os.symlink(basename(inactive), tmp)
+    os.replace(tmp, env_dir)
+    logging.debug(f'update_env: {env_dir} -> {inactive}')
+
+    return diff
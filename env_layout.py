@@ -0,0 +1,217 @@
+'''
+Layout planner for the environment directories: the "soup" and the `_deps` directories.
+
+Every stored file has RUNPATH=$ORIGIN/name_deps/:$ORIGIN/:$ORIGIN/common/
+(see store_files.store_rpath). In an environment directory, one version of
+every name goes into the flat soup. When a binary needs another version of a
+library, that version goes into the binary's own directory `binary_deps/`,
+which the loader searches first:
+
+    env/
+        foo                     -> store/.../foo,1,<hash>
+        libbar.so.1             -> store/.../libbar.so.1,2.0,<hash>   the soup version
+        foo_deps/
+            libbar.so.1         -> store/.../libbar.so.1,1.0,<hash>   what foo needs
+            common              -> ..                                 the soup, for libbar's own deps
+
+A file in a `_deps` directory resolves its dependencies in the same order:
+its own `_deps`, the directory it is in, then the soup through `common`.
+If the directory it is in has the wrong version of something it needs,
+it gets its own nested `_deps` directory too.
+
+The soup version of a name is chosen greedily: the conflicting names with
+the most parents first, and for each the version that adds the fewest
+new `_deps` directories, given the ones already needed (the score breaks ties).
+The conflict checks are lookups in the layout {path: node}, each
+(node, directory) placement is resolved once.
+
+With minimal_runpaths, every placed file can get the shortest RUNPATH that
+still resolves its dependencies, instead of the three store entries:
+a file with no conflicts gets just $ORIGIN. The loader tries the RUNPATH
+directories in order, each with its glibc-hwcaps subdirectories first,
+so every directory before the right one costs failed openat calls.
+
+Known limitation: the loader shares a loaded library between all objects
+by its SONAME, so two versions with the same SONAME cannot coexist in one process.
+'''
+
+import logging
+
+DEPS_SUFFIX = '_deps/'
+
+# where a dependency is found from a placed file, in the store RUNPATH order
+IN_OWN_DEPS, IN_ORIGIN, IN_COMMON = range(3)
+
+def runpath_entry(location, name):
+    return ('$ORIGIN/' + name + DEPS_SUFFIX[:-1], '$ORIGIN', '$ORIGIN/common')[location]
+
+def failed_probes(position, hwcaps=0):
+    '''
+    the failed opens before a library is found in the RUNPATH directory at <position>:
+    each directory before it, and the glibc-hwcaps subdirectories of all of them
+    '''
+    return position * (1 + hwcaps) + hwcaps
+
+def deps_dir(directory, name):
+    return f'{directory}{name}{DEPS_SUFFIX}'
+
+class LayoutPlanner:
+    '''
+    planner = LayoutPlanner(accumulated)
+    layout = planner.plan()  # {relative path: node}
+
+    accumulated = {name: [[DepNode, score], ...]} (AccumulatedNodes),
+    the graph is taken from the nodes' parents.
+    '''
+
+    def __init__(self, accumulated):
+        self.accumulated = accumulated
+        self.nodes = {}     # {id: node}
+        self.scores = {}    # {id: score}
+        self.children = {}  # {id: [node, ...]}
+
+        for defs in accumulated.values():
+            for node, score in defs:
+                self.nodes[id(node)] = node
+                self.scores[id(node)] = score
+                self.children.setdefault(id(node), [])
+
+        for node in self.nodes.values():
+            for parent in node.parents:
+                self.children.setdefault(id(parent), []).append(node)
+
+        self.soup = {}          # {name: node}
+        self.layout = {}        # {relative path: node}
+        self.deps_dirs = set()  # the `_deps` directories of the layout
+        self.placed = set()     # {(id(node), directory)}
+
+    def choose_soup(self):
+        '''the soup version for every name, see the module docstring'''
+
+        needed_dirs = set()  # id(parent) of the parents that get a `_deps` directory
+        conflicting = []
+        for name, defs in self.accumulated.items():
+            if len(defs) == 1:
+                self.soup[name] = defs[0][0]
+            else:
+                conflicting.append((name, defs))
+
+        def parents_count(item):
+            return sum(len(node.parents) for node, _ in item[1])
+
+        for name, defs in sorted(conflicting, key=parents_count, reverse=True):
+            best, best_cost = None, None
+            for i, (candidate, score) in enumerate(defs):
+                new_dirs = {id(parent) for node, _ in defs if node is not candidate for parent in node.parents} - needed_dirs
+                cost = (len(new_dirs), -score, i)
+                if best_cost is None or cost < best_cost:
+                    best, best_cost, best_dirs = candidate, cost, new_dirs
+
+            self.soup[name] = best
+            needed_dirs |= best_dirs
+
+        logging.debug(f'LayoutPlanner: {len(conflicting)} names with conflicting versions')
+        return self.soup
+
+    def find(self, directory, name):
+        '''the node the loader finds for <name> from a file in <directory>, its own `_deps` aside'''
+        node = self.layout.get(directory + name)
+        if node is None and directory:
+            # $ORIGIN/common/ is the soup
+            node = self.layout.get(name)
+        return node
+
+    def place(self, node, path):
+        existing = self.layout.setdefault(path, node)
+        if existing is not node:
+            logging.warning(f'LayoutPlanner: {path} is taken by {existing.full_definition}, cannot place {node.full_definition}')
+            return False
+        return True
+
+    def plan(self):
+        '''
+        plan() -> {relative path: node}
+
+        The `_deps` directories are in self.deps_dirs,
+        each of them gets a `common` link to the soup (see layout_links).
+        '''
+
+        if not self.soup:
+            self.choose_soup()
+
+        for name, node in self.soup.items():
+            self.place(node, name)
+
+        stack = [(node, '') for node in self.soup.values()]
+        while stack:
+            node, directory = stack.pop()
+            if (id(node), directory) in self.placed:
+                continue
+            self.placed.add((id(node), directory))
+
+            own_deps = deps_dir(directory, node.name)
+            # the wrong versions first: they fill own_deps,
+            # which the loader searches before the rest
+            wrong = []
+            for child in self.children.get(id(node), ()):
+                found = self.find(directory, child.name)
+                if found is child:
+                    stack.append((child, directory if directory + child.name in self.layout else ''))
+                else:
+                    wrong.append(child)
+
+            for child in wrong:
+                if self.place(child, own_deps + child.name):
+                    self.deps_dirs.add(own_deps)
+                    stack.append((child, own_deps))
+
+        logging.info(f'LayoutPlanner: {len(self.layout)} links, {len(self.deps_dirs)} _deps directories')
+        return self.layout
+
+    def location(self, node, directory, child):
+        if self.layout.get(deps_dir(directory, node.name) + child.name) is child:
+            return IN_OWN_DEPS
+        # in the top directory the soup is $ORIGIN itself
+        if not directory or directory + child.name in self.layout:
+            return IN_ORIGIN
+        return IN_COMMON
+
+    def minimal_runpaths(self, hwcaps=0):
+        '''
+        minimal_runpaths(hwcaps=0) -> ({path: runpath}, saved probes)
+
+        The shortest RUNPATH for every file in the planned layout, and
+        how many failed loader probes it saves against the store RUNPATH,
+        for one load of every file, with <hwcaps> glibc-hwcaps subdirectories.
+        '''
+
+        runpaths = {}
+        saved = 0
+        for path, node in self.layout.items():
+            directory = path[:len(path) - len(node.name)]
+            locations = [self.location(node, directory, child) for child in self.children.get(id(node), ())]
+
+            used = sorted(set(locations)) or [IN_ORIGIN]
+            runpaths[path] = ':'.join(runpath_entry(location, node.name) for location in used)
+            saved += sum(failed_probes(location, hwcaps) - failed_probes(used.index(location), hwcaps)
+                         for location in locations)
+
+        return runpaths, saved
+
+def layout_links(layout, deps_dirs, target=lambda node: node.value['full_path']):
+    '''
+    layout_links(layout, deps_dirs) -> {relative path: symlink target}
+
+    The symlinks for env_dir.update_env, with the `common` link
+    in every `_deps` directory pointing back to the top of the environment.
+    '''
+
+    links = {path: target(node) for path, node in layout.items()}
+    for directory in deps_dirs:
+        links[directory + 'common'] = '/'.join(['..'] * directory.count('/'))
+    return links
+
+def plan_links(accumulated):
+    '''plan_links(accumulated) -> {relative path: symlink target} of the planned layout'''
+    planner = LayoutPlanner(accumulated)
+    return layout_links(planner.plan(), planner.deps_dirs)
@@ -0,0 +1,255 @@
+'''
+Selector queries over a dependency graph, like CSS selectors over a tree:
+
+    libgtk*                  the nodes named libgtk*
+    =libc.so.6               the nodes of this version
+    libssl*=>=libssl.so.3    a name and a version constraint (see versions.py)
+    libgtk*>libglib*         the libglib* nodes that a libgtk* node needs directly
+    curl libz*               the libz* nodes that curl needs, directly or transitively
+
+A step is a name glob and an optional =version, the version is a constraint
+of versions.py or a glob. The steps are joined by `>` (a child) or
+by whitespace (a descendant). The query selects the nodes of the last step.
+
+The steps are answered from an index: the names sorted for the glob
+prefixes, the exact names and versions in dicts. The descendants of a node
+are computed once, on the strongly connected components of the graph,
+and memoized as bitmasks, so a query does not walk the paths of the graph:
+
+    index = SelectorIndex.from_graph(dep_graphs, acc_deps)
+    for node in index.select_nodes('libgtk*>libglib*'):
+        ...
+'''
+
+from bisect import bisect_left
+from fnmatch import fnmatchcase
+
+from dep_node import number_nodes
+from versions import is_range, parse_range
+
+WILDCARDS = '*?['
+CHILD, DESCENDANT = '>', ' '
+
+def _has_wildcard(pattern):
+    return any(ch in pattern for ch in WILDCARDS)
+
+def parse_selector(query):
+    '''
+    parse_selector('libgtk* > libglib*=>=2.70') -> [(None, 'libgtk*', ''), ('>', 'libglib*', '>=2.70')]
+
+    The steps as (combinator, name, version).
+    A `>` in the version is the combinator unless it starts a clause: =>=2.70 or =<3,>2
+    '''
+
+    steps = []
+    i, n = 0, len(query)
+    while True:
+        start = i
+        while i < n and query[i].isspace():
+            i += 1
+        combinator = DESCENDANT if i > start else None
+        if i < n and query[i] == CHILD:
+            combinator = CHILD
+            i += 1
+            while i < n and query[i].isspace():
+                i += 1
+
+        if i >= n:
+            if combinator == CHILD or not steps:
+                raise ValueError(f'parse_selector: a selector step is missing in {query!r}')
+            break
+
+        if not steps and combinator == CHILD:
+            raise ValueError(f'parse_selector: the selector {query!r} starts with {CHILD}')
+        if steps and combinator is None:
+            raise ValueError(f'parse_selector: no combinator before {query[i:]!r} in {query!r}')
+
+        j = i
+        while j < n and query[j] not in '=>' and not query[j].isspace():
+            j += 1
+        name, version = query[i:j], ''
+
+        if j < n and query[j] == '=':
+            k = j + 1
+            while k < n and not query[k].isspace():
+                if query[k] == CHILD and query[k - 1] not in '=,':
+                    break
+                k += 1
+            version, j = query[j + 1:k], k
+
+        if not name and not version:
+            raise ValueError(f'parse_selector: an empty step at {query[i:]!r} in {query!r}')
+
+        steps.append((combinator if steps else None, name, version))
+        i = j
+
+    return steps
+
+def version_matcher(constraint):
+    '''a predicate of versions: a glob, or a constraint of versions.py'''
+    if _has_wildcard(constraint):
+        return lambda version: fnmatchcase(version, constraint)
+    return parse_range(constraint).contains
+
+class SelectorIndex:
+    '''
+    The index of a graph with integer node ids for the selector queries:
+    names[i], versions[i] of the nodes, and children[i] -- their child ids.
+    nodes[i] are the graph nodes, if the index is made from them.
+    '''
+
+    def __init__(self, names, versions, children, nodes=None):
+        self.names = names
+        self.versions = versions
+        self.children = children
+        self.nodes = nodes
+
+        self.by_name = {}
+        self.by_version = {}
+        for node_id, (name, version) in enumerate(zip(names, versions)):
+            self.by_name.setdefault(name, []).append(node_id)
+            self.by_version.setdefault(version, []).append(node_id)
+        self.sorted_names = sorted(self.by_name)
+
+        # {node id: bitmask of the nodes reachable by one edge or more}
+        self._descendants = {}
+
+    @classmethod
+    def from_graph(cls, roots, accumulated):
+        '''the index of the graph of all_deps.targets_to_graph'''
+        nodes, _, children, _ = number_nodes(roots, accumulated)
+        return cls([node.name for node in nodes], [node.full_definition.version for node in nodes], children, nodes)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        '''the index of a graph_snapshot.GraphSnapshot, the ids are its node ids'''
+        class Children:
+            def __getitem__(self, node_id):
+                return snapshot.children_ids(node_id)
+
+        n_nodes = len(snapshot)
+        return cls([snapshot.name(i) for i in range(n_nodes)], [snapshot.version(i) for i in range(n_nodes)], Children())
+
+    def __len__(self):
+        return len(self.names)
+
+    def match_names(self, pattern):
+        '''the ids of the nodes whose name matches the glob, the literal prefix is a binary search'''
+        if not _has_wildcard(pattern):
+            return self.by_name.get(pattern, [])
+
+        prefix = pattern
+        for ch in WILDCARDS:
+            prefix = prefix.split(ch, 1)[0]
+
+        ids = []
+        for i in range(bisect_left(self.sorted_names, prefix), len(self.sorted_names)):
+            name = self.sorted_names[i]
+            if not name.startswith(prefix):
+                break
+            if fnmatchcase(name, pattern):
+                ids.extend(self.by_name[name])
+        return ids
+
+    def step_ids(self, name, version):
+        '''the ids of the nodes that match one step, sorted'''
+        ids = self.match_names(name) if name else None
+
+        if version and not _has_wildcard(version) and not is_range(version):
+            # an exact version
+            if ids is None:
+                ids = self.by_version.get(version, [])
+            else:
+                ids = [i for i in ids if self.versions[i] == version]
+
+        elif version:
+            matches = version_matcher(version)
+            ids = [i for i in (ids if ids is not None else range(len(self))) if matches(self.versions[i])]
+
+        return sorted(ids) if ids is not None else list(range(len(self)))
+
+    def descendants(self, node_id):
+        '''the bitmask of the nodes reachable from node_id by one edge or more'''
+        mask = self._descendants.get(node_id)
+        if mask is None:
+            self._reach_from(node_id)
+            mask = self._descendants[node_id]
+        return mask
+
+    def _reach_from(self, start):
+        '''
+        Tarjan's strongly connected components, iteratively, from start
+        over the nodes that are not memoized yet. The nodes of a component
+        reach the same nodes: the children of the component and their descendants.
+        '''
+
+        memo = self._descendants
+        children = self.children
+        index = {start: 0}
+        low = {start: 0}
+        stack = [start]
+        on_stack = {start}
+        work = [(start, iter(children[start]))]
+
+        while work:
+            v, child_iter = work[-1]
+            for w in child_iter:
+                if w in memo:
+                    continue
+                if w not in index:
+                    index[w] = low[w] = len(index)
+                    stack.append(w)
+                    on_stack.add(w)
+                    work.append((w, iter(children[w])))
+                    break
+                if w in on_stack:
+                    low[v] = min(low[v], index[w])
+
+            else:
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    low[u] = min(low[u], low[v])
+
+                if low[v] == index[v]:
+                    component = []
+                    while True:
+                        w = stack.pop()
+                        on_stack.discard(w)
+                        component.append(w)
+                        if w == v:
+                            break
+
+                    # the edges inside the component set the bits of its nodes
+                    mask = 0
+                    for m in component:
+                        for c in children[m]:
+                            mask |= (1 << c) | memo.get(c, 0)
+                    for m in component:
+                        memo[m] = mask
+
+    def select(self, query):
+        '''select(query) -> [node id, ...] of the nodes that match the last step, sorted'''
+        selected = None
+        for combinator, name, version in parse_selector(query):
+            candidates = self.step_ids(name, version)
+            if selected is None:
+                selected = candidates
+
+            elif combinator == CHILD:
+                child_ids = {c for node_id in selected for c in self.children[node_id]}
+                selected = [c for c in candidates if c in child_ids]
+
+            else:
+                reach = 0
+                for node_id in selected:
+                    reach |= self.descendants(node_id)
+                selected = [c for c in candidates if reach >> c & 1]
+
+            if not selected:
+                break
+
+        return selected
+
+    def select_nodes(self, query):
+        return [self.nodes[node_id] for node_id in self.select(query)]
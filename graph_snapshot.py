@@ -0,0 +1,448 @@
+#!/usr/bin/python3
+'''
+Snapshots of the accumulated dependency graph, a binary file that is
+mmap-ed back and queried without reading any ELF file again.
+
+    ./all_deps.py --snapshot temp/host.graph curl ssh ls
+    ./graph_snapshot.py temp/host.graph rdeps libssl.so.3
+    ./graph_snapshot.py temp/host.graph needs libssl.so.3 '>=libssl.so.3.0.2'
+    ./graph_snapshot.py temp/host.graph closure curl
+
+The file is a header and flat arrays of native 32-bit integers:
+
+    header       magic, format, byte order mark, the counts, the section offsets
+    string_offsets  n_strings + 1 offsets into the string pool
+    strings      the UTF-8 string pool, every distinct string once
+    nodes        n_nodes rows of NODE_FIELDS: string ids, and the score
+    fwd_offsets, fwd_targets   the children of every node, CSR-style
+    rev_offsets, rev_targets   the parents of every node
+    roots        the ids of the target nodes
+    name_order   the node ids sorted by (name, version) bytes
+
+like the frozen dep_node.CompactGraph:
+
+    children of node i = fwd_targets[fwd_offsets[i]:fwd_offsets[i+1]]
+    parents  of node i = rev_targets[rev_offsets[i]:rev_offsets[i+1]]
+
+Loading maps the file and casts the sections to memoryviews,
+it does not parse anything, the strings are decoded on access.
+'''
+
+import argparse, logging
+import textwrap
+import fnmatch
+import mmap
+import os
+import struct
+from array import array
+from collections import deque
+from os.path import dirname
+
+import run_stats
+from dep_node import CompactGraph, number_nodes
+from versions import parse_range, version_key
+
+MAGIC = b'DEPGRAPH'
+SNAPSHOT_FORMAT = 2
+BYTE_ORDER_MARK = 0x01020304
+
+SECTIONS = ('string_offsets', 'strings', 'nodes', 'fwd_offsets', 'fwd_targets',
+            'rev_offsets', 'rev_targets', 'roots', 'name_order')
+NODE_FIELDS = ('name', 'version', 'hashes', 'soname', 'rpath', 'full_path', 'signature', 'score')
+# hashes and rpath are joined with ':',
+# signature is the stat signature of full_path when it was read, see host_scan
+
+HEADER = struct.Struct('=8sIIIIII' + 'Q' * len(SECTIONS))
+# magic, format, byte order mark, n_nodes, n_edges, n_roots, n_strings, section offsets
+
+QUERIES = ('info', 'closure', 'rdeps', 'needs', 'select')
+
+class SnapshotError(Exception):
+    pass
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+def _encode(string):
+    return string.encode('utf-8', 'surrogateescape')
+
+def graph_arrays(roots, accumulated, signatures=None):
+    '''
+    graph_arrays(roots, accumulated, signatures=None) -> (strings, nodes, edge_src, edge_dst, root_ids)
+
+    The nodes numbered by dep_node.number_nodes, their fields
+    with the strings interned into the pool, and the edges.
+    '''
+
+    signatures = signatures or {}
+    strings = {}
+    def string_id(string):
+        return strings.setdefault(string, len(strings))
+
+    node_list, scores, children, root_ids = number_nodes(roots, accumulated)
+
+    nodes = array('i')
+    for node, score in zip(node_list, scores):
+        name, version, hashes = node.full_definition
+        value = node.value
+        nodes.extend((string_id(name), string_id(version), string_id(':'.join(sorted(hashes))),
+                      string_id(value['soname']), string_id(':'.join(value['rpath'])),
+                      string_id(value['full_path']), string_id(signatures.get(value['full_path'], '')), score))
+
+    edge_src, edge_dst = array('i'), array('i')
+    for node_id, child_ids in enumerate(children):
+        for child_id in child_ids:
+            edge_src.append(node_id)
+            edge_dst.append(child_id)
+
+    return list(strings), nodes, edge_src, edge_dst, array('i', root_ids)
+
+def write_snapshot(filename, roots, accumulated, signatures=None):
+    '''
+    write_snapshot(filename, roots, accumulated, signatures=None) -> the number of nodes
+
+    Save the graph of all_deps.targets_to_graph, DepNode-s or CompactGraph views,
+    and the {full_path: stat signature} of the files if they are known.
+    '''
+
+    return write_arrays(filename, *graph_arrays(roots, accumulated, signatures))
+
+def write_arrays(filename, strings, nodes, edge_src, edge_dst, root_ids):
+    '''
+    write_arrays(filename, strings, nodes, edge_src, edge_dst, root_ids) -> the number of nodes
+
+    Save the arrays of graph_arrays, or of a graph patched without DepNode-s (see host_scan).
+    The file is written to a temp file and renamed over, atomically.
+    '''
+
+    n_nodes = len(nodes) // len(NODE_FIELDS)
+
+    string_offsets = array('i', [0])
+    encoded = [_encode(s) for s in strings]
+    for data in encoded:
+        string_offsets.append(string_offsets[-1] + len(data))
+
+    fwd_offsets, fwd_targets = CompactGraph._csr(n_nodes, edge_src, edge_dst)
+    rev_offsets, rev_targets = CompactGraph._csr(n_nodes, edge_dst, edge_src)
+
+    fields = len(NODE_FIELDS)
+    name_order = array('i', sorted(range(n_nodes), key=lambda i: (encoded[nodes[i * fields]], encoded[nodes[i * fields + 1]])))
+
+    sections = {
+        'string_offsets': string_offsets.tobytes(),
+        'strings': b''.join(encoded),
+        'nodes': nodes.tobytes(),
+        'fwd_offsets': fwd_offsets.tobytes(),
+        'fwd_targets': fwd_targets.tobytes(),
+        'rev_offsets': rev_offsets.tobytes(),
+        'rev_targets': rev_targets.tobytes(),
+        'roots': root_ids.tobytes(),
+        'name_order': name_order.tobytes(),
+    }
+
+    offsets = []
+    offset = HEADER.size
+    for section in SECTIONS:
+        offset = _align(offset)
+        offsets.append(offset)
+        offset += len(sections[section])
+
+    header = HEADER.pack(MAGIC, SNAPSHOT_FORMAT, BYTE_ORDER_MARK, n_nodes, len(edge_src), len(root_ids), len(strings), *offsets)
+
+    os.makedirs(dirname(filename) or '.', exist_ok=True)
+    tempname = f'{filename}.{os.getpid()}.tmp'
+    try:
+        with open(tempname, 'wb') as f:
+            f.write(header)
+            for section, offset in zip(SECTIONS, offsets):
+                f.write(b'\0' * (offset - f.tell()))
+                f.write(sections[section])
+        os.replace(tempname, filename)
+
+    except BaseException:
+        if os.path.exists(tempname):
+            os.unlink(tempname)
+        raise
+
+    logging.debug(f'write_arrays: {n_nodes} nodes, {len(edge_src)} edges, {len(strings)} strings to {filename}')
+    return n_nodes
+
+class GraphSnapshot:
+    '''
+    A read-only graph over a mapped snapshot file.
+    The nodes are integer ids, see the module docstring for the layout.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                raise SnapshotError(f'{filename}: an empty file') from e
+
+        if len(self._map) < HEADER.size:
+            raise SnapshotError(f'{filename}: not a graph snapshot')
+
+        magic, snapshot_format, bom, self.n_nodes, self.n_edges, self.n_roots, self.n_strings, *offsets = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise SnapshotError(f'{filename}: not a graph snapshot')
+        if snapshot_format != SNAPSHOT_FORMAT or bom != BYTE_ORDER_MARK:
+            raise SnapshotError(f'{filename}: snapshot format {snapshot_format}, byte order {bom:#x}, expected {SNAPSHOT_FORMAT}')
+
+        lengths = {
+            'string_offsets': self.n_strings + 1,
+            'nodes': self.n_nodes * len(NODE_FIELDS),
+            'fwd_offsets': self.n_nodes + 1,
+            'fwd_targets': self.n_edges,
+            'rev_offsets': self.n_nodes + 1,
+            'rev_targets': self.n_edges,
+            'roots': self.n_roots,
+            'name_order': self.n_nodes,
+        }
+
+        view = memoryview(self._map)
+        for section, offset in zip(SECTIONS, offsets):
+            if section == 'strings':
+                continue
+            end = offset + 4 * lengths[section]
+            if end > len(self._map):
+                raise SnapshotError(f'{filename}: truncated {section}')
+            setattr(self, section, view[offset:end].cast('i'))
+
+        strings_offset = offsets[SECTIONS.index('strings')]
+        self.strings = view[strings_offset:strings_offset + self.string_offsets[-1]]
+        self._fields = {field: i for i, field in enumerate(NODE_FIELDS)}
+
+    def __len__(self):
+        return self.n_nodes
+
+    def close(self):
+        for section in SECTIONS:
+            getattr(self, section).release()
+        self._map.close()
+
+    def string_bytes(self, string_id):
+        return self.strings[self.string_offsets[string_id]:self.string_offsets[string_id + 1]]
+
+    def string(self, string_id):
+        return bytes(self.string_bytes(string_id)).decode('utf-8', 'surrogateescape')
+
+    def field(self, node_id, field):
+        value = self.nodes[node_id * len(NODE_FIELDS) + self._fields[field]]
+        return value if field == 'score' else self.string(value)
+
+    def name(self, node_id):
+        return self.field(node_id, 'name')
+
+    def version(self, node_id):
+        return self.field(node_id, 'version')
+
+    def definition_str(self, node_id):
+        '''name,version,hashes -- the format of ./all_deps.py -n'''
+        return ','.join(self.field(node_id, field) for field in ('name', 'version', 'hashes'))
+
+    def record(self, node_id):
+        record = {field: self.field(node_id, field) for field in NODE_FIELDS}
+        record['hashes'] = record['hashes'].split(':') if record['hashes'] else []
+        record['rpath'] = record['rpath'].split(':') if record['rpath'] else []
+        return record
+
+    def children_ids(self, node_id):
+        return self.fwd_targets[self.fwd_offsets[node_id]:self.fwd_offsets[node_id + 1]]
+
+    def parents_ids(self, node_id):
+        return self.rev_targets[self.rev_offsets[node_id]:self.rev_offsets[node_id + 1]]
+
+    def _name_bytes(self, node_id):
+        return bytes(self.string_bytes(self.nodes[node_id * len(NODE_FIELDS)]))
+
+    def find(self, name):
+        '''the ids of the nodes with the name, sorted by version: two binary searches over name_order'''
+        key = _encode(name)
+
+        low, high = 0, self.n_nodes
+        while low < high:
+            mid = (low + high) // 2
+            if self._name_bytes(self.name_order[mid]) < key:
+                low = mid + 1
+            else:
+                high = mid
+        start = low
+
+        high = self.n_nodes
+        while low < high:
+            mid = (low + high) // 2
+            if self._name_bytes(self.name_order[mid]) <= key:
+                low = mid + 1
+            else:
+                high = mid
+
+        return sorted(self.name_order[start:low].tolist(), key=lambda i: version_key(self.version(i)))
+
+    def names(self):
+        '''the distinct node names, sorted'''
+        previous = None
+        for node_id in self.name_order:
+            name = self._name_bytes(node_id)
+            if name != previous:
+                previous = name
+                yield name.decode('utf-8', 'surrogateescape')
+
+    def match(self, pattern):
+        '''the ids of the nodes whose name matches the pattern, or the name itself'''
+        if not any(ch in pattern for ch in '*?['):
+            return self.find(pattern)
+        return [node_id for name in fnmatch.filter(self.names(), pattern) for node_id in self.find(name)]
+
+    def closure(self, node_ids, reverse=False):
+        '''
+        closure(node_ids, reverse=False) -> [node_id, ...]
+
+        The nodes reachable from node_ids, themselves included, breadth-first.
+        reverse=True follows the parents: everything that depends on them.
+        '''
+
+        offsets, targets = (self.rev_offsets, self.rev_targets) if reverse else (self.fwd_offsets, self.fwd_targets)
+
+        seen = bytearray(self.n_nodes)
+        order = []
+        queue = deque()
+        for node_id in node_ids:
+            if not seen[node_id]:
+                seen[node_id] = 1
+                queue.append(node_id)
+
+        while queue:
+            node_id = queue.popleft()
+            order.append(node_id)
+            for target in targets[offsets[node_id]:offsets[node_id + 1]]:
+                if not seen[target]:
+                    seen[target] = 1
+                    queue.append(target)
+
+        return order
+
+    def dependents(self, node_ids, direct=False):
+        '''the nodes that need node_ids, directly or transitively'''
+        if direct:
+            return sorted({parent for node_id in node_ids for parent in self.parents_ids(node_id)})
+        start = set(node_ids)
+        return [node_id for node_id in self.closure(node_ids, reverse=True) if node_id not in start]
+
+    def roots_reaching(self, node_ids):
+        '''the roots (the targets of the snapshot) that pull in any of node_ids'''
+        reaching = set(self.closure(node_ids, reverse=True))
+        return [root for root in self.roots if root in reaching]
+
+    def who_needs(self, name, constraint=''):
+        '''
+        who_needs(name, constraint='') -> {node_id of a version: [root id, ...]}
+
+        The versions of <name> (a glob pattern, see match) that satisfy
+        the constraint (see versions.py), and the roots that pull in each of them.
+        '''
+
+        version_range = parse_range(constraint)
+        return {node_id: self.roots_reaching([node_id])
+                for node_id in self.match(name) if version_range.contains(self.version(node_id))}
+
+    def info(self):
+        return {'nodes': self.n_nodes, 'edges': self.n_edges, 'roots': self.n_roots,
+                'strings': self.n_strings, 'bytes': len(self._map)}
+
+def open_snapshot(filename):
+    with run_stats.timer('snapshot.load'):
+        return GraphSnapshot(filename)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+            formatter_class = argparse.RawDescriptionHelpFormatter,
+            description = textwrap.dedent("""Query a dependency graph snapshot saved by ./all_deps.py --snapshot"""),
+            epilog = textwrap.dedent("""
+            Queries:
+            info                     the sizes of the snapshot
+            closure NAME...          everything the nodes need, transitively
+            rdeps NAME...            everything that needs the nodes (--direct: the parents only, --roots: the targets only)
+            needs NAME [VERSION]     the targets that pull in the versions of NAME in the VERSION constraint
+            select SELECTOR...       the nodes that match the selectors of graph_select.py
+
+            The names can be glob patterns.
+
+            Example:
+            ./all_deps.py --snapshot temp/host.graph curl ssh ls
+            ./graph_snapshot.py temp/host.graph rdeps --roots libssl.so.3
+            ./graph_snapshot.py temp/host.graph needs libssl.so.3 '>=libssl.so.3.0.2'
+            ./graph_snapshot.py -p temp/host.graph closure 'libgtk*'
+            ./graph_snapshot.py temp/host.graph select 'libgtk*>libglib*'
+            """)
+            )
+
+    parser.add_argument("snapshot", type=str, help="the snapshot file")
+    parser.add_argument("query",    choices=QUERIES, help="the query")
+    parser.add_argument("args",     nargs='*', help="the names, NAME VERSION for needs, or the selectors")
+    parser.add_argument("--direct", action='store_true', help="rdeps: only the direct parents")
+    parser.add_argument("--roots",  action='store_true', help="rdeps: only the targets of the snapshot")
+    parser.add_argument("-p", "--print-filenames", action='store_true', help="print the full paths instead of the definitions")
+    run_stats.add_stats_arguments(parser)
+    parser.add_argument("-d", "--debug", action='store_true', help="DEBUG logging")
+
+    args = parser.parse_intermixed_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    run_stats.start(args)
+
+    try:
+        snapshot = open_snapshot(args.snapshot)
+    except (OSError, SnapshotError) as e:
+        logging.error(f'graph_snapshot: {e}')
+        raise SystemExit(1)
+
+    def show(node_id):
+        return snapshot.field(node_id, 'full_path') if args.print_filenames else snapshot.definition_str(node_id)
+
+    if args.query != 'info' and not args.args:
+        parser.error(f'{args.query} needs a name')
+
+    with run_stats.timer('snapshot.query'):
+        if args.query == 'info':
+            for key, value in snapshot.info().items():
+                print(f'{key:10} {value}')
+
+        elif args.query == 'needs':
+            if len(args.args) > 2:
+                parser.error('needs NAME [VERSION]')
+            name, constraint = args.args[0], (args.args[1] if len(args.args) > 1 else '')
+            needed = snapshot.who_needs(name, constraint)
+            if not needed:
+                logging.warning(f'graph_snapshot: no nodes match {" ".join(args.args)}')
+            for node_id, root_ids in needed.items():
+                print(f'{show(node_id)}: {" ".join(show(root) for root in root_ids)}')
+
+        elif args.query == 'select':
+            from graph_select import SelectorIndex
+
+            index = SelectorIndex.from_snapshot(snapshot)
+            for selector in args.args:
+                for node_id in index.select(selector):
+                    print(show(node_id))
+
+        else:
+            node_ids = [node_id for pattern in args.args for node_id in snapshot.match(pattern)]
+            if not node_ids:
+                logging.warning(f'graph_snapshot: no nodes match {" ".join(args.args)}')
+
+            if args.query == 'closure':
+                result = snapshot.closure(node_ids)
+            elif args.roots:
+                result = snapshot.roots_reaching(node_ids)
+            else:
+                result = snapshot.dependents(node_ids, args.direct)
+
+            for node_id in result:
+                print(show(node_id))
@@ -0,0 +1,396 @@
+#!/usr/bin/python3
+'''
+Whole-host scan: the dependency graph of every ELF executable under
+the directories of $PATH and /opt, saved as a graph snapshot.
+
+    ./host_scan.py -o temp/host.graph -j 8
+    ./host_scan.py -o temp/host.graph -j 8 --rescan
+    ./graph_snapshot.py temp/host.graph rdeps --roots libssl.so.3
+
+The directories are walked with os.scandir, the ELF files are told by
+their magic number, each physical file is taken once, and all targets
+share one accumulated graph.
+
+With --rescan the previous snapshot is patched, the graph is not built again:
+a node whose file did not change (the stat signature, see elf_cache) keeps
+its record and its edges without reading the file. The changed files are
+read as new nodes, their unchanged parents resolve their dependencies again
+(the dependency may be gone, or have another version now), the new targets
+are read with the new files they reach, and the nodes that no target reaches
+any more are dropped.
+The resolution of the unchanged files is trusted: a library installed
+later, earlier in the search order, is noticed when the file changes,
+or on a full scan.
+
+The files that cannot be read are logged and left out,
+with the targets that depend on them.
+'''
+
+import argparse, logging
+import textwrap
+import os
+from collections import deque
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from os.path import basename, realpath
+
+import all_deps
+import elf_cache
+import elf_dynamic
+import run_stats
+from elf_cache import stat_signature
+from graph_snapshot import open_snapshot, write_snapshot, write_arrays, SnapshotError, NODE_FIELDS
+
+ELF_MAGIC = b'\x7fELF'
+EXECUTABLE_BITS = 0o111
+
+def default_scan_dirs():
+    '''the directories of $PATH, and /opt'''
+    return [d for d in os.environ.get('PATH', '').split(':') if d] + ['/opt']
+
+def is_elf(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(ELF_MAGIC)) == ELF_MAGIC
+    except OSError:
+        return False
+
+def walk_elf_files(dirs, executables_only=True, known=None):
+    '''
+    walk_elf_files(dirs, executables_only=True, known=None) -> [(path, signature), ...]
+
+    The ELF files under the directories, each physical file once,
+    by the first path it is found at. The subdirectories are walked,
+    the symlinks to directories are not followed, the symlinks to files are.
+    The files in known = {path: signature} with the same signature
+    are not opened for the magic number again.
+    '''
+
+    seen_dirs = set()
+    seen_files = set()
+    found = []
+
+    stack = list(reversed(dirs))
+    while stack:
+        directory = stack.pop()
+        try:
+            st = os.stat(directory)
+            if (st.st_dev, st.st_ino) in seen_dirs:
+                continue
+            seen_dirs.add((st.st_dev, st.st_ino))
+
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+
+        except OSError as e:
+            logging.debug(f'walk_elf_files: skip {directory}: {e}')
+            continue
+
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+
+            except OSError:
+                continue
+
+            if executables_only and not st.st_mode & EXECUTABLE_BITS:
+                continue
+            if (st.st_dev, st.st_ino) in seen_files:
+                continue
+            seen_files.add((st.st_dev, st.st_ino))
+
+            signature = stat_signature(st)
+            if (known is None or known.get(entry.path) != signature) and not is_elf(entry.path):
+                continue
+
+            found.append((entry.path, signature))
+
+        stack.extend(reversed(subdirs))
+
+    return found
+
+def _current_signature(path):
+    try:
+        return stat_signature(os.stat(path))
+    except OSError:
+        return None
+
+def failed_targets(targets, visits, failed):
+    '''the targets that reach a file that could not be read'''
+    parents = {}
+    for filename, visit in visits.items():
+        for dep_filename in visit.dependencies:
+            parents.setdefault(dep_filename, []).append(filename)
+
+    bad = set(failed)
+    queue = deque(failed)
+    while queue:
+        for parent in parents.get(queue.popleft(), ()):
+            if parent not in bad:
+                bad.add(parent)
+                queue.append(parent)
+
+    return [target for target in targets if target in bad]
+
+def scan_host(dirs, jobs=1, compact=True):
+    '''
+    scan_host(dirs, jobs=1, compact=True) -> (roots, accumulated, signatures)
+
+    The graph of all ELF executables under dirs, and the stat signatures
+    {full_path: signature} of the files, for write_snapshot.
+    '''
+
+    with run_stats.timer('scan.walk'):
+        targets = [path for path, _ in walk_elf_files(dirs)]
+    run_stats.count('scan.targets', len(targets))
+
+    failed = []
+    def on_error(filename, e):
+        logging.warning(f'scan_host: cannot read {filename}: {e}')
+        failed.append(filename)
+
+    with run_stats.timer('scan.read'):
+        visits = all_deps.scan_files(targets, jobs, on_error)
+
+    if failed:
+        left_out = set(failed_targets(targets, visits, failed))
+        targets = [target for target in targets if target not in left_out]
+        run_stats.count('scan.failed', len(failed))
+
+    with run_stats.timer('scan.graph'):
+        roots, accumulated = all_deps.build_graph(targets, visits, compact=compact)
+
+    logging.info(f'scan_host: {len(targets)} targets, {len(visits)} files, {len(failed)} failed')
+    return roots, accumulated, {filename: visit.signature for filename, visit in visits.items()}
+
+def _visit(filename):
+    try:
+        return all_deps.visit_file(filename), None
+    except Exception as e:
+        return None, e
+
+def rescan_host(dirs, previous, jobs=1):
+    '''
+    rescan_host(dirs, previous, jobs=1) -> (strings, nodes, edge_src, edge_dst, root_ids) for write_arrays
+
+    Patch the GraphSnapshot <previous> of an earlier scan (see the module docstring).
+    The node ids of the snapshot are kept for the kept nodes, the new nodes
+    get the next ids, then the dropped nodes are squeezed out.
+    The scores are counted again from the edges, as a full scan counts them:
+    one per target and one per reference of a parent.
+    '''
+
+    n_old = len(previous)
+    paths = [previous.field(node_id, 'full_path') for node_id in range(n_old)]
+    with run_stats.timer('scan.stat'), ThreadPoolExecutor(max_workers=jobs) as pool:
+        signatures = list(pool.map(_current_signature, paths, chunksize=256))
+
+    changed = bytearray(signature is None or signature != previous.field(node_id, 'signature')
+                        for node_id, signature in enumerate(signatures))
+    relinked = [node_id for node_id in range(n_old)
+                if not changed[node_id] and any(changed[child] for child in previous.children_ids(node_id))]
+    run_stats.count('scan.changed', sum(changed))
+    run_stats.count('scan.relinked', len(relinked))
+
+    # the node ids by definition (name, version, hashes) and by the path they were read from
+    ids = {}
+    node_paths = {}
+    for node_id in range(n_old):
+        if not changed[node_id]:
+            ids[(previous.name(node_id), previous.version(node_id), previous.field(node_id, 'hashes'))] = node_id
+            node_paths[paths[node_id]] = node_id
+    n_ids = n_old
+
+    path_keys = {}
+    def definition(path):
+        key = path_keys.get(path)
+        if key is None:
+            node_id = node_paths.get(path)
+            if node_id is not None:
+                key = (previous.name(node_id), previous.version(node_id), previous.field(node_id, 'hashes'))
+            else:
+                _, version = all_deps.file_version(path)
+                key = (basename(path), version, '')
+            path_keys[path] = key
+        return key
+
+    new_paths = {}   # {node id: the path a new node is read from}
+    def node_of(path):
+        '''the node id of the file, and whether it is a new node to read'''
+        nonlocal n_ids
+        key = definition(path)
+        node_id = ids.get(key)
+        if node_id is not None:
+            return node_id, False
+        node_id = ids[key] = n_ids
+        n_ids += 1
+        new_paths[node_id] = path
+        return node_id, True
+
+    with run_stats.timer('scan.walk'):
+        targets = [path for path, _ in walk_elf_files(dirs, known={paths[i]: signatures[i] for i in range(n_old) if not changed[i]})]
+    run_stats.count('scan.targets', len(targets))
+
+    frontier = [(node_id, paths[node_id]) for node_id in relinked]
+    root_ids = []
+    for target in targets:
+        node_id, new = node_of(target)
+        root_ids.append(node_id)
+        if new:
+            frontier.append((node_id, target))
+
+    # read the new files and resolve the relinked ones, a frontier at a time
+    visits = {}      # {node id: FileVisit}
+    failed = set()
+    with run_stats.timer('scan.read'), ThreadPoolExecutor(max_workers=jobs) as pool:
+        while frontier:
+            filenames = [path for _, path in frontier]
+            all_deps.read_physical_files(pool.map(realpath, filenames), jobs)
+
+            next_frontier = []
+            for (node_id, path), (visit, error) in zip(frontier, pool.map(_visit, filenames)):
+                if error is not None:
+                    logging.warning(f'rescan_host: cannot read {path}: {error}')
+                    failed.add(node_id)
+                    continue
+
+                visits[node_id] = visit
+                for dep_filename in visit.dependencies:
+                    dep_id, new = node_of(dep_filename)
+                    if new:
+                        next_frontier.append((dep_id, dep_filename))
+
+            frontier = next_frontier
+
+    def children(node_id):
+        visit = visits.get(node_id)
+        if visit is None:
+            return previous.children_ids(node_id)
+        return [ids[definition(dep_filename)] for dep_filename in visit.dependencies]
+
+    live = [node_id for node_id in range(n_old) if not changed[node_id]] + [node_id for node_id in new_paths if node_id not in failed]
+    edges = {node_id: children(node_id) for node_id in live}
+
+    # the targets that reach a file that could not be read are left out, as in scan_host
+    if failed:
+        parents = {}
+        for node_id, child_ids in edges.items():
+            for child_id in child_ids:
+                parents.setdefault(child_id, []).append(node_id)
+        bad = set(failed)
+        queue = deque(failed)
+        while queue:
+            for parent_id in parents.get(queue.popleft(), ()):
+                if parent_id not in bad:
+                    bad.add(parent_id)
+                    queue.append(parent_id)
+        root_ids = [node_id for node_id in root_ids if node_id not in bad]
+        run_stats.count('scan.failed', len(failed))
+
+    # the nodes the targets still reach, in the order of their ids
+    reached = set(root_ids)
+    queue = deque(reached)
+    while queue:
+        for child_id in edges[queue.popleft()]:
+            if child_id not in reached:
+                reached.add(child_id)
+                queue.append(child_id)
+    order = sorted(reached)
+    renumber = {node_id: i for i, node_id in enumerate(order)}
+    run_stats.count('scan.dropped', len(live) - len(order))
+
+    scores = array('i', bytes(4 * len(order)))
+    for node_id in root_ids:
+        scores[renumber[node_id]] += 1
+
+    strings = {}
+    def string_id(string):
+        return strings.setdefault(string, len(strings))
+
+    nodes = array('i')
+    edge_src, edge_dst = array('i'), array('i')
+    for i, node_id in enumerate(order):
+        if node_id < n_old:
+            record = [previous.field(node_id, field) for field in NODE_FIELDS[:-1]]
+        else:
+            visit = visits[node_id]
+            name, version, hashes = definition(new_paths[node_id])
+            record = [name, version, hashes, visit.soname, ':'.join(visit.runpath), new_paths[node_id], visit.signature]
+
+        child_ids = sorted(renumber[child_id] for child_id in edges[node_id])
+        for child_id in child_ids:
+            edge_src.append(i)
+            edge_dst.append(child_id)
+            scores[child_id] += 1
+
+        nodes.extend(string_id(string) for string in record)
+        nodes.append(0)
+
+    score_column = len(NODE_FIELDS) - 1
+    for i, score in enumerate(scores):
+        nodes[i * len(NODE_FIELDS) + score_column] = score
+
+    logging.info(f'rescan_host: {len(root_ids)} targets, {len(order)} nodes, {sum(changed)} changed, '
+                 f'{len(relinked)} relinked, {len(new_paths)} read, {len(failed)} failed')
+    return list(strings), nodes, edge_src, edge_dst, array('i', [renumber[node_id] for node_id in root_ids])
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+            formatter_class = argparse.RawDescriptionHelpFormatter,
+            description = textwrap.dedent("""Scan every ELF executable on the host into one dependency graph snapshot"""),
+            epilog = textwrap.dedent("""
+            Example:
+            ./host_scan.py -o temp/host.graph -j 8
+            ./host_scan.py -o temp/host.graph -j 8 --rescan --stats
+            ./host_scan.py -o temp/opt.graph /opt /usr/local/bin
+            ./graph_snapshot.py temp/host.graph needs libssl.so.3
+            """)
+            )
+
+    parser.add_argument("dirs", nargs='*', help="the directories to scan (default: $PATH and /opt)")
+    parser.add_argument("-o", "--output", type=str, required=True, help="the snapshot file to write")
+    parser.add_argument("--rescan", action='store_true', help="start from the --output snapshot of an earlier scan, read only the changed files")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="read the files on N threads, parse the large batches of files on N processes (default: %(default)s)")
+    parser.add_argument("--elf-backend", choices=elf_dynamic.BACKENDS, default=elf_dynamic.backend,
+                        help="how to read the dynamic section of ELF files (default: %(default)s)")
+    elf_cache.add_cache_arguments(parser)
+    run_stats.add_stats_arguments(parser)
+    parser.add_argument("-d", "--debug", action='store_true', help="DEBUG logging")
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    elf_dynamic.backend = args.elf_backend
+    elf_cache.open_cache(args.cache, args.cache_file)
+    run_stats.start(args)
+
+    previous = None
+    if args.rescan:
+        try:
+            previous = open_snapshot(args.output)
+        except (OSError, SnapshotError) as e:
+            logging.warning(f'host_scan: no previous snapshot, a full scan: {e}')
+
+    dirs = args.dirs or default_scan_dirs()
+    if previous is not None:
+        with run_stats.timer('phase.scan'):
+            arrays = rescan_host(dirs, previous, args.jobs)
+        with run_stats.timer('phase.snapshot'):
+            write_arrays(args.output, *arrays)
+
+    else:
+        with run_stats.timer('phase.scan'):
+            roots, accumulated, signatures = scan_host(dirs, args.jobs)
+        with run_stats.timer('phase.snapshot'):
+            write_snapshot(args.output, roots, accumulated, signatures)
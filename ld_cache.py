@@ -0,0 +1,181 @@
+'''
+Reader of /etc/ld.so.cache, the cache that ld.so resolves most libraries with.
+
+Both formats written by ldconfig are supported:
+
+    old: "ld.so-1.7.0", nlibs, entries {int32 flags, uint32 key, uint32 value},
+         the strings follow the entries, offsets are relative to them
+    new: "glibc-ld.so.cache" "1.1", nlibs, len_strings, flags, extension_offset,
+         entries {int32 flags, uint32 key, uint32 value, uint32 osversion, uint64 hwcap},
+         offsets are relative to the start of the new header
+
+The old format may be followed by the new one (the "compat" layout),
+then the new one is used.
+
+The cache is loaded once into a {soname: path} dict with only the entries
+the loader of this machine would accept: the right libc6 ABI flags, and for
+the glibc-hwcaps entries only the subdirectories the CPU supports, the best first.
+'''
+
+import logging
+import struct
+import sys
+
+OLD_MAGIC = b'ld.so-1.7.0'
+NEW_MAGIC = b'glibc-ld.so.cache1.1'
+
+FLAG_ELF_LIBC6 = 0x0003
+FLAG_TYPE_MASK = 0x00ff
+
+# _DL_CACHE_DEFAULT_ID of the 64-bit (or the only) ABI per `uname -m`
+CACHE_DEFAULT_ID = {
+    'x86_64':  0x0303,
+    'aarch64': 0x0a03,
+    'ppc64':   0x0503,
+    'ppc64le': 0x0503,
+    's390x':   0x0403,
+    'sparc64': 0x0103,
+    'ia64':    0x0203,
+    'i386':    FLAG_ELF_LIBC6,
+    'i686':    FLAG_ELF_LIBC6,
+}
+
+class LdCacheFormatError(Exception):
+    pass
+
+def _strings(buf, base):
+    def string(offset):
+        start = base + offset
+        end = buf.find(b'\0', start)
+        if start >= len(buf) or end < 0:
+            raise LdCacheFormatError(f'string offset {offset} is out of the cache')
+        return buf[start:end].decode(errors='surrogateescape')
+    return string
+
+def _parse_new(buf, start):
+    '''[(flags, key, value), ...] of the new format header at <start>'''
+
+    if len(buf) < start + 48:
+        raise LdCacheFormatError('truncated new format header')
+
+    # the byte order is recorded in the flags: 2 little, 3 big, 0 not recorded
+    order = {2: '<', 3: '>'}.get(buf[start + 28] & 3, '<' if sys.byteorder == 'little' else '>')
+    nlibs, _ = struct.unpack_from(order + 'II', buf, start + 20)
+
+    entry = struct.Struct(order + 'iIIIQ')
+    entries_start = start + 48
+    if entries_start + nlibs * entry.size > len(buf):
+        raise LdCacheFormatError('truncated new format entries')
+
+    string = _strings(buf, start)
+    entries = []
+    for i in range(nlibs):
+        flags, key, value, _, _ = entry.unpack_from(buf, entries_start + i * entry.size)
+        entries.append((flags, string(key), string(value)))
+
+    return entries
+
+def _parse_old(buf):
+    '''
+    [(flags, key, value), ...] of the old format,
+    or of the new format if it follows the old one
+    '''
+
+    nlibs, = struct.unpack_from('=I', buf, 12)
+    entry = struct.Struct('=iII')
+    entries_end = 16 + nlibs * entry.size
+    if entries_end > len(buf):
+        raise LdCacheFormatError('truncated old format entries')
+
+    # the compat layout: the new format at the next 8-byte boundary
+    new_start = (entries_end + 7) & ~7
+    if buf[new_start:new_start + len(NEW_MAGIC)] == NEW_MAGIC:
+        return _parse_new(buf, new_start)
+
+    string = _strings(buf, entries_end)
+    entries = []
+    for i in range(nlibs):
+        flags, key, value = entry.unpack_from(buf, 16 + i * entry.size)
+        entries.append((flags, string(key), string(value)))
+
+    return entries
+
+def parse_ld_so_cache(buf):
+    '''
+    parse_ld_so_cache(buf) -> [(flags, soname, path), ...] in the cache order
+    '''
+
+    try:
+        if buf.startswith(NEW_MAGIC):
+            return _parse_new(buf, 0)
+
+        if buf.startswith(OLD_MAGIC):
+            return _parse_old(buf)
+
+    except struct.error as e:
+        raise LdCacheFormatError('truncated ld.so.cache') from e
+
+    raise LdCacheFormatError('not an ld.so.cache file')
+
+def hwcaps_rank(path, hwcaps):
+    '''
+    0, 1, ... for the supported glibc-hwcaps subdirectories (the best first),
+    len(hwcaps) for the baseline directories,
+    None for the unsupported subdirectories
+    '''
+
+    if '/glibc-hwcaps/' not in path:
+        return len(hwcaps)
+
+    for rank, subdir in enumerate(hwcaps):
+        if f'/{subdir}/' in path:
+            return rank
+
+    return None
+
+def cache_dict(entries, machine, hwcaps=()):
+    '''
+    cache_dict(entries, machine, hwcaps=()) -> {soname: path}
+
+    What the loader would pick for each soname.
+    '''
+
+    default_id = CACHE_DEFAULT_ID.get(machine)
+
+    best = {}
+    for flags, soname, path in entries:
+        if default_id is not None:
+            if flags != default_id:
+                continue
+        elif flags & FLAG_TYPE_MASK != FLAG_ELF_LIBC6:
+            continue
+
+        rank = hwcaps_rank(path, hwcaps)
+        if rank is None:
+            continue
+
+        # the first entry wins among equal ranks, as in the loader
+        if soname not in best or rank < best[soname][0]:
+            best[soname] = (rank, path)
+
+    return {soname: path for soname, (_, path) in best.items()}
+
+def load_ld_so_cache(machine, hwcaps=(), filename='/etc/ld.so.cache'):
+    '''
+    load_ld_so_cache(machine, hwcaps=(), filename='/etc/ld.so.cache') -> {soname: path} or None
+
+    None if there is no usable cache, then the caller falls back to ld.so.conf.
+    '''
+
+    try:
+        with open(filename, 'rb') as f:
+            buf = f.read()
+        return cache_dict(parse_ld_so_cache(buf), machine, hwcaps)
+
+    except OSError as e:
+        logging.debug(f'load_ld_so_cache: no {filename}: {e}')
+
+    except LdCacheFormatError as e:
+        logging.warning(f'load_ld_so_cache: cannot parse {filename}: {e}')
+
+    return None
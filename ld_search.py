@@ -0,0 +1,217 @@
+'''
+Library search for the dependency traversal, following the ld.so man page.
+
+Instead of probing `isfile(dir + "/" + so)` for every directory and every
+NEEDED entry, each search directory is listed once into a {name: DirEntry}
+index, and the lookups are memoized per (name, rpath, runpath).
+
+The search order of LibraryResolver.find:
+
+    1) DT_RPATH of the object, if it has no DT_RUNPATH
+    2) LD_LIBRARY_PATH
+    3) DT_RUNPATH of the object
+    4) the loader's /etc/ld.so.cache (see ld_cache),
+       or the directories from /etc/ld.so.conf (and its includes) if there is no cache
+    5) the default paths, /lib/, /usr/lib/ etc
+
+In every directory, the glibc-hwcaps subdirectories supported by the CPU
+are searched first, like glibc >= 2.33 does.
+
+Known simplification: ld.so also uses the DT_RPATH of the objects
+that loaded this one, here only the object's own DT_RPATH is used.
+'''
+
+import glob
+import logging
+import os
+import threading
+from os.path import dirname, isabs, isfile, join
+
+import run_stats
+
+# glibc-hwcaps subdirectories per machine, from the best to the baseline,
+# with the CPU flags they need (from /proc/cpuinfo)
+HWCAPS_LEVELS = {
+    'x86_64': [
+        ('x86-64-v4', {'avx512f', 'avx512bw', 'avx512cd', 'avx512dq', 'avx512vl'}),
+        ('x86-64-v3', {'avx', 'avx2', 'bmi1', 'bmi2', 'f16c', 'fma', 'abm', 'movbe', 'xsave'}),
+        ('x86-64-v2', {'cx16', 'lahf_lm', 'popcnt', 'sse4_1', 'sse4_2', 'ssse3'}),
+    ],
+}
+
+_dir_indexes = {}
+_dir_indexes_lock = threading.Lock()
+
+def list_dir(directory):
+    '''
+    list_dir(directory) -> {name: DirEntry}
+
+    Listed once per run. A missing directory is an empty index.
+    '''
+
+    index = _dir_indexes.get(directory)
+    if index is not None:
+        return index
+
+    try:
+        with os.scandir(directory) as entries:
+            index = {entry.name: entry for entry in entries}
+    except OSError:
+        index = {}
+
+    with _dir_indexes_lock:
+        return _dir_indexes.setdefault(directory, index)
+
+def find_so(so, paths):
+    '''
+    find_so(so, paths) -> p + "/" + so or None
+
+    The first directory in paths that has a file <so>.
+    '''
+
+    run_stats.count('find_so.calls')
+    for p in paths:
+        run_stats.count('find_so.probes')
+        entry = list_dir(p).get(so)
+        # DirEntry.is_file follows symlinks and caches the stat
+        if entry is not None and entry.is_file():
+            run_stats.count('find_so.hits')
+            return p + "/" + so
+
+    return None
+
+def read_ld_so_conf(filename='/etc/ld.so.conf', _seen=None):
+    '''
+    read_ld_so_conf(filename='/etc/ld.so.conf') -> [directory, ...]
+
+    Follows the `include` lines (with globs, relative to the file's directory),
+    skips comments and the `hwcap` lines.
+    '''
+
+    seen = set() if _seen is None else _seen
+    if filename in seen:
+        return []
+    seen.add(filename)
+
+    try:
+        with open(filename) as f:
+            lines = f.readlines()
+    except OSError:
+        return []
+
+    directories = []
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+
+        if line.startswith('include'):
+            for pattern in line.split()[1:]:
+                if not isabs(pattern):
+                    pattern = join(dirname(filename), pattern)
+                for included in sorted(glob.glob(pattern)):
+                    directories.extend(read_ld_so_conf(included, seen))
+
+        elif line.startswith('hwcap'):
+            continue
+
+        else:
+            # the old format allows "dir=type" and commas
+            for directory in line.replace(',', ' ').split():
+                directories.append(directory.split('=', 1)[0])
+
+    return list(dict.fromkeys(directories))
+
+def cpu_flags(cpuinfo='/proc/cpuinfo'):
+    try:
+        with open(cpuinfo) as f:
+            for line in f:
+                if line.startswith('flags'):
+                    return set(line.split(':', 1)[1].split())
+    except OSError:
+        pass
+
+    return set()
+
+def hwcaps_subdirs(machine):
+    '''
+    hwcaps_subdirs(machine) -> ['glibc-hwcaps/x86-64-v3', ...]
+
+    The supported levels, the best first.
+    '''
+
+    levels = HWCAPS_LEVELS.get(machine)
+    if not levels:
+        return []
+
+    flags = cpu_flags()
+    # the levels are cumulative: v3 requires v2 etc
+    supported = []
+    for level, level_flags in reversed(levels):
+        if not level_flags <= flags:
+            break
+        supported.append('glibc-hwcaps/' + level)
+
+    return supported[::-1]
+
+class LibraryResolver:
+    def __init__(self, ld_library_paths=(), conf_paths=(), default_paths=(), hwcaps=(), ld_cache=None):
+        self.hwcaps = list(hwcaps)
+        self.ld_cache = ld_cache
+        self.ld_library_paths = self.with_hwcaps(ld_library_paths)
+        self.conf_paths = self.with_hwcaps(conf_paths)
+        self.default_paths = self.with_hwcaps(default_paths)
+
+        self.memo = {}
+        self.lookups = 0
+
+    def with_hwcaps(self, paths):
+        expanded = []
+        for p in paths:
+            expanded.extend(p.rstrip('/') + '/' + subdir for subdir in self.hwcaps)
+            expanded.append(p)
+        return tuple(expanded)
+
+    def find(self, so, runpath=(), rpath=()):
+        '''
+        find(so, runpath=(), rpath=()) -> path or None
+
+        The path of the NEEDED <so> for an object with
+        the given (already $ORIGIN-expanded) RUNPATH and RPATH.
+        '''
+
+        runpath, rpath = tuple(runpath), tuple(rpath)
+        # DT_RPATH is ignored if there is DT_RUNPATH
+        if runpath:
+            rpath = ()
+
+        key = (so, rpath, runpath)
+        self.lookups += 1
+        run_stats.count('resolver.calls')
+        if key in self.memo:
+            run_stats.count('resolver.hits')
+            return self.memo[key]
+
+        path = (rpath and find_so(so, self.with_hwcaps(rpath))) \
+            or find_so(so, self.ld_library_paths) \
+            or (runpath and find_so(so, self.with_hwcaps(runpath))) \
+            or self.find_in_ld_cache(so) \
+            or find_so(so, self.default_paths) \
+            or None
+
+        self.memo[key] = path
+        logging.debug(f'LibraryResolver: {so} -> {path}')
+        return path
+
+    def find_in_ld_cache(self, so):
+        if self.ld_cache is None:
+            return find_so(so, self.conf_paths)
+
+        run_stats.count('ld_cache.calls')
+        path = self.ld_cache.get(so)
+        # a stale cache entry, the loader goes on to the default paths
+        if path is not None and isfile(path):
+            run_stats.count('ld_cache.hits')
+            return path
+
+        return None
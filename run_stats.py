@@ -0,0 +1,155 @@
+'''
+Counters and timers of a run, for the --stats option of the CLIs.
+
+The modules count events and time sections:
+
+    run_stats.count('find_so.probes')
+    with run_stats.timer('traverse'):
+        ...
+
+The counting is a no-op until enable() is called, so the hot paths
+do not pay for it in a normal run. At the end:
+
+    --stats                     a text report on stderr
+    --stats --stats-format json the same as one JSON object on stderr
+    --profile FILE              cProfile of the run, saved for pstats / snakeviz
+
+The spawns of the external tools are counted as spawn.<tool>,
+the rates are derived from the counters and the timers of the same prefix:
+
+    find_so.hits / find_so.calls          -> find_so.hit_rate
+    store.hash.bytes / the store.hash timer -> store.hash.MB_per_s
+'''
+
+import atexit
+import cProfile
+import json
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+STATS_FORMATS = ('text', 'json')
+
+# the external tools, reported even if they were never spawned
+SPAWNED_TOOLS = ('readelf', 'patchelf', 'sha256sum')
+
+enabled = False
+counters = Counter()
+timers = {}  # {name: [seconds, calls]}
+_lock = threading.Lock()
+
+def enable():
+    global enabled
+    enabled = True
+
+def count(name, n=1):
+    if enabled:
+        with _lock:
+            counters[name] += n
+
+def spawned(tool):
+    count('spawn.' + tool)
+
+@contextmanager
+def timer(name):
+    '''accumulate the time of the section, the sections can run on several threads'''
+    if not enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            total = timers.setdefault(name, [0.0, 0])
+            total[0] += elapsed
+            total[1] += 1
+
+def snapshot():
+    '''
+    snapshot() -> {'counters': {...}, 'timers': {name: {'seconds', 'calls'}}, 'rates': {...}}
+    '''
+
+    with _lock:
+        report_counters = {f'spawn.{tool}': 0 for tool in SPAWNED_TOOLS}
+        report_counters.update(counters)
+        report_timers = {name: {'seconds': seconds, 'calls': calls} for name, (seconds, calls) in timers.items()}
+
+    rates = {}
+    # the hit rates: <prefix>.hits of <prefix>.calls
+    for name, value in report_counters.items():
+        if name.endswith('.hits'):
+            prefix = name[:-len('.hits')]
+            calls = report_counters.get(prefix + '.calls')
+            if calls:
+                rates[prefix + '.hit_rate'] = value / calls
+
+    # the throughputs: <timer>.bytes over the seconds of <timer>
+    for name, value in report_counters.items():
+        if name.endswith('.bytes'):
+            timer_name = name[:-len('.bytes')]
+            seconds = report_timers.get(timer_name, {}).get('seconds')
+            if seconds:
+                rates[timer_name + '.MB_per_s'] = value / seconds / 1e6
+
+    return {'counters': dict(sorted(report_counters.items())),
+            'timers': dict(sorted(report_timers.items())),
+            'rates': dict(sorted(rates.items()))}
+
+def format_text(report):
+    lines = ['--- stats ---']
+    for name, value in report['counters'].items():
+        lines.append(f'{name:40} {value}')
+    for name, timing in report['timers'].items():
+        lines.append(f'{name:40} {timing["seconds"]:10.3f} s  {timing["calls"]} calls')
+    for name, value in report['rates'].items():
+        lines.append(f'{name:40} {value:10.3f}')
+    return '\n'.join(lines)
+
+def add_stats_arguments(parser):
+    '''
+    the command line options shared by the CLIs
+    '''
+
+    parser.add_argument("--stats", action='store_true', help="report the counters and the phase timings on stderr")
+    parser.add_argument("--stats-format", choices=STATS_FORMATS, default='text',
+                        help="the --stats report as text or json (default: %(default)s)")
+    parser.add_argument("--profile", type=str, default=None, metavar='FILE',
+                        help="save a cProfile of the run to FILE")
+
+def start(args):
+    '''
+    start(args)
+
+    Enable the counters for --stats, start the profiler for --profile,
+    the reports are written when the program exits.
+    '''
+
+    if args.stats:
+        enable()
+        atexit.register(report, args.stats_format)
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def save_profile():
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logging.info(f'run_stats: saved the profile to {args.profile}')
+
+        atexit.register(save_profile)
+
+def report(stats_format='text', file=None):
+    data = snapshot()
+    file = file or sys.stderr
+    if stats_format == 'json':
+        json.dump(data, file)
+        print(file=file)
+    else:
+        print(format_text(data), file=file)
@@ -5,23 +5,158 @@ preliminary functions to save binaries in the standard "binary store" format:
     store_dir/name/version/name,version,hash
 
     with RPATH=$ORIGIN/:$ORIGIN/name_deps/:$ORIGIN/common
+
+The RUNPATH is set in-process by elf_patch, patchelf is the fallback.
 '''
 
 import argparse, logging
 import textwrap
-from subprocess import check_output, CalledProcessError
+from subprocess import CalledProcessError
 import os
 from os import mkdir, makedirs
-from os.path import basename, isdir, isfile, realpath
-from shutil import copy2 #copyfile
-import logging
-from collections import UserDict
-
+from os.path import basename, dirname, isfile
+import fcntl
+import hashlib
+import mmap
+import shutil
+from shutil import copystat
+from tempfile import mkstemp
+from collections import UserDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import all_deps
+import elf_cache
+import elf_patch
+import env_dir
+import env_layout
+import run_stats
+import store_index
+from store_index import StoreEntry
+from versions import ANY_VERSION, is_range
+from elf_patch import ElfPatchError
+from tool_runner import run_tool, run_many
 from dep_node import DepNode, DepDefinition, str_to_def
-from all_deps import readelf_dynamic, add_to_accumulated_nodes, check_in_accumulated_nodes
+from all_deps import expand_origin, add_to_accumulated_nodes, check_in_accumulated_nodes, AccumulatedNodes
+
+
+# the precedence of the rules that match a binary, the most specific first
+RULE_HASH, RULE_VERSION, RULE_RANGE, RULE_ANY = range(4)
 
+def rule_level(rule_def):
+    '''
+    RULE_HASH    -- the rule pins hash tags
+    RULE_VERSION -- an exact version string
+    RULE_RANGE   -- a version range, like >=2.19,<3
+    RULE_ANY     -- any version: empty or "latest"
+    '''
+    if rule_def.hashes:
+        return RULE_HASH
+    if not is_range(rule_def.version):
+        return RULE_VERSION
+    if rule_def.version in ANY_VERSION:
+        return RULE_ANY
+    return RULE_RANGE
+
+class _NameRules:
+    '''the rules for one file name, indexed by the hash tags and the versions'''
+
+    __slots__ = ('by_hash', 'by_version', 'ranges', 'any', 'ordered')
+
+    def __init__(self):
+        self.by_hash = {}       # {hash: [rule_def, ...]}
+        self.by_version = {}    # {version: [rule_def, ...]}
+        self.ranges = []
+        self.any = []
+        self.ordered = None     # [rule_def, ...] by (level, position), made on demand
+
+    def add(self, rule_def):
+        level = rule_level(rule_def)
+        if level == RULE_HASH:
+            for hsh in rule_def.hashes:
+                self.by_hash.setdefault(hsh, []).append(rule_def)
+        elif level == RULE_VERSION:
+            self.by_version.setdefault(rule_def.version, []).append(rule_def)
+        elif level == RULE_RANGE:
+            self.ranges.append(rule_def)
+        else:
+            self.any.append(rule_def)
+        self.ordered = None
 
 class BinaryDefFile(UserDict):
+    '''
+    The environment rules {binary DepDefinition: {dep name: DepDefinition}}
+    with an index by the file name, the hash tags and the versions.
+
+    Of the rules that match a binary (same name, versions overlap, hash tags overlap)
+    the most specific one applies:
+
+        1) a rule with hash tags
+        2) a rule with the exact version
+        3) a rule with a version range
+        4) a rule for any version
+
+    and on the same level the rule that comes first in the file.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.index = {}     # {name: _NameRules}
+        self.position = {}  # {rule_def: the order it was added in}
+        super().__init__(*args, **kwargs)
+
+    def __setitem__(self, rule_def, rule):
+        assert isinstance(rule_def, DepDefinition)
+        if rule_def not in self.position:
+            self.position[rule_def] = len(self.position)
+            self.index.setdefault(rule_def.filename, _NameRules()).add(rule_def)
+        self.data[rule_def] = rule
+
+    def __delitem__(self, rule_def):
+        del self.data[rule_def]
+        del self.position[rule_def]
+        bucket = self.index[rule_def.filename] = _NameRules()
+        for other in sorted(self.position, key=self.position.get):
+            if other.filename == rule_def.filename:
+                bucket.add(other)
+
+    def find_rule(self, binary_def):
+        '''
+        find_rule(binary_def) -> the rule DepDefinition that applies to binary_def, or None
+        '''
+
+        bucket = self.index.get(binary_def.filename)
+        if bucket is None:
+            return None
+
+        first = self.position.get
+        version = binary_def.version
+
+        # a concrete file: name, version, hash -- straight to the buckets
+        if binary_def.hashes and not is_range(version):
+            matches = [rule_def for hsh in binary_def.hashes for rule_def in bucket.by_hash.get(hsh, ())
+                       if rule_def.eq_version(binary_def)]
+            if matches:
+                return min(matches, key=first)
+
+            exact = bucket.by_version.get(version)
+            if exact:
+                return exact[0]
+
+            for rule_def in bucket.ranges:
+                if rule_def.eq_version(binary_def):
+                    return rule_def
+
+            return bucket.any[0] if bucket.any else None
+
+        # a loose definition: the name's rules in the precedence order
+        if bucket.ordered is None:
+            rules = [rule_def for rules in bucket.by_hash.values() for rule_def in rules]
+            rules.extend(rule_def for rules in bucket.by_version.values() for rule_def in rules)
+            rules.extend(bucket.ranges)
+            rules.extend(bucket.any)
+            bucket.ordered = sorted(set(rules), key=lambda rule_def: (rule_level(rule_def), first(rule_def)))
+
+        return next((rule_def for rule_def in bucket.ordered if rule_def.no_conflict(binary_def)), None)
+
     def __getitem__(self, binary_def):
         '''
          __getitem__(self, binary_def)
@@ -31,56 +166,363 @@ class BinaryDefFile(UserDict):
         '''
 
         assert isinstance(binary_def, DepDefinition)
-        # self.data.keys() = list of DepDefinition
-        for rule_def, rule in self.data.items():
-            if rule_def.no_conflict(binary_def):
-                return rule
+        rule_def = self.find_rule(binary_def)
+        if rule_def is None:
+            raise KeyError(f'Could not find a suitable definition for: {binary_def}')
+
+        return self.data[rule_def]
+
+    # UserDict.get and `in` look the key up in self.data exactly, a rule matches loosely
+    def __contains__(self, binary_def):
+        return isinstance(binary_def, DepDefinition) and self.find_rule(binary_def) is not None
+
+    def get(self, binary_def, default=None):
+        rule_def = self.find_rule(binary_def) if isinstance(binary_def, DepDefinition) else None
+        return default if rule_def is None else self.data[rule_def]
 
-        raise KeyError(f'Could not find a suitable definition for: {binary_def}')
+def store_rpath(name):
+    return f"$ORIGIN/{name}_deps/:$ORIGIN/:$ORIGIN/common/"
 
 def set_rpath(filename):
     name = basename(filename)
-    rpath_def = f"$ORIGIN/{name}_deps/:$ORIGIN/:$ORIGIN/common/"
-    command = f"patchelf --set-rpath '{rpath_def}' {filename}"
-    output = check_output(command, shell=True).decode().strip()
-    logging.debug(output)
+    rpath_def = store_rpath(name)
+    try:
+        elf_patch.set_runpath_file(filename, rpath_def)
+        return
+    except ElfPatchError as e:
+        logging.debug(f'set_rpath: {e}, falling back to patchelf for {filename}')
 
-def hash_file(filename):
-    command = f'sha256sum {filename}'
-    output = check_output(command, shell=True).decode().strip()
+    patchelf_set_rpath(filename, rpath_def)
+
+def patchelf_argv(filename, rpath_def):
+    return ['patchelf', '--set-rpath', rpath_def, filename]
+
+def patchelf_set_rpath(filename, rpath_def):
+    output = run_tool(patchelf_argv(filename, rpath_def)).decode().strip()
     logging.debug(output)
 
-    hashtag = output.split()[0]
+HASH_CHUNK = 1 << 20
+
+def hash_file(filename):
+    '''sha256 of the file, in-process'''
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        buf = bytearray(HASH_CHUNK)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+            run_stats.count('store.hash.bytes', n)
+
+    hashtag = hasher.hexdigest()
+    logging.debug(f'{hashtag}  {filename}')
     return hashtag
 
+FICLONE = 0x40049409 # _IOW(0x94, 9, int) from linux/fs.h
+
+def clone_file(src, dst):
+    '''
+    clone_file(src, dst) -> the method used
+
+    Copy the content of the open file src into the empty open file dst
+    without passing it through the user space:
+    a reflink (the blocks are shared, on btrfs, xfs etc),
+    or copy_file_range, or sendfile, or at last read/write.
+    '''
+
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    run_stats.count('store.clone.bytes', os.fstat(src_fd).st_size)
+
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return 'reflink'
+    except OSError:
+        pass
+
+    size = os.fstat(src_fd).st_size
+    for method in ('copy_file_range', 'sendfile'):
+        copied = 0
+        try:
+            while copied < size:
+                if method == 'copy_file_range':
+                    n = os.copy_file_range(src_fd, dst_fd, size - copied, copied, copied)
+                else:
+                    n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+            return method
+
+        except (AttributeError, OSError):
+            # not supported here: try the next method, if nothing was copied yet
+            if copied:
+                raise
+
+    shutil.copyfileobj(src, dst, HASH_CHUNK)
+    return 'read/write'
+
+def copy_and_hash(src, dst, patches=(), tail=b''):
+    '''
+    copy_and_hash(src, dst, patches=(), tail=b'') -> sha256 hexdigest
+
+    Copy the open file src into dst, hashing on the way: one read of the data.
+    The patches from elf_patch.runpath_patches are applied to the chunks
+    before they are hashed and written, the tail is appended.
+    '''
+
+    hasher = hashlib.sha256()
+    buf = bytearray(HASH_CHUNK)
+    view = memoryview(buf)
+    offset = 0
+    while True:
+        n = src.readinto(buf)
+        if not n:
+            break
+        if patches:
+            elf_patch.apply_patches(view[:n], offset, patches)
+        hasher.update(view[:n])
+        dst.write(view[:n])
+        offset += n
+
+    if tail:
+        hasher.update(tail)
+        dst.write(tail)
+
+    run_stats.count('store.copy_and_hash.bytes', offset + len(tail))
+    return hasher.hexdigest()
+
+def plan_rpath(src, runpath):
+    '''
+    plan_rpath(src, runpath) -> (patches, tail) to set the RUNPATH of the open file src,
+    or None if elf_patch cannot edit it
+    '''
+
+    try:
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return elf_patch.runpath_patches(buf, runpath)
+    except (ValueError, ElfPatchError) as e:
+        logging.debug(f'plan_rpath: {e}, {src.name} goes through patchelf')
+        return None
+
 def convert_to_store(dep_node, store_dir):
+    '''
+    convert_to_store(dep_node, store_dir) -> the path of the file in the store
+
+    Copy the file of dep_node into a unique temp file in store_dir/temp,
+    set its RPATH, hash it, and rename it into
+
+        store_dir/name/version/name,version,hash
+
+    The file is read once: the RUNPATH patches are planned on an mmap
+    of the source, then applied to the chunks while they are copied and hashed.
+    If elf_patch cannot edit the file, it is cloned in the kernel
+    (reflink or copy_file_range), patched with patchelf, and read again to hash it.
+    If the store already has the hash, the temp file is dropped.
+    The file is recorded in the store index.
+
+    The final name is claimed with link(), which fails if it exists:
+    concurrent writers to the same store do not overwrite each other,
+    and the store never has a half-written file.
+    '''
+
     assert isinstance(dep_node, DepNode)
 
+    #
+    fullname = dep_node.value['full_path']
+    assert basename(fullname) == dep_node.name
+    name, version = dep_node.full_definition.filename, dep_node.full_definition.version
+
+    return add_to_store(fullname, name, version, store_dir, store_rpath(name))
+
+StagedFile = namedtuple('StagedFile', 'fullname name version runpath dynamic tempfile hashtag')
+# a file copied into store_dir/temp with its RUNPATH set and hashed,
+# or with hashtag None: it still needs patchelf_set_rpath, then the hash
+
+def stage_file(fullname, name, version, store_dir, runpath):
+    '''
+    stage_file(fullname, name, version, store_dir, runpath) -> StagedFile
+
+    The first half of add_to_store: the copy into a unique temp file,
+    patched and hashed on the way (see convert_to_store),
+    or cloned and left for patchelf if elf_patch cannot edit the file.
+    '''
+
     #assert isdir(store_dir)
     temp_dirname = store_dir + '/temp'
     makedirs(temp_dirname, exist_ok=True)
 
-    #
-    fullname = dep_node.value['full_path']
-    assert basename(fullname) == dep_node.name
-    tempfile = temp_dirname + '/' + dep_node.name
-    #copyfile(fullname, tempfile)
-    copy2(fullname, tempfile)
+    dynamic = elf_cache.read_elf_dynamic(fullname)
+    needs_rpath = dynamic.runpath != runpath
+
+    temp_fd, tempfile = mkstemp(dir=temp_dirname, prefix=name + ',')
+    try:
+        hashtag = None
+        with open(fullname, 'rb') as src, os.fdopen(temp_fd, 'wb') as dst:
+            plan = plan_rpath(src, runpath) if needs_rpath else ([], b'')
+            if plan is None:
+                with run_stats.timer('store.clone'):
+                    method = clone_file(src, dst)
+                logging.debug(f'stage_file: {method} {fullname}')
+            else:
+                with run_stats.timer('store.copy_and_hash'):
+                    hashtag = copy_and_hash(src, dst, *plan)
 
-    # set the RPATH
-    set_rpath(tempfile)
+        return StagedFile(fullname, name, version, runpath, dynamic, tempfile, hashtag)
 
-    # now make the hash
-    hashtag = hash_file(tempfile)
-    # TODO: check that this actual hashtag is not in conflict with the dependency?
+    except BaseException:
+        discard_staged(tempfile)
+        raise
 
-    #
-    name, version = dep_node.full_definition.filename, dep_node.full_definition.version
-    store_path = f'{store_dir}/{name}/{version}/'
-    store_file = f'{name},{version},{hashtag}'
-    makedirs(store_path, exist_ok=True)
-    #copyfile(tempfile, store_path + '/' + store_file)
-    copy2(tempfile, store_path + '/' + store_file)
+def discard_staged(tempfile):
+    if os.path.exists(tempfile):
+        os.unlink(tempfile)
+
+def finish_staged(staged, store_dir):
+    '''
+    finish_staged(staged, store_dir) -> the path of the file in the store
+
+    The second half of add_to_store, after the RUNPATH is set:
+    hash the file if it was patched by patchelf, and link it into the store.
+    The temp file is removed, also on a failure.
+    '''
+
+    index = store_index.open_index(store_dir)
+    tempfile = staged.tempfile
+    try:
+        hashtag = staged.hashtag
+        if hashtag is None:
+            with run_stats.timer('store.hash'):
+                hashtag = hash_file(tempfile)
+        # TODO: check that this actual hashtag is not in conflict with the dependency?
+
+        copystat(staged.fullname, tempfile)
+
+        # the real path: the environments link to it from anywhere
+        entry = StoreEntry(staged.name, staged.version, hashtag,
+                os.stat(tempfile).st_size, staged.dynamic.needed, staged.dynamic.soname, staged.runpath)
+        store_file = index.path(entry)
+        if not isfile(store_file):
+            makedirs(dirname(store_file), exist_ok=True)
+            try:
+                os.link(tempfile, store_file)
+            except FileExistsError:
+                # another writer got the same file in
+                pass
+        else:
+            logging.debug(f'finish_staged: already in the store {store_file}')
+
+        index.add(entry)
+        return store_file
+
+    finally:
+        discard_staged(tempfile)
+
+def add_to_store(fullname, name, version, store_dir, runpath):
+    '''
+    add_to_store(fullname, name, version, store_dir, runpath) -> the path of the file in the store
+
+    convert_to_store with the given RUNPATH, for any file:
+    also a store file that gets another RUNPATH (see store_variant).
+    '''
+
+    staged = stage_file(fullname, name, version, store_dir, runpath)
+    if staged.hashtag is None:
+        try:
+            patchelf_set_rpath(staged.tempfile, runpath)
+        except BaseException:
+            discard_staged(staged.tempfile)
+            raise
+
+    return finish_staged(staged, store_dir)
+
+def store_variant(node, store_dir, runpath):
+    '''
+    store_variant(node, store_dir, runpath) -> the path of the variant
+
+    A store file with another RUNPATH, added next to it as
+    store_dir/name/version/name,version,<its hash>
+    '''
+
+    name, version = node.full_definition.filename, node.full_definition.version
+    return add_to_store(node.value['full_path'], name, version, store_dir, runpath)
+
+def minimal_runpath_links(planner, store_dir, hwcaps=0):
+    '''
+    minimal_runpath_links(planner, store_dir, hwcaps=0) -> {path: store file}
+
+    The links of the planned layout to the store variants with the minimal RUNPATH.
+    '''
+
+    runpaths, saved = planner.minimal_runpaths(hwcaps)
+
+    variants = {}
+    links = {}
+    for path, runpath in runpaths.items():
+        node = planner.layout[path]
+        key = (node.value['full_path'], runpath)
+        if key not in variants:
+            variants[key] = store_variant(node, store_dir, runpath)
+        links[path] = variants[key]
+
+    logging.info(f'minimal_runpath_links: {len(variants)} RUNPATH variants, {saved} failed loader probes saved per load of every file')
+    return links
+
+def convert_nodes_to_store(nodes, store_dir, jobs=1):
+    '''
+    convert_nodes_to_store(nodes, store_dir, jobs=1) -> [store path, ...]
+
+    convert_to_store the nodes on a pool of <jobs> threads
+    (the time goes to hashing and copying, which release the GIL),
+    in two passes: stage_file all nodes, then finish_staged them.
+    Between the passes the patchelf calls of the staged files
+    run as one tool_runner.run_many batch.
+    The result is in the order of the nodes, whatever order they finish in.
+    A failed node leaves nothing in the store, the others are still converted,
+    and then an exception lists the failures.
+    '''
+
+    def stage(node):
+        try:
+            fullname = node.value['full_path']
+            assert basename(fullname) == node.name
+            name, version = node.full_definition.filename, node.full_definition.version
+            return stage_file(fullname, name, version, store_dir, store_rpath(name)), None
+        except Exception as e:
+            return None, e
+
+    def finish(result):
+        staged, e = result
+        if staged is None:
+            return None, e
+        try:
+            return finish_staged(staged, store_dir), None
+        except Exception as e:
+            return None, e
+
+    nodes = list(nodes)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        staged = list(pool.map(stage, nodes))
+
+        # the files that elf_patch cannot edit: all their patchelf calls in flight at once
+        to_patch = [i for i, (staged_file, _) in enumerate(staged) if staged_file is not None and staged_file.hashtag is None]
+        outputs = run_many([patchelf_argv(staged[i][0].tempfile, staged[i][0].runpath) for i in to_patch], return_exceptions=True)
+        for i, output in zip(to_patch, outputs):
+            if isinstance(output, Exception):
+                discard_staged(staged[i][0].tempfile)
+                staged[i] = (None, output)
+
+        results = list(pool.map(finish, staged))
+
+    failed = [(node, e) for node, (_, e) in zip(nodes, results) if e is not None]
+    for node, e in failed:
+        logging.error(f'convert_to_store failed: {node.value["full_path"]}: {e}')
+
+    if failed:
+        raise Exception(f'failed to convert {len(failed)} of {len(nodes)} files to the store {store_dir}') from failed[0][1]
+
+    return [store_file for store_file, _ in results]
 
 def storefile_to_def(bin_path) -> DepDefinition:
     '''
@@ -108,20 +550,16 @@ def find_dep(bindef, store_dir, dep_rules={}, parent_nodes=set(), accumulated_bi
     '''
 
     assert isinstance(parent_nodes, set)
-    assert isdir(store_dir)
-    store_dir = realpath(store_dir)
+    index = store_index.open_index(store_dir)
 
     fname, version = bindef.filename, bindef.version
-    dir_fname = store_dir + '/' + fname
-    assert isdir(dir_fname), dir_fname
 
     #
-    # if version is empty - match any
-    if version == '':
-        version = os.listdir(dir_fname)[0]
-
-    dir_bins = dir_fname + '/' + version
-    assert isdir(dir_bins), dir_bins
+    # if version is empty or a range - the latest that matches
+    if is_range(version):
+        version = index.select_version(fname, version)
+        if version is None:
+            raise Exception(f"Could not find a version in store {store_dir}: {bindef}")
 
     #
     # check if this definition was already found
@@ -134,33 +572,34 @@ def find_dep(bindef, store_dir, dep_rules={}, parent_nodes=set(), accumulated_bi
 
     #
     # otherwise, it is a new definition
-    # find it in the store
-    bin_path = None
+    # find it in the store index
+    entry = None
     if len(bindef.hashes) == 0:
         # then any file will work
-        any_file = os.listdir(dir_bins)[0]
-        bin_path = dir_bins + '/' + any_file
+        # the file with the store RUNPATH, not a variant from store_variant
+        entries = index.entries(fname, version)
+        entries = [e for e in entries if e.runpath == store_rpath(fname)] or entries
+        entry = entries[0] if entries else None
 
     #
     # find the first binary that passes the hash requirement
     for hsh in bindef.hashes:
-        file_bin = f'{fname},{version},{hsh}'
-        full_path = dir_bins + '/' + file_bin
-
-        if isfile(full_path):
-            bin_path = full_path
+        entry = index.get(fname, version, hsh)
+        if entry is not None:
+            break
 
-        else:
-            raise Exception(f"Could not find a file in store {store_dir}: {bindef}")
+    if entry is None:
+        raise Exception(f"Could not find a file in store {store_dir}: {bindef}")
 
     #
-    # now, there is a path to the binary: bin_path
-    # it has some dependencies (readelf -d)
+    # now, there is a binary: bin_path
+    # it has some dependencies (NEEDED, from the index)
     # and some rules for them (dep_rules)
     # make the rules subset for the dependencies, and find them
     #
+    bin_path = index.path(entry)
     full_definition = storefile_to_def(bin_path)
-    needed, runpath, soname = readelf_dynamic(bin_path)
+    needed, runpath, soname = list(entry.needed), expand_origin(entry.runpath, dirname(bin_path)), entry.soname
 
     dependencies = set()
     new_bin = DepNode(fname, soname, version, full_definition, bin_path, runpath, dependencies, parent_nodes)
@@ -169,9 +608,7 @@ def find_dep(bindef, store_dir, dep_rules={}, parent_nodes=set(), accumulated_bi
     #
     # find the dependencies in the store
     # and add them to accumulated_binaries
-    #dep_rules_for_this_bin = dep_rules[fname]
-    #dep_rules_for_this_bin = dep_rules[full_definition]
-    # TODO this won't work! the definitions are hashed - they won't match loose versions etc!
+    # dep_rules is a BinaryDefFile: the lookup matches loose versions and hashes
     dep_rules_for_this_bin = dep_rules.get(full_definition, {})
 
     for dep_name in needed:
@@ -207,10 +644,12 @@ def parse_env_file(env_file) -> dict:
             # currently the definition string is
             # <binary definition> > <dependency def> <another> ...
 
-            if '>' in defstr:
-                bindef, dep_rules = defstr.split('>')
-                bindef = str_to_def(bindef.strip())
-                dep_rules_list = [str_to_def(rs) for rs in dep_rules.split()]
+            # the > is a separate word: the version ranges have >= and <
+            words = defstr.split()
+            if '>' in words:
+                sep = words.index('>')
+                bindef = str_to_def(' '.join(words[:sep]))
+                dep_rules_list = [str_to_def(rs) for rs in words[sep+1:]]
                 dep_rules = {rule.filename: rule for rule in dep_rules_list}
 
             else:
@@ -233,6 +672,7 @@ if __name__ == "__main__":
             Example:
             ./store_files.py    env_example1.txt temp/env1 temp/store1/
             ./store_files.py -t env_example2.txt temp/env1 temp/store1/
+            ./store_files.py -u env_example2.txt temp/env1 temp/store1/
             """)
             )
 
@@ -241,6 +681,11 @@ if __name__ == "__main__":
     parser.add_argument("store_dir", type=str, help="directory with the stored patched binaries")
 
     parser.add_argument("-t", "--test",  action='store_true', help="dry pass, just print symlink commands, don't execute them")
+    parser.add_argument("--runpath", choices=('store', 'minimal'), default='store',
+                        help="link the store files as they are, or variants with the shortest RUNPATH for their place in the layout (default: %(default)s)")
+    parser.add_argument("-u", "--update", action='store_true', help="update an existing environment: change only the links that differ, and swap the new generation in atomically (see env_dir.py)")
+    elf_cache.add_cache_arguments(parser)
+    run_stats.add_stats_arguments(parser)
     parser.add_argument("-d", "--debug", action='store_true', help="DEBUG logging")
 
     args = parser.parse_args()
@@ -250,22 +695,49 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logging.INFO)
 
-    dependency_defs = parse_env_file(args.env_file)
+    elf_cache.open_cache(args.cache, args.cache_file)
+    run_stats.start(args)
+
+    with run_stats.timer('phase.parse_env_file'):
+        dependency_defs = parse_env_file(args.env_file)
 
     #
-    makedirs(args.env_dir, exist_ok=True)
-    accumulated_binaries = {}
-    for bindef, dep_rules in dependency_defs.items():
-        #full_path = find_dep(bindef, args.store_dir, dep_rules)
-        find_dep(bindef, args.store_dir, dep_rules, set(), accumulated_binaries)
+    accumulated_binaries = AccumulatedNodes()
+    with run_stats.timer('phase.find_dep'):
+        for bindef, dep_rules in dependency_defs.items():
+            # the rules of the whole environment apply to the dependencies
+            find_dep(bindef, args.store_dir, dependency_defs, set(), accumulated_binaries)
+
+    # the soup and the _deps directories for the conflicting versions
+    with run_stats.timer('phase.layout'):
+        planner = env_layout.LayoutPlanner(accumulated_binaries)
+        planner.plan()
+        layout = env_layout.layout_links(planner.layout, planner.deps_dirs)
+
+        if args.runpath == 'minimal':
+            layout.update(minimal_runpath_links(planner, args.store_dir, len(all_deps.hwcaps)))
+
+    with run_stats.timer('phase.env'):
+        if args.update:
+            diff = env_dir.update_env(args.env_dir, layout, dry_run=args.test)
+            if args.test:
+                for path, target in {**diff.add, **diff.change}.items():
+                    print(f"os.symlink({target}, {args.env_dir} + '/' + {path})")
+                for path in diff.remove:
+                    print(f"os.unlink({args.env_dir} + '/' + {path})")
 
-    for name, defs in accumulated_binaries.items():
-        full_path = defs[0][0].value['full_path']
+        else:
+            makedirs(args.env_dir, exist_ok=True)
+            for path, full_path in layout.items():
 
-        # symlink it in the args.env_dir
-        if args.test:
-            print(f"os.symlink({full_path}, {args.env_dir} + '/' + {name})")
+                # symlink it in the args.env_dir
+                if args.test:
+                    print(f"os.symlink({full_path}, {args.env_dir} + '/' + {path})")
 
-        else:
-            os.symlink(full_path, args.env_dir + '/' + name)
+                else:
+                    makedirs(dirname(args.env_dir + '/' + path), exist_ok=True)
+                    os.symlink(full_path, args.env_dir + '/' + path)
 
+    if not args.test:
+        # the gc root: store_gc.py keeps the files the environment links to
+        store_index.open_index(args.store_dir).add_root(args.env_dir)
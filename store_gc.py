@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+'''
+Compaction of a binary store: the duplicates by content, and the garbage.
+
+    ./store_gc.py dedup temp/store1/
+    ./store_gc.py gc temp/store1/
+
+dedup -- the store keeps a file per name,version,hash, so the same content
+stored under different names or versions takes its space again.
+The entries of the index with the same hash become hard links to the oldest
+one: a link to a temp name next to the file, renamed over it, atomically.
+Only the files with the same mode and owner are linked, a hard link shares them.
+With --reflink the duplicate is replaced by a clone of the oldest file
+instead (a reflink on btrfs, xfs...): the blocks are shared,
+the file keeps its own inode and metadata.
+The run is incremental: the index remembers the last entry that was
+deduplicated, the next run looks only at the hashes of the newer entries
+(--full looks at all of them).
+
+gc -- mark and sweep. The environments made by store_files.py are recorded
+in the index as the gc roots, more environment directories can be given.
+Every store file that a symlink of an environment, or of its generations
+(see env_dir.py), resolves to is marked, the other indexed files are removed,
+with their index entries and the empty directories.
+The files changed in the last --keep-recent seconds are kept:
+convert_to_store puts the files in before an environment links to them.
+--full also walks the store for the files that are not indexed,
+and cleans the temp directory.
+--max-files bounds the removals of one run, the next run goes on.
+
+Both run the file operations on --jobs threads.
+'''
+
+import argparse, logging
+import textwrap
+import fcntl
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import dirname, isdir, join, realpath
+from tempfile import mkstemp
+from shutil import copystat
+
+import env_dir
+import run_stats
+import store_index
+from store_files import FICLONE
+
+GC_COMMANDS = ('dedup', 'gc')
+KEEP_RECENT = 3600 # seconds
+DEDUP_MARK = 'dedup.rowid'
+
+def _link_over(src, dst):
+    '''replace dst with a hard link to src, atomically'''
+    temp = f'{dst}.{os.getpid()}.{threading.get_ident()}.dedup'
+    os.link(src, temp)
+    try:
+        os.replace(temp, dst)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+def _reflink_over(src, dst):
+    '''replace dst with a reflink clone of src, keeping the metadata of dst, atomically'''
+    temp_fd, temp = mkstemp(dir=dirname(dst), prefix='.dedup,')
+    try:
+        with os.fdopen(temp_fd, 'wb') as temp_file, open(src, 'rb') as src_file:
+            fcntl.ioctl(temp_file.fileno(), FICLONE, src_file.fileno())
+        copystat(dst, temp)
+        os.replace(temp, dst)
+
+    except BaseException:
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+
+def dedup_group(index, group, reflink=False):
+    '''
+    dedup_group(index, group, reflink=False) -> the bytes saved
+
+    Link or clone the entries of one hash to the oldest of them.
+    '''
+
+    paths = [index.path(entry) for entry in group]
+    try:
+        first = os.stat(paths[0])
+    except OSError as e:
+        logging.warning(f'dedup: {e}')
+        return 0
+
+    saved = 0
+    for entry, path in zip(group[1:], paths[1:]):
+        try:
+            st = os.stat(path)
+            if st.st_ino == first.st_ino and st.st_dev == first.st_dev:
+                continue
+            if st.st_size != first.st_size:
+                logging.warning(f'dedup: the same hash, another size: {path} {paths[0]}, verify the store')
+                continue
+
+            if reflink:
+                _reflink_over(paths[0], path)
+            elif (st.st_mode, st.st_uid, st.st_gid) != (first.st_mode, first.st_uid, first.st_gid):
+                logging.debug(f'dedup: another mode or owner, not linked: {path}')
+                continue
+            else:
+                _link_over(paths[0], path)
+
+        except OSError as e:
+            logging.warning(f'dedup: cannot {"reflink" if reflink else "link"} {path}: {e}')
+            continue
+
+        # a file with other links frees nothing
+        if reflink or st.st_nlink == 1:
+            saved += st.st_size
+        run_stats.count('dedup.files')
+
+    return saved
+
+def dedup_store(store_dir, jobs=1, reflink=False, full=False):
+    '''
+    dedup_store(store_dir, jobs=1, reflink=False, full=False) -> (files linked, bytes saved)
+    '''
+
+    index = store_index.open_index(store_dir)
+    since = 0 if full else int(index.get_meta(DEDUP_MARK, 0))
+    # the entries added while this runs are left for the next run
+    mark = index.max_rowid()
+    groups = index.same_hash_groups(since)
+
+    with run_stats.timer('dedup'), ThreadPoolExecutor(max_workers=jobs) as pool:
+        saved = sum(pool.map(lambda group: dedup_group(index, group, reflink), groups))
+
+    index.set_meta(DEDUP_MARK, mark)
+    files = sum(len(group) - 1 for group in groups)
+    run_stats.count('dedup.bytes', saved)
+    logging.info(f'dedup_store: {len(groups)} hashes with duplicates, {files} duplicates, {saved} bytes saved')
+    return files, saved
+
+def env_targets(directory):
+    '''the real paths that the symlinks of an environment directory resolve to'''
+    return {realpath(join(directory, path)) for path in env_dir.read_layout(directory)}
+
+def mark(store_dir, env_dirs, jobs=1):
+    '''
+    mark(store_dir, env_dirs, jobs=1) -> {real path of a store file, ...}
+
+    The store files that the environments and their generations link to.
+    '''
+
+    store_prefix = realpath(store_dir) + '/'
+    directories = [d for env in env_dirs for d in [env] + env_dir.generation_dirs(env) if isdir(d)]
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        marked = set()
+        for targets in pool.map(env_targets, directories):
+            marked.update(path for path in targets if path.startswith(store_prefix))
+
+    run_stats.count('gc.marked', len(marked))
+    return marked
+
+def _lstat(path):
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+        return True
+    except FileNotFoundError:
+        return True
+    except OSError as e:
+        logging.warning(f'gc: cannot remove {path}: {e}')
+        return False
+
+def _remove_empty_dirs(paths, store_dir):
+    '''the version and the name directories left empty'''
+    for directory in sorted({dirname(path) for path in paths}, reverse=True):
+        while directory != store_dir:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = dirname(directory)
+
+def gc_store(store_dir, env_dirs=(), jobs=1, keep_recent=KEEP_RECENT, max_files=None, full=False, dry_run=False):
+    '''
+    gc_store(store_dir, env_dirs=(), ...) -> [removed path, ...]
+
+    Mark the store files from the recorded gc roots and env_dirs, sweep the rest.
+    '''
+
+    index = store_index.open_index(store_dir)
+
+    roots = []
+    for root in index.roots():
+        if any(isdir(d) for d in [root] + env_dir.generation_dirs(root)):
+            roots.append(root)
+        else:
+            logging.info(f'gc: the environment {root} is gone, dropping the root')
+            if not dry_run:
+                index.remove_root(root)
+    roots += [os.path.abspath(d.rstrip('/')) for d in env_dirs]
+
+    if not roots:
+        raise Exception(f'gc: no environments to mark from in {store_dir}, give the environment directories')
+
+    start = time.time()
+    with run_stats.timer('gc.mark'):
+        marked = mark(store_dir, roots, jobs)
+
+    garbage = {index.path(entry): entry for entry in index.entries() if index.path(entry) not in marked}
+    unindexed = []
+    if full:
+        unindexed = [path for _, _, _, path in index.scan_store() if path not in marked and path not in garbage]
+        temp_dir = join(index.store_dir, 'temp')
+        if isdir(temp_dir):
+            unindexed += [entry.path for entry in os.scandir(temp_dir) if entry.is_file(follow_symlinks=False)]
+
+    candidates = list(garbage) + unindexed
+    if max_files is not None:
+        candidates = candidates[:max_files]
+
+    # all stat-ed before the first unlink: removing a hard link changes the ctime of the others
+    keep_after = start - keep_recent
+    with run_stats.timer('gc.sweep'), ThreadPoolExecutor(max_workers=jobs) as pool:
+        stats = dict(zip(candidates, pool.map(_lstat, candidates)))
+        old = [path for path, st in stats.items() if st is None or st.st_ctime <= keep_after]
+        if dry_run:
+            removed = old
+        else:
+            removed = [path for path, ok in zip(old, pool.map(_unlink, old)) if ok]
+
+    # an inode is freed when all its links go
+    inodes = {}
+    for path in removed:
+        st = stats[path]
+        if st is not None:
+            inodes.setdefault((st.st_dev, st.st_ino), [st, 0])[1] += 1
+    freed = sum(st.st_size for st, links in inodes.values() if links >= st.st_nlink)
+
+    if not dry_run:
+        index.remove([garbage[path] for path in removed if path in garbage])
+        _remove_empty_dirs([path for path in removed if dirname(path) != join(index.store_dir, 'temp')], index.store_dir)
+
+    run_stats.count('gc.removed', len(removed))
+    run_stats.count('gc.bytes', freed)
+    logging.info(f'gc_store: {len(marked)} files in use from {len(roots)} environments, '
+                 f'{"would remove" if dry_run else "removed"} {len(removed)} files, {freed} bytes, '
+                 f'kept {len(candidates) - len(removed)} recent files')
+    return removed
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+            formatter_class = argparse.RawDescriptionHelpFormatter,
+            description = textwrap.dedent("""Deduplicate the files of a binary store, or remove the ones no environment uses"""),
+            epilog = textwrap.dedent("""
+            Example:
+            ./store_gc.py dedup -j 8 temp/store1/
+            ./store_gc.py dedup --reflink --full temp/store1/
+            ./store_gc.py gc --dry-run temp/store1/
+            ./store_gc.py gc --keep-recent 0 temp/store1/ temp/env1 temp/env2
+            """)
+            )
+
+    parser.add_argument("command",   choices=GC_COMMANDS, help="link the same contents, or mark and sweep")
+    parser.add_argument("store_dir", type=str, help="directory with the stored patched binaries")
+    parser.add_argument("env_dirs",  nargs='*', help="gc: the environments to keep, besides the ones recorded in the store index")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="file operations on N threads (default: %(default)s)")
+    parser.add_argument("--full", action='store_true', help="dedup: all hashes, not only the new ones; gc: also the files that are not indexed, and the temp directory")
+    parser.add_argument("--reflink", action='store_true', help="dedup: reflink clones instead of hard links")
+    parser.add_argument("--keep-recent", type=float, default=KEEP_RECENT, metavar='SECONDS', help="gc: keep the files changed in the last SECONDS (default: %(default)s)")
+    parser.add_argument("--max-files", type=int, default=None, help="gc: remove at most N files in this run")
+    parser.add_argument("-n", "--dry-run", action='store_true', help="gc: print what would be removed")
+    run_stats.add_stats_arguments(parser)
+    parser.add_argument("-d", "--debug", action='store_true', help="DEBUG logging")
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    run_stats.start(args)
+
+    if args.command == 'dedup':
+        dedup_store(args.store_dir, args.jobs, args.reflink, args.full)
+
+    else:
+        removed = gc_store(args.store_dir, args.env_dirs, args.jobs, args.keep_recent, args.max_files, args.full, args.dry_run)
+        if args.dry_run:
+            for path in removed:
+                print(path)
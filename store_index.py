@@ -0,0 +1,343 @@
+#!/usr/bin/python3
+'''
+The index of a binary store, an sqlite database in
+
+    store_dir/index.sqlite
+
+with a row per stored file:
+
+    name, version, hash, size, needed, soname, runpath
+
+convert_to_store records every file it puts in the store,
+so an environment is resolved from the index alone:
+no listdir of the store directories and no ELF parsing of the stored files.
+
+The index is derived data, the store files are the truth.
+If it is lost or stale:
+
+    ./store_index.py reindex temp/store1/
+    ./store_index.py verify  temp/store1/
+
+It also keeps the gc roots of the store: the environment directories
+made from it, see store_gc.py.
+'''
+
+import argparse, logging
+import textwrap
+import json
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from os.path import isdir, isfile, realpath
+
+import elf_cache
+from versions import VersionIndex
+
+INDEX_FILENAME = 'index.sqlite'
+INDEX_FORMAT = 1
+
+StoreEntry = namedtuple('StoreEntry', 'name version hash size needed soname runpath')
+# needed is a tuple of strings
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    name    TEXT NOT NULL,
+    version TEXT NOT NULL,
+    hash    TEXT NOT NULL,
+    size    INTEGER NOT NULL,
+    needed  TEXT NOT NULL,
+    soname  TEXT NOT NULL,
+    runpath TEXT NOT NULL,
+    PRIMARY KEY (name, version, hash)
+);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+CREATE TABLE IF NOT EXISTS roots (path TEXT PRIMARY KEY);
+'''
+
+def index_filename(store_dir):
+    return os.path.join(store_dir, INDEX_FILENAME)
+
+def store_file_path(store_dir, name, version, hashtag):
+    return f'{store_dir}/{name}/{version}/{name},{version},{hashtag}'
+
+def _row_to_entry(row):
+    name, version, hashtag, size, needed, soname, runpath = row
+    return StoreEntry(name, version, hashtag, size, tuple(json.loads(needed)), soname, runpath)
+
+def _root_path(env_dir):
+    '''the roots are kept as absolute paths without the trailing slash'''
+    return os.path.abspath(env_dir.rstrip('/'))
+
+class StoreIndex:
+    def __init__(self, store_dir):
+        self.store_dir = realpath(store_dir)
+        self.filename = index_filename(self.store_dir)
+        self.lock = threading.Lock()
+        # {name: VersionIndex}, loaded on the first lookup of the name
+        self.version_indexes = {}
+
+        # one connection shared by the threads of convert_nodes_to_store, under the lock;
+        # other processes writing the same store wait on the sqlite lock
+        self.db = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(_SCHEMA)
+            self.db.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', ('format', str(INDEX_FORMAT)))
+
+        fmt, = self.db.execute("SELECT value FROM meta WHERE key = 'format'").fetchone()
+        if fmt != str(INDEX_FORMAT):
+            raise Exception(f'StoreIndex: {self.filename} has format {fmt}, expected {INDEX_FORMAT}, reindex the store')
+
+    def close(self):
+        self.db.close()
+
+    def add(self, entry):
+        assert isinstance(entry, StoreEntry)
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (entry.name, entry.version, entry.hash, entry.size,
+                     json.dumps(list(entry.needed)), entry.soname, entry.runpath))
+
+            version_index = self.version_indexes.get(entry.name)
+            if version_index is not None:
+                version_index.add(entry.version)
+
+    def remove(self, entries):
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM files WHERE name = ? AND version = ? AND hash = ?',
+                    [(e.name, e.version, e.hash) for e in entries])
+            for name in {e.name for e in entries}:
+                self.version_indexes.pop(name, None)
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def set_meta(self, key, value):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+
+    def add_root(self, env_dir):
+        '''record an environment directory made from the store, the gc keeps what it links to'''
+        with self.lock, self.db:
+            self.db.execute('INSERT OR IGNORE INTO roots VALUES (?)', (_root_path(env_dir),))
+
+    def remove_root(self, env_dir):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM roots WHERE path = ?', (_root_path(env_dir),))
+
+    def roots(self):
+        with self.lock:
+            return [path for path, in self.db.execute('SELECT path FROM roots ORDER BY path')]
+
+    def max_rowid(self):
+        with self.lock:
+            rowid, = self.db.execute('SELECT MAX(rowid) FROM files').fetchone()
+        return rowid or 0
+
+    def same_hash_groups(self, since_rowid=0):
+        '''
+        same_hash_groups(since_rowid=0) -> [[StoreEntry, ...], ...]
+
+        The entries that share their hash with another entry, grouped by the hash,
+        the oldest first. Only the hashes of the entries added after since_rowid.
+        '''
+
+        with self.lock:
+            rows = self.db.execute('SELECT * FROM files WHERE hash IN (SELECT hash FROM files WHERE rowid > ?) '
+                                   'ORDER BY hash, rowid', (since_rowid,)).fetchall()
+
+        groups = {}
+        for row in rows:
+            entry = _row_to_entry(row)
+            groups.setdefault(entry.hash, []).append(entry)
+        return [group for group in groups.values() if len(group) > 1]
+
+    def version_index(self, name):
+        '''VersionIndex of the versions of <name> in the store'''
+        with self.lock:
+            version_index = self.version_indexes.get(name)
+            if version_index is None:
+                rows = self.db.execute('SELECT DISTINCT version FROM files WHERE name = ?', (name,)).fetchall()
+                version_index = self.version_indexes[name] = VersionIndex(version for version, in rows)
+        return version_index
+
+    def versions(self, name):
+        '''the versions of <name> in the store, sorted'''
+        return list(self.version_index(name))
+
+    def select_version(self, name, constraint=''):
+        '''
+        select_version(name, constraint='') -> the latest version of <name> that satisfies the constraint, or None
+        '''
+        return self.version_index(name).select(constraint)
+
+    def entries(self, name=None, version=None):
+        query, params = 'SELECT * FROM files', []
+        if name is not None:
+            query += ' WHERE name = ?'
+            params.append(name)
+            if version is not None:
+                query += ' AND version = ?'
+                params.append(version)
+
+        with self.lock:
+            rows = self.db.execute(query + ' ORDER BY rowid', params).fetchall()
+        return [_row_to_entry(row) for row in rows]
+
+    def get(self, name, version, hashtag):
+        with self.lock:
+            row = self.db.execute('SELECT * FROM files WHERE name = ? AND version = ? AND hash = ?',
+                    (name, version, hashtag)).fetchone()
+        return _row_to_entry(row) if row is not None else None
+
+    def path(self, entry):
+        return store_file_path(self.store_dir, entry.name, entry.version, entry.hash)
+
+    def scan_store(self):
+        '''
+        scan_store() -> [(name, version, hash, path), ...]
+
+        The files on disk, store_dir/name/version/name,version,hash
+        '''
+
+        found = []
+        with os.scandir(self.store_dir) as names:
+            for name_entry in names:
+                # the temp dir of convert_to_store
+                if name_entry.name == 'temp' or not name_entry.is_dir(follow_symlinks=False):
+                    continue
+
+                with os.scandir(name_entry.path) as versions:
+                    for version_entry in versions:
+                        if not version_entry.is_dir(follow_symlinks=False):
+                            continue
+
+                        prefix = f'{name_entry.name},{version_entry.name},'
+                        with os.scandir(version_entry.path) as files:
+                            for file_entry in files:
+                                if file_entry.name.startswith(prefix) and file_entry.is_file(follow_symlinks=False):
+                                    found.append((name_entry.name, version_entry.name,
+                                                  file_entry.name[len(prefix):], file_entry.path))
+
+        return found
+
+    def reindex(self):
+        '''
+        reindex() -> the number of files
+
+        Rebuild the index from the files in the store.
+        '''
+
+        entries = []
+        for name, version, hashtag, path in self.scan_store():
+            dynamic = elf_cache.read_elf_dynamic(path)
+            entries.append(StoreEntry(name, version, hashtag, os.stat(path).st_size,
+                                      dynamic.needed, dynamic.soname, dynamic.runpath))
+
+        with self.lock, self.db:
+            self.version_indexes.clear()
+            self.db.execute('DELETE FROM files')
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(e.name, e.version, e.hash, e.size, json.dumps(list(e.needed)), e.soname, e.runpath) for e in entries])
+
+        logging.info(f'StoreIndex: indexed {len(entries)} files in {self.store_dir}')
+        return len(entries)
+
+    def verify(self, check_hashes=False):
+        '''
+        verify(check_hashes=False) -> [problem, ...]
+
+        Compare the index with the files in the store:
+        missing files, unindexed files, wrong sizes, and the hashes if asked.
+        '''
+
+        # imported here: store_files imports this module
+        from store_files import hash_file
+
+        problems = []
+        on_disk = {(name, version, hashtag): path for name, version, hashtag, path in self.scan_store()}
+        indexed = {(e.name, e.version, e.hash): e for e in self.entries()}
+
+        for key in indexed.keys() - on_disk.keys():
+            problems.append(f'missing file: {store_file_path(self.store_dir, *key)}')
+
+        for key in on_disk.keys() - indexed.keys():
+            problems.append(f'not indexed: {on_disk[key]}')
+
+        for key in indexed.keys() & on_disk.keys():
+            path, entry = on_disk[key], indexed[key]
+            size = os.stat(path).st_size
+            if size != entry.size:
+                problems.append(f'size {size} != indexed {entry.size}: {path}')
+            elif check_hashes and hash_file(path) != entry.hash:
+                problems.append(f'hash mismatch: {path}')
+
+        return sorted(problems)
+
+_open_indexes = {}
+_open_indexes_lock = threading.Lock()
+
+def open_index(store_dir):
+    '''
+    open_index(store_dir) -> StoreIndex
+
+    One StoreIndex per store in the process.
+    A store without an index file gets it built from its files.
+    '''
+
+    store_dir = realpath(store_dir)
+    with _open_indexes_lock:
+        index = _open_indexes.get(store_dir)
+        if index is not None:
+            return index
+
+        assert isdir(store_dir), store_dir
+        new_store = not isfile(index_filename(store_dir))
+        index = StoreIndex(store_dir)
+        if new_store and any(True for _ in index.scan_store()):
+            logging.info(f'open_index: {store_dir} has no index, building it')
+            index.reindex()
+
+        _open_indexes[store_dir] = index
+        return index
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+            formatter_class = argparse.RawDescriptionHelpFormatter,
+            description = textwrap.dedent("""Rebuild or check the index of a binary store"""),
+            epilog = textwrap.dedent("""
+            Example:
+            ./store_index.py reindex temp/store1/
+            ./store_index.py verify --hashes temp/store1/
+            """)
+            )
+
+    parser.add_argument("command",   choices=('reindex', 'verify'), help="rebuild the index from the store files, or compare them")
+    parser.add_argument("store_dir", type=str, help="directory with the stored patched binaries")
+    parser.add_argument("--hashes",  action='store_true', help="verify: also hash every file")
+    elf_cache.add_cache_arguments(parser)
+    parser.add_argument("-d", "--debug", action='store_true', help="DEBUG logging")
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    elf_cache.open_cache(args.cache, args.cache_file)
+
+    index = StoreIndex(args.store_dir)
+    if args.command == 'reindex':
+        index.reindex()
+
+    else:
+        problems = index.verify(args.hashes)
+        for problem in problems:
+            print(problem)
+        if problems:
+            raise SystemExit(1)
@@ -0,0 +1,137 @@
+import shutil
+import subprocess
+
+import pytest
+
+from elf_dynamic import parse_dynamic, parse_readelf, _LAYOUTS, PT_LOAD
+from elf_forest import make_shared_object, PT_NOTE
+from elf_patch import runpath_patches, apply_patches, set_runpath_file, ElfPatchError, _PHDR_FIELDS
+
+LAYOUTS = [(64, '<'), (32, '<'), (64, '>'), (32, '>')]
+
+NEEDED = ['libc.so.6', 'libfoo.so.1']
+
+def patched(image, runpath):
+    patches, tail = runpath_patches(image, runpath)
+    out = bytearray(image)
+    apply_patches(out, 0, patches)
+    return bytes(out) + tail, tail
+
+def phdr_types(image):
+    ehdr_st, phdr_st, _, _ = _LAYOUTS[(image[4], image[5])]
+    header = ehdr_st.unpack_from(image, 16)
+    e_phoff, e_phentsize, e_phnum = header[4], header[8], header[9]
+    fields = _PHDR_FIELDS[image[4]]
+    return [dict(zip(fields, phdr_st.unpack_from(image, e_phoff + i * e_phentsize)))['p_type'] for i in range(e_phnum)]
+
+@pytest.mark.parametrize('bits, byte_order', LAYOUTS)
+def test_in_place(bits, byte_order):
+    image = make_shared_object(NEEDED, 'libbar.so.1', '$ORIGIN/../lib/v0', b'id', bits, byte_order)
+    new, tail = patched(image, '$ORIGIN')
+
+    assert tail == b''
+    assert len(new) == len(image)
+    assert parse_dynamic(new) == parse_dynamic(image)._replace(runpath='$ORIGIN')
+
+@pytest.mark.parametrize('bits, byte_order', LAYOUTS)
+def test_rpath_becomes_runpath(bits, byte_order):
+    image = make_shared_object(NEEDED, 'libbar.so.1', rpath='/usr/lib/old', bits=bits, byte_order=byte_order)
+    new, tail = patched(image, '/new')
+
+    assert tail == b''
+    dynamic = parse_dynamic(new)
+    assert (dynamic.runpath, dynamic.rpath) == ('/new', '')
+    assert dynamic.needed == tuple(NEEDED)
+
+@pytest.mark.parametrize('bits, byte_order', LAYOUTS)
+def test_append_longer(bits, byte_order):
+    image = make_shared_object(NEEDED, 'libbar.so.1', '$ORIGIN', b'id', bits, byte_order)
+    new, tail = patched(image, '$ORIGIN/../lib/a/much/longer/runpath')
+
+    assert tail
+    assert parse_dynamic(new) == parse_dynamic(image)._replace(runpath='$ORIGIN/../lib/a/much/longer/runpath')
+    # the build-id PT_NOTE became the PT_LOAD of the new string table
+    assert phdr_types(image) == [PT_LOAD, 2, PT_NOTE]
+    assert phdr_types(new) == [PT_LOAD, PT_LOAD, 2]
+
+@pytest.mark.parametrize('bits, byte_order', LAYOUTS)
+def test_append_into_null_slot(bits, byte_order):
+    image = make_shared_object(NEEDED, 'libbar.so.1', '', b'id', bits, byte_order)
+    new, tail = patched(image, '$ORIGIN')
+
+    assert tail
+    assert parse_dynamic(new) == parse_dynamic(image)._replace(runpath='$ORIGIN')
+
+@pytest.mark.parametrize('bits, byte_order', LAYOUTS)
+def test_merged_string_is_not_overwritten(bits, byte_order):
+    # the linker stores DT_NEEDED libfoo.so.1 as the tail of the RUNPATH string
+    image = make_shared_object(NEEDED, '', '/opt/libfoo.so.1', b'id', bits, byte_order, merge_strings=True)
+    before = parse_dynamic(image)
+    assert before.needed == tuple(NEEDED) and before.runpath == '/opt/libfoo.so.1'
+    assert image.count(b'libfoo.so.1\0') == 1
+
+    new, tail = patched(image, '/x')
+
+    assert tail
+    assert parse_dynamic(new) == before._replace(runpath='/x')
+
+def test_runpath_as_tail_of_other_string():
+    # RUNPATH is the tail of SONAME: overwriting it would change the SONAME
+    image = make_shared_object(NEEDED, 'lib/opt', '/opt', merge_strings=True)
+    assert image.count(b'/opt\0') == 1
+
+    new, tail = patched(image, '/x')
+
+    assert tail
+    assert parse_dynamic(new) == parse_dynamic(image)._replace(runpath='/x')
+
+def test_static_file_is_not_patched():
+    image = bytearray(make_shared_object(NEEDED))
+    # turn PT_DYNAMIC into PT_NULL
+    ehdr_st, phdr_st, _, _ = _LAYOUTS[(2, 1)]
+    e_phoff = ehdr_st.unpack_from(image, 16)[4]
+    image[e_phoff + phdr_st.size:e_phoff + phdr_st.size + 4] = b'\0' * 4
+
+    assert runpath_patches(bytes(image), '$ORIGIN') == ([], b'')
+
+def test_no_note_to_reuse():
+    image = bytearray(make_shared_object(NEEDED, runpath='/a'))
+    ehdr_st, phdr_st, _, _ = _LAYOUTS[(2, 1)]
+    e_phoff = ehdr_st.unpack_from(image, 16)[4]
+    image[e_phoff + 2 * phdr_st.size:e_phoff + 2 * phdr_st.size + 4] = b'\0' * 4
+
+    with pytest.raises(ElfPatchError):
+        runpath_patches(bytes(image), '/a/longer/one')
+
+@pytest.mark.parametrize('image', [b'', b'\x7fELF', b'#!/bin/sh\n' * 8,
+                                   make_shared_object(NEEDED, runpath='/a')[:80]])
+def test_not_elf(image):
+    with pytest.raises(ElfPatchError):
+        runpath_patches(image, '/a')
+
+def test_apply_patches_in_chunks():
+    image = make_shared_object(NEEDED, 'libbar.so.1', '$ORIGIN', b'id')
+    patches, tail = runpath_patches(image, '/a/longer/runpath')
+    whole, _ = patched(image, '/a/longer/runpath')
+
+    for chunk_size in (1, 7, 64, 4096):
+        out = bytearray()
+        for offset in range(0, len(image), chunk_size):
+            chunk = bytearray(image[offset:offset + chunk_size])
+            apply_patches(chunk, offset, patches)
+            out += chunk
+        assert bytes(out) + tail == whole
+
+@pytest.mark.parametrize('runpath', ['$ORIGIN', '$ORIGIN/../lib/a/much/longer/runpath'])
+def test_set_runpath_file(tmp_path, runpath):
+    filename = tmp_path / 'libbar.so.1'
+    image = make_shared_object(NEEDED, 'libbar.so.1', '$ORIGIN/../lib', b'id')
+    filename.write_bytes(image)
+
+    set_runpath_file(filename, runpath)
+
+    assert parse_dynamic(filename.read_bytes()) == parse_dynamic(image)._replace(runpath=runpath)
+
+    if shutil.which('readelf'):
+        output = subprocess.run(['readelf', '-d', '-l', '-W', filename], capture_output=True, check=True).stdout
+        assert parse_readelf(output)._replace(interp='') == parse_dynamic(image)._replace(runpath=runpath)
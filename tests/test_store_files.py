@@ -0,0 +1,110 @@
+import pytest
+
+from dep_node import DepDefinition, str_to_def
+from store_files import BinaryDefFile, parse_env_file, rule_level, RULE_HASH, RULE_VERSION, RULE_RANGE, RULE_ANY
+
+def d(string):
+    return str_to_def(string)
+
+def rules(*defstrs):
+    binary_defs = BinaryDefFile()
+    for i, defstr in enumerate(defstrs):
+        binary_defs[d(defstr)] = {'rule': i}
+    return binary_defs
+
+@pytest.mark.parametrize('defstr, level', [
+    ('libc.so.6,2.19,abc', RULE_HASH),
+    ('libc.so.6,,abc', RULE_HASH),
+    ('libc.so.6,2.19,', RULE_VERSION),
+    ('libc.so.6,>=2.19,<3,', RULE_RANGE),
+    ('libc.so.6,,', RULE_ANY),
+    ('libc.so.6,latest,', RULE_ANY),
+])
+def test_rule_level(defstr, level):
+    assert rule_level(d(defstr)) == level
+
+# the rules of every level for one name, in the file from the least specific
+ALL_LEVELS = ('libc.so.6,,', 'libc.so.6,>=2.19,<3,', 'libc.so.6,2.19,', 'libc.so.6,,abc')
+
+@pytest.mark.parametrize('binary, expected', [
+    # the hash tags win over everything
+    ('libc.so.6,2.19,abc', 'libc.so.6,,abc'),
+    # then the exact version
+    ('libc.so.6,2.19,def', 'libc.so.6,2.19,'),
+    # then the range
+    ('libc.so.6,2.31,def', 'libc.so.6,>=2.19,<3,'),
+    # then any version
+    ('libc.so.6,3.1,def', 'libc.so.6,,'),
+])
+def test_precedence(binary, expected):
+    binary_defs = rules(*ALL_LEVELS)
+    assert binary_defs.find_rule(d(binary)) == d(expected)
+    assert binary_defs[d(binary)] == {'rule': ALL_LEVELS.index(expected)}
+
+@pytest.mark.parametrize('binary, expected', [
+    ('libc.so.6,,abc', 'libc.so.6,,abc'),
+    ('libc.so.6,2.19,', 'libc.so.6,,abc'),
+    ('libc.so.6,>=2.30,', 'libc.so.6,,abc'),
+    ('libc.so.6,,', 'libc.so.6,,abc'),
+])
+def test_precedence_loose_definition(binary, expected):
+    # a definition without hash tags or with a range matches the hash rule too
+    assert rules(*ALL_LEVELS).find_rule(d(binary)) == d(expected)
+
+def test_precedence_loose_definition_by_level():
+    binary_defs = rules('libc.so.6,,', 'libc.so.6,>=2.19,<3,', 'libc.so.6,2.19,')
+    assert binary_defs.find_rule(d('libc.so.6,2.19,')) == d('libc.so.6,2.19,')
+    assert binary_defs.find_rule(d('libc.so.6,>=2.20,')) == d('libc.so.6,>=2.19,<3,')
+    assert binary_defs.find_rule(d('libc.so.6,>=3,')) == d('libc.so.6,,')
+
+def test_same_level_first_in_file():
+    binary_defs = rules('libc.so.6,>=2,<3,', 'libc.so.6,>=2.19,<3,', 'libc.so.6,,x:y', 'libc.so.6,,y')
+    assert binary_defs.find_rule(d('libc.so.6,2.31,')) == d('libc.so.6,>=2,<3,')
+    assert binary_defs.find_rule(d('libc.so.6,2.31,z')) == d('libc.so.6,>=2,<3,')
+    assert binary_defs.find_rule(d('libc.so.6,2.31,y')) == d('libc.so.6,,x:y')
+
+def test_hash_rule_needs_matching_version():
+    binary_defs = rules('libc.so.6,2.19,abc', 'libc.so.6,,')
+    assert binary_defs.find_rule(d('libc.so.6,2.31,abc')) == d('libc.so.6,,')
+
+def test_no_match():
+    binary_defs = rules('libc.so.6,2.19,', 'libc.so.6,>=3,abc')
+    assert binary_defs.find_rule(d('libc.so.6,2.31,')) is None
+    assert binary_defs.find_rule(d('libm.so.6,2.19,')) is None
+    with pytest.raises(KeyError):
+        binary_defs[d('libc.so.6,2.31,')]
+
+def test_get_and_contains():
+    binary_defs = rules('libc.so.6,>=2.19,<3,', 'libm.so.6,,')
+
+    # a rule matches loosely, not by the exact key
+    assert d('libc.so.6,2.31,abc') in binary_defs
+    assert binary_defs.get(d('libc.so.6,2.31,abc')) == {'rule': 0}
+    assert d('libm.so.6,1,') in binary_defs
+    assert binary_defs.get(d('libm.so.6,1,')) == {'rule': 1}
+
+    assert d('libc.so.6,3,') not in binary_defs
+    assert binary_defs.get(d('libc.so.6,3,')) is None
+    assert binary_defs.get(d('libc.so.6,3,'), 'default') == 'default'
+    assert d('libz.so.1,,') not in binary_defs
+
+    # the other keys are never rules
+    assert 'libc.so.6' not in binary_defs
+    assert binary_defs.get('libc.so.6', 'default') == 'default'
+
+def test_delete_rule():
+    binary_defs = rules('libc.so.6,2.19,', 'libc.so.6,,')
+    del binary_defs[d('libc.so.6,2.19,')]
+    assert binary_defs.find_rule(d('libc.so.6,2.19,')) == d('libc.so.6,,')
+    assert len(binary_defs) == 1
+
+def test_parse_env_file(tmp_path):
+    env_file = tmp_path / 'env.txt'
+    env_file.write_text('hello,1.0, > libc.so.6,>=2.19,<3, libm.so.6,,abc\n'
+                        'libc.so.6,2.31,\n')
+
+    binary_defs = parse_env_file(env_file)
+
+    assert binary_defs[d('hello,1.0,x')] == {'libc.so.6': d('libc.so.6,>=2.19,<3,'),
+                                             'libm.so.6': DepDefinition('libm.so.6', '', frozenset({'abc'}))}
+    assert binary_defs[d('libc.so.6,2.31,')] == {}
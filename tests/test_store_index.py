@@ -0,0 +1,13 @@
+from store_index import StoreIndex
+
+def test_remove_root_normalizes_like_add_root(tmp_path, monkeypatch):
+    index = StoreIndex(tmp_path)
+    monkeypatch.chdir(tmp_path)
+
+    index.add_root('env1/')
+    index.add_root(str(tmp_path / 'env2'))
+    assert index.roots() == [str(tmp_path / 'env1'), str(tmp_path / 'env2')]
+
+    index.remove_root(str(tmp_path / 'env1') + '/')
+    index.remove_root('env2')
+    assert index.roots() == []
@@ -0,0 +1,137 @@
+import pytest
+
+from versions import version_key, is_range, VersionRange, parse_range, versions_overlap, VersionIndex
+
+def test_version_key_order():
+    assert version_key('libstdc++.so.6.0.9') < version_key('libstdc++.so.6.0.30')
+    assert version_key('2.19') < version_key('2.19.1')
+    assert version_key('2.19') == version_key('2.019')
+    assert version_key('1.0') < version_key('1.a')
+
+@pytest.mark.parametrize('constraint, expected', [
+    ('', True), ('latest', True), ('>=2.19', True), ('>=2,<3', True), ('==2.19', True),
+    ('2.19', False), ('libc-2.19.so', False),
+])
+def test_is_range(constraint, expected):
+    assert is_range(constraint) == expected
+
+def test_any():
+    for constraint in ('', 'latest'):
+        version_range = VersionRange(constraint)
+        assert version_range.lower is None and version_range.upper is None and version_range.exact is None
+        assert version_range.contains('0') and version_range.contains('99.1')
+
+def test_exact():
+    version_range = VersionRange('2.19')
+    assert version_range.exact == '2.19'
+    assert version_range.lower == version_range.upper == (version_key('2.19'), True)
+    assert version_range.contains('2.19')
+    # a plain version is matched literally, not by the key
+    assert not version_range.contains('2.019')
+    assert not version_range.contains('2.19.1')
+
+def test_equal_clause_compares_keys():
+    version_range = VersionRange('==2.19')
+    assert version_range.exact is None
+    assert version_range.contains('2.19') and version_range.contains('2.019')
+    assert not version_range.contains('2.20')
+
+@pytest.mark.parametrize('constraint, inside, outside', [
+    ('>=2.19', ['2.19', '2.20', '10'], ['2.18', '2.4', '1']),
+    ('>2.19', ['2.19.1', '2.20'], ['2.19', '2.18']),
+    ('<=3', ['3', '2.99', '0'], ['3.0', '3.1', '4']),
+    ('<3', ['2.99', '2'], ['3', '3.1']),
+    ('>=2.19,<3', ['2.19', '2.31'], ['2.18', '3', '3.1']),
+    ('>2.19,<=3', ['2.20', '3'], ['2.19', '3.0.1']),
+    (' >= 2.19 , < 3 ', ['2.19'], ['3']),
+])
+def test_bounds(constraint, inside, outside):
+    version_range = VersionRange(constraint)
+    assert all(version_range.contains(v) for v in inside)
+    assert not any(version_range.contains(v) for v in outside)
+
+def test_lower_upper_open_closed():
+    version_range = VersionRange('>=1,<2')
+    assert version_range.lower == (version_key('1'), True)
+    assert version_range.upper == (version_key('2'), False)
+
+    # open ends
+    assert VersionRange('>=1').upper is None
+    assert VersionRange('<2').lower is None
+
+def test_clauses_tighten():
+    version_range = VersionRange('>=1,>=2,>2,<5,<=4,<=4')
+    assert version_range.lower == (version_key('2'), False)
+    assert version_range.upper == (version_key('4'), True)
+
+@pytest.mark.parametrize('constraint, empty', [
+    ('>=2,<2', True), ('>2,<=2', True), ('>3,<2', True),
+    ('>=2,<=2', False), ('>=2', False), ('', False), ('2', False),
+])
+def test_is_empty(constraint, empty):
+    assert VersionRange(constraint).is_empty() == empty
+
+def test_no_operator():
+    with pytest.raises(ValueError):
+        VersionRange('>=1,2')
+
+def test_parse_range_is_cached():
+    assert parse_range('>=7,<8') is parse_range('>=7,<8')
+
+@pytest.mark.parametrize('version1, version2, expected', [
+    # empty matches anything
+    ('', '2.19', True), ('>=3', '', True), ('', '', True),
+    # plain versions are compared as strings
+    ('2.19', '2.19', True), ('2.19', '2.019', False), ('2.19', '2.20', False),
+    ('latest', '2.19', True),
+    # a plain version in a range
+    ('2.19', '>=2,<3', True), ('>=2,<3', '3.1', False),
+    # ranges
+    ('>=1,<2', '>=1.5,<3', True),
+    ('>=1,<2', '>=2,<3', False),
+    ('>=1,<=2', '>=2,<3', True),
+    ('<2', '>2', False),
+    ('>=1', '<=1', True),
+    ('>1', '<=1', False),
+    ('>=1', '>=5', True),
+])
+def test_versions_overlap(version1, version2, expected):
+    assert versions_overlap(version1, version2) == expected
+    assert versions_overlap(version2, version1) == expected
+
+def test_index_order():
+    index = VersionIndex(['2.31', '2.4', '2.19', '10', '2.19'])
+    assert list(index) == ['2.4', '2.19', '2.31', '10']
+    assert len(index) == 4
+
+    # equal keys keep both strings, ordered by the string
+    index.add('2.019')
+    assert list(index) == ['2.4', '2.019', '2.19', '2.31', '10']
+
+@pytest.mark.parametrize('constraint, selected, matching', [
+    ('', '10', ['2.4', '2.19', '2.31', '10']),
+    ('latest', '10', ['2.4', '2.19', '2.31', '10']),
+    ('2.19', '2.19', ['2.19']),
+    ('2.20', None, []),
+    ('==2.19', '2.19', ['2.19']),
+    ('>=2.19', '10', ['2.19', '2.31', '10']),
+    ('>2.19', '10', ['2.31', '10']),
+    ('<2.31', '2.19', ['2.4', '2.19']),
+    ('<=2.31', '2.31', ['2.4', '2.19', '2.31']),
+    ('>=2.19,<3', '2.31', ['2.19', '2.31']),
+    ('>2.4,<=2.19', '2.19', ['2.19']),
+    ('>=3,<10', None, []),
+    ('<2', None, []),
+    ('>10', None, []),
+    ('>=2.31,<2.19', None, []),
+])
+def test_index_select(constraint, selected, matching):
+    index = VersionIndex(['2.19', '2.31', '2.4', '10'])
+    assert index.select(constraint) == selected
+    assert index.matching(constraint) == matching
+
+def test_index_empty():
+    index = VersionIndex()
+    assert index.select() is None
+    assert index.select('>=1') is None
+    assert index.matching('1') == []
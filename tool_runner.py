@@ -0,0 +1,111 @@
+'''
+Runner of the external tools (readelf, patchelf...) on asyncio.
+
+The tools are exec-ed directly, without a shell, their output is read as
+it streams, and a semaphore bounds how many run at once.
+One event loop runs in a background thread for the whole process.
+run_tool waits for one call, run_many puts a whole batch in flight at once,
+up to the bound, whatever the --jobs of the caller: scan_files reads the
+readelf fallbacks of a frontier and convert_nodes_to_store runs the patchelf
+fallbacks of its nodes as batches:
+
+    output = run_tool(['readelf', '-d', filename])       # from any thread, blocks
+    outputs = run_many([['readelf', '-d', f] for f in filenames], return_exceptions=True)
+
+    # or from a coroutine
+    output = await runner.run(['patchelf', '--set-rpath', rpath, filename])
+
+A failed tool raises ToolError, a subprocess.CalledProcessError.
+'''
+
+import asyncio
+import logging
+import os
+import threading
+from subprocess import CalledProcessError, DEVNULL, PIPE
+
+import run_stats
+
+MAX_CONCURRENCY = 4 * (os.cpu_count() or 1)
+READ_CHUNK = 1 << 16
+
+class ToolError(CalledProcessError):
+    def __str__(self):
+        stderr = self.stderr.decode(errors='replace').strip() if self.stderr else ''
+        return f'{super().__str__()} {stderr}'.strip()
+
+class ToolRunner:
+    def __init__(self, max_concurrency=MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.semaphore = None  # made in the loop that uses it
+
+    async def run(self, argv, on_output=None):
+        '''
+        await run(argv, on_output=None) -> stdout bytes
+
+        on_output(chunk) is called with the stdout chunks as they come.
+        '''
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self.semaphore:
+            run_stats.spawned(os.path.basename(argv[0]))
+            process = await asyncio.create_subprocess_exec(*argv, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+
+            chunks = []
+            async def read_stdout():
+                while True:
+                    chunk = await process.stdout.read(READ_CHUNK)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                    if on_output is not None:
+                        on_output(chunk)
+
+            _, stderr = await asyncio.gather(read_stdout(), process.stderr.read())
+            returncode = await process.wait()
+
+        output = b''.join(chunks)
+        if returncode != 0:
+            raise ToolError(returncode, argv, output, stderr)
+
+        logging.debug(f'ToolRunner: {" ".join(argv)}')
+        return output
+
+    async def run_all(self, argvs, return_exceptions=False):
+        return await asyncio.gather(*(self.run(argv) for argv in argvs), return_exceptions=return_exceptions)
+
+runner = ToolRunner()
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def _background_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='tool_runner', daemon=True).start()
+            _loop = loop
+        return _loop
+
+def run_tool(argv):
+    '''
+    run_tool(argv) -> stdout bytes
+
+    The synchronous wrapper: run on the background loop, wait for the result.
+    '''
+
+    return asyncio.run_coroutine_threadsafe(runner.run(argv), _background_loop()).result()
+
+def run_many(argvs, return_exceptions=False):
+    '''
+    run_many(argvs, return_exceptions=False) -> [stdout bytes or exception, ...]
+
+    All the commands at once, up to the concurrency bound, the results in order.
+    '''
+
+    if not argvs:
+        return []
+    return asyncio.run_coroutine_threadsafe(runner.run_all(argvs, return_exceptions), _background_loop()).result()
@@ -0,0 +1,212 @@
+'''
+Sortable versions and version constraints for the definitions.
+
+The versions here are the file names the binaries resolve to, like
+libc-2.19.so, libstdc++.so.6.0.30 or just 2.19. A version is parsed
+into a key of components: the runs of digits compare as numbers,
+the other runs as strings, the separators . - _ + are dropped:
+
+    libstdc++.so.6.0.9 < libstdc++.so.6.0.30
+
+A constraint is a version or a comma-separated list of clauses:
+
+    ''          -- any version
+    latest      -- any version, the latest is picked
+    2.19        -- exactly this version string
+    >=2.19,<3   -- a range, the clauses are ANDed
+    ==2.19      -- the same as 2.19, compared by the key
+
+The clauses make an interval of the sorted versions, so VersionIndex
+answers a constraint with two binary searches.
+'''
+
+import re
+from bisect import bisect_left, bisect_right
+
+ANY_VERSION = ('', 'latest')
+
+_COMPONENT = re.compile(r'(\d+)|([^\d.\-_+]+)')
+_CLAUSE = re.compile(r'^(>=|<=|==|>|<|=)\s*(.*)$')
+
+def version_key(version):
+    '''
+    version_key('libc-2.19.so') -> ((1, 'libc'), (0, 2), (0, 19), (1, 'so'))
+
+    The numbers sort before the strings at the same position,
+    a prefix sorts before the longer version: 2.19 < 2.19.1
+    '''
+
+    return tuple((0, int(number)) if number else (1, text)
+                 for number, text in _COMPONENT.findall(version))
+
+def is_range(version):
+    '''a constraint that is not a plain version string'''
+    return version in ANY_VERSION or ',' in version or _CLAUSE.match(version) is not None
+
+class VersionRange:
+    '''
+    The interval of versions a constraint allows:
+    lower and upper are (key, inclusive) or None for no bound.
+    '''
+
+    __slots__ = ('lower', 'upper', 'exact')
+
+    def __init__(self, constraint=''):
+        self.lower = self.upper = None
+        # a plain version string is matched literally, like DepDefinition always did
+        self.exact = None
+
+        if constraint in ANY_VERSION:
+            return
+
+        if not is_range(constraint):
+            self.exact = constraint
+            key = version_key(constraint)
+            self.lower = self.upper = (key, True)
+            return
+
+        for clause in constraint.split(','):
+            clause = clause.strip()
+            if not clause:
+                continue
+
+            match = _CLAUSE.match(clause)
+            if match is None:
+                raise ValueError(f'VersionRange: no operator in the clause {clause!r} of {constraint!r}')
+
+            op, version = match.groups()
+            key = version_key(version)
+            if op in ('>=', '>'):
+                self._tighten_lower((key, op == '>='))
+            elif op in ('<=', '<'):
+                self._tighten_upper((key, op == '<='))
+            else:
+                self._tighten_lower((key, True))
+                self._tighten_upper((key, True))
+
+    def _tighten_lower(self, bound):
+        # the higher key, or the exclusive one of equal keys
+        if self.lower is None or bound[0] > self.lower[0] or (bound[0] == self.lower[0] and not bound[1]):
+            self.lower = bound
+
+    def _tighten_upper(self, bound):
+        if self.upper is None or bound[0] < self.upper[0] or (bound[0] == self.upper[0] and not bound[1]):
+            self.upper = bound
+
+    def __repr__(self):
+        return f'VersionRange(lower={self.lower}, upper={self.upper}, exact={self.exact!r})'
+
+    def is_empty(self):
+        if self.lower is None or self.upper is None:
+            return False
+        (low, low_incl), (high, high_incl) = self.lower, self.upper
+        return low > high or (low == high and not (low_incl and high_incl))
+
+    def contains(self, version):
+        if self.exact is not None:
+            return version == self.exact
+
+        key = version_key(version)
+        if self.lower is not None:
+            low, inclusive = self.lower
+            if key < low or (key == low and not inclusive):
+                return False
+        if self.upper is not None:
+            high, inclusive = self.upper
+            if key > high or (key == high and not inclusive):
+                return False
+        return True
+
+    def overlaps(self, other):
+        '''there can be a version that satisfies both'''
+        if self.exact is not None:
+            return other.contains(self.exact)
+        if other.exact is not None:
+            return self.contains(other.exact)
+
+        both = VersionRange()
+        for bound in (self.lower, other.lower):
+            if bound is not None:
+                both._tighten_lower(bound)
+        for bound in (self.upper, other.upper):
+            if bound is not None:
+                both._tighten_upper(bound)
+        return not both.is_empty()
+
+_ranges = {}
+
+def parse_range(constraint):
+    '''VersionRange of the constraint, parsed once per string'''
+    version_range = _ranges.get(constraint)
+    if version_range is None:
+        version_range = _ranges[constraint] = VersionRange(constraint)
+    return version_range
+
+def versions_overlap(version1, version2):
+    '''the DepDefinition version match: empty matches anything, ranges must overlap'''
+    if not version1 or not version2:
+        return True
+    if not is_range(version1) and not is_range(version2):
+        return version1 == version2
+    return parse_range(version1).overlaps(parse_range(version2))
+
+class VersionIndex:
+    '''
+    The versions of one name, sorted by their keys.
+
+        index = VersionIndex(['2.19', '2.31', '2.4'])
+        index.select('>=2.19,<3') -> '2.31'
+    '''
+
+    def __init__(self, versions=()):
+        self.keys = []
+        self.versions = []
+        for version in versions:
+            self.add(version)
+
+    def __len__(self):
+        return len(self.versions)
+
+    def __iter__(self):
+        return iter(self.versions)
+
+    def add(self, version):
+        key = version_key(version)
+        # equal keys (2.19 and 2.019) keep both strings, ordered by the string
+        i = bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key and self.versions[i] < version:
+            i += 1
+        if i < len(self.keys) and self.versions[i] == version:
+            return
+        self.keys.insert(i, key)
+        self.versions.insert(i, version)
+
+    def matching(self, constraint):
+        '''the versions that satisfy the constraint, in order'''
+        version_range = parse_range(constraint)
+        if version_range.exact is not None:
+            return [version_range.exact] if version_range.exact in self.versions[self._span(version_range)] else []
+        return self.versions[self._span(version_range)]
+
+    def _span(self, version_range):
+        start, stop = 0, len(self.keys)
+        if version_range.lower is not None:
+            key, inclusive = version_range.lower
+            start = (bisect_left if inclusive else bisect_right)(self.keys, key)
+        if version_range.upper is not None:
+            key, inclusive = version_range.upper
+            stop = (bisect_right if inclusive else bisect_left)(self.keys, key)
+        return slice(start, max(start, stop))
+
+    def select(self, constraint=''):
+        '''
+        select(constraint='') -> the latest version that satisfies the constraint, or None
+        '''
+
+        version_range = parse_range(constraint)
+        if version_range.exact is not None:
+            span = self.versions[self._span(version_range)]
+            return version_range.exact if version_range.exact in span else None
+
+        span = self._span(version_range)
+        return self.versions[span.stop - 1] if span.stop > span.start else None